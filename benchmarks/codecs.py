@@ -0,0 +1,79 @@
+'''
+  OnionPerf
+  Authored by Rob Jansen, 2015
+  Copyright 2015-2020 The Tor Project
+  See LICENSE for licensing information
+'''
+
+# Compares the encode and decode throughput and the compressed size of the
+# compression codecs in onionperf.util on the bundled test logs and analysis
+# results. Codecs whose library is not installed are reported as such. Run
+# from the repository root:
+#
+#   python benchmarks/codecs.py --codecs xz:1,xz:6,gz:9,zstd:3,lz4:0
+#
+# Repeating the inputs with --repeat gives steadier timings but flatters the
+# ratios of codecs with large windows, which find the earlier copies.
+
+import argparse, glob, os, shutil, sys, tempfile, time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from onionperf import util
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "onionperf", "tests", "data")
+
+def read_inputs(repeat):
+    ''' returns (name, bytes) of the bundled logs and decompressed analyses, each concatenated repeat times '''
+    inputs = []
+    for path in sorted(glob.glob(os.path.join(DATA_DIR, "logs", "*.log"))) + \
+            sorted(glob.glob(os.path.join(DATA_DIR, "analyses", "*.json.xz")))[:1]:
+        with util.open_binary(path) as f:
+            inputs.append((os.path.basename(path), f.read() * repeat))
+    return inputs
+
+def measure(codec, level, content, path, rounds):
+    encode_seconds, decode_seconds = None, None
+    for _ in range(rounds):
+        start = time.perf_counter()
+        with codec.open(path, 'wb', level=level) as f:
+            f.write(content)
+        seconds = time.perf_counter() - start
+        encode_seconds = seconds if encode_seconds is None else min(encode_seconds, seconds)
+        start = time.perf_counter()
+        with util.open_binary(path) as f:
+            decoded = f.read()
+        seconds = time.perf_counter() - start
+        decode_seconds = seconds if decode_seconds is None else min(decode_seconds, seconds)
+        assert decoded == content
+    return encode_seconds, decode_seconds, os.path.getsize(path)
+
+def main():
+    arg_parser = argparse.ArgumentParser(description="Benchmark the compression codecs for logs and analysis results")
+    arg_parser.add_argument('--repeat', help="concatenate each input N times to get bigger inputs", metavar="N", type=int, default=1)
+    arg_parser.add_argument('--codecs', help="comma-separated CODEC or CODEC:LEVEL entries to measure", metavar="LIST",
+                            default="xz:1,xz:6,gz:1,gz:9,zstd:3,zstd:19,lz4:0,plain")
+    arg_parser.add_argument('--rounds', help="take the best of N rounds per codec", metavar="N", type=int, default=3)
+    args = arg_parser.parse_args()
+
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        print("{0:>46} {1:>8} {2:>12} {3:>14} {4:>14} {5:>8}".format("input", "codec", "input bytes", "encode MB/s", "decode MB/s", "ratio"))
+        for (name, content) in read_inputs(args.repeat):
+            for entry in args.codecs.split(','):
+                (codec_name, _, level) = entry.partition(':')
+                codec = util.get_codec(codec_name)
+                level = int(level) if level else None
+                label = "{0}:{1}".format(codec.name, codec.get_level(level)) if codec.default_level is not None else codec.name
+                if not codec.is_available():
+                    print("{0:>46} {1:>8} {2:>12} {3:>14}".format(name, label, len(content), "not installed"))
+                    continue
+                path = os.path.join(tmp_dir, "bench" + codec.extension)
+                encode_seconds, decode_seconds, size = measure(codec, level, content, path, args.rounds)
+                print("{0:>46} {1:>8} {2:>12} {3:>14.1f} {4:>14.1f} {5:>8.2f}".format(name, label, len(content),
+                      len(content) / encode_seconds / 1e6, len(content) / decode_seconds / 1e6, len(content) / size))
+    finally:
+        shutil.rmtree(tmp_dir)
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,70 @@
+'''
+  OnionPerf
+  Authored by Rob Jansen, 2015
+  Copyright 2015-2020 The Tor Project
+  See LICENSE for licensing information
+'''
+
+# Measures how the cost of parsing torctl events grows with the number of
+# guard rotations, as seen when running with --drop-guards for weeks, using
+# TorGuardRegistry and using the linear scan over all guards that
+# TorCtlParser did before. Run from the repository root:
+#
+#   python benchmarks/guard_registry.py --rotations 500,1000,2000,4000
+
+import argparse, os, sys, time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from onionperf import util
+from onionperf.analysis import TorCtlParser, TorGuardRegistry
+
+def generate_lines(num_rotations, circuits_per_rotation):
+    ''' returns torctl log lines in which one guard is replaced by a new one num_rotations times '''
+    lines = []
+    unix_ts = 1548934190.0
+    circ_id = 0
+    for rotation in range(num_rotations):
+        fingerprint = "{0:040X}".format(rotation)
+        for status in ['NEW', 'UP']:
+            unix_ts += 1.0
+            lines.append("2019-01-31 00:00:00 {0:.02f} 650 GUARD ENTRY ${1}~guard{2} {3}\r\n".format(unix_ts, fingerprint, rotation, status))
+        for _ in range(circuits_per_rotation):
+            circ_id += 1
+            for status in ['LAUNCHED', 'CLOSED']:
+                unix_ts += 0.5
+                lines.append("2019-01-31 00:00:00 {0:.02f} 650 CIRC {1} {2} PURPOSE=GENERAL\r\n".format(unix_ts, circ_id, status))
+        unix_ts += 1.0
+        lines.append("2019-01-31 00:00:00 {0:.02f} 650 GUARD ENTRY ${1}~guard{2} DROPPED\r\n".format(unix_ts, fingerprint, rotation))
+    return lines
+
+class ScanGuardRegistry(TorGuardRegistry):
+    ''' looks up current_guards with the linear scan over all guards that TorCtlParser used before '''
+    def get_current(self, unix_ts):
+        return [g for g in self.guards if g.up_ts and unix_ts >= g.up_ts and (not g.dropped_ts or unix_ts < g.dropped_ts)]
+
+def parse(lines, registry):
+    parser = TorCtlParser(country_lookup=util.CountryLookup(offline=True))
+    parser.guard_registry = registry
+    parser.guards = registry.guards
+    start = time.perf_counter()
+    parser.parse(lines)
+    seconds = time.perf_counter() - start
+    return seconds, parser.get_data()
+
+def main():
+    arg_parser = argparse.ArgumentParser(description="Benchmark guard lookups in TorCtlParser")
+    arg_parser.add_argument('--rotations', help="comma-separated numbers of guard rotations to measure", metavar="LIST", default="500,1000,2000,4000")
+    arg_parser.add_argument('--circuits', help="the number of circuits per guard rotation", metavar="N", type=int, default=5)
+    args = arg_parser.parse_args()
+
+    print("{0:>10} {1:>10} {2:>18} {3:>18} {4:>10}".format("rotations", "events", "registry (us/ev)", "scan (us/ev)", "identical"))
+    for num_rotations in [int(n) for n in args.rotations.split(',')]:
+        lines = generate_lines(num_rotations, args.circuits)
+        registry_seconds, registry_data = parse(lines, TorGuardRegistry())
+        scan_seconds, scan_data = parse(lines, ScanGuardRegistry())
+        print("{0:>10} {1:>10} {2:>18.2f} {3:>18.2f} {4:>10}".format(num_rotations, len(lines),
+              registry_seconds * 1e6 / len(lines), scan_seconds * 1e6 / len(lines), str(registry_data == scan_data)))
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,84 @@
+'''
+  OnionPerf
+  Authored by Rob Jansen, 2015
+  Copyright 2015-2020 The Tor Project
+  See LICENSE for licensing information
+'''
+
+# Measures how many torctl event lines per second the tokenizer behind
+# TorCtlParser's fast_parse handles compared to parsing them with stem, both
+# for the events alone and for whole parses of a log, and checks that both
+# ways give the same results. Run from the repository root:
+#
+#   python benchmarks/torctl_tokenizer.py --repeat 20
+
+import argparse, os, sys, time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from stem.response import ControlMessage, convert
+
+from onionperf import util
+from onionperf.analysis import TorCtlParser, TORCTL_EVENT_ARGS, parse_torctl_event
+
+DEFAULT_LOG = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                           "onionperf", "tests", "data", "logs", "onionperf.torctl.log")
+
+def read_events(filename, repeat):
+    ''' returns the contents of the event lines that TorCtlParser consumes, repeated repeat times '''
+    events = []
+    with open(filename, 'rt', newline='\r\n') as f:
+        for line in f:
+            _, sep, content = line.partition(" 650 ")
+            if sep != '' and content.split(None, 1)[0] in TORCTL_EVENT_ARGS:
+                events.append(content)
+    return events * repeat
+
+def tokenize_fast(events):
+    for content in events:
+        parse_torctl_event(content)
+
+def tokenize_stem(events):
+    for content in events:
+        event = ControlMessage.from_str("650 {0}".format(content))
+        convert('EVENT', event)
+
+def parse_log(lines, fast_parse):
+    parser = TorCtlParser(fast_parse=fast_parse, country_lookup=util.CountryLookup(offline=True))
+    parser.parse(lines)
+    return parser.get_data()
+
+def best_of(rounds, func, *args):
+    best, result = None, None
+    for _ in range(rounds):
+        start = time.perf_counter()
+        result = func(*args)
+        seconds = time.perf_counter() - start
+        best = seconds if best is None else min(best, seconds)
+    return best, result
+
+def main():
+    arg_parser = argparse.ArgumentParser(description="Benchmark the torctl event tokenizer against stem")
+    arg_parser.add_argument('--log', help="an uncompressed torctl log file PATH", metavar="PATH", default=DEFAULT_LOG)
+    arg_parser.add_argument('--repeat', help="repeat the events of the log N times to get a bigger input", metavar="N", type=int, default=20)
+    arg_parser.add_argument('--rounds', help="take the best of N rounds", metavar="N", type=int, default=3)
+    args = arg_parser.parse_args()
+
+    events = read_events(args.log, args.repeat)
+    with open(args.log, 'rt', newline='\r\n') as f:
+        lines = f.readlines()
+    lines = lines * args.repeat
+    fast_seconds, _ = best_of(args.rounds, tokenize_fast, events)
+    stem_seconds, _ = best_of(args.rounds, tokenize_stem, events)
+    fast_parse_seconds, fast_data = best_of(args.rounds, parse_log, lines, True)
+    stem_parse_seconds, stem_data = best_of(args.rounds, parse_log, lines, False)
+
+    print("{0:>12} {1:>10} {2:>16} {3:>16} {4:>8} {5:>10}".format("input", "lines", "fast (lines/s)", "stem (lines/s)", "speedup", "identical"))
+    print("{0:>12} {1:>10} {2:>16.0f} {3:>16.0f} {4:>8.2f} {5:>10}".format("events", len(events),
+          len(events) / fast_seconds, len(events) / stem_seconds, stem_seconds / fast_seconds, "-"))
+    print("{0:>12} {1:>10} {2:>16.0f} {3:>16.0f} {4:>8.2f} {5:>10}".format("parse", len(lines),
+          len(lines) / fast_parse_seconds, len(lines) / stem_parse_seconds, stem_parse_seconds / fast_parse_seconds,
+          str(fast_data == stem_data)))
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,64 @@
+'''
+  OnionPerf
+  Authored by Rob Jansen, 2015
+  Copyright 2015-2020 The Tor Project
+  See LICENSE for licensing information
+'''
+
+# Measures how parsing one torctl log with TorCtlParser scales with the
+# number of worker processes, and checks that the results are identical to
+# those of the serial parser. Run from the repository root:
+#
+#   python benchmarks/torctl_workers.py --repeat 200 --workers 1,2,4,8
+
+import argparse, json, os, shutil, sys, tempfile, time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from onionperf import util
+from onionperf.analysis import TorCtlParser
+
+DEFAULT_LOG = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                           "onionperf", "tests", "data", "logs", "onionperf.torctl.log")
+
+def parse(filename, num_workers):
+    parser = TorCtlParser(num_workers=num_workers)
+    start = time.perf_counter()
+    parser.parse(util.DataSource(filename))
+    seconds = time.perf_counter() - start
+    result = json.dumps({'data': parser.get_data(), 'name': parser.get_name(), 'counts': parser.get_event_counts()}, sort_keys=True)
+    return seconds, result
+
+def main():
+    arg_parser = argparse.ArgumentParser(description="Benchmark parallel torctl log parsing")
+    arg_parser.add_argument('--log', help="an uncompressed torctl log file PATH", metavar="PATH", default=DEFAULT_LOG)
+    arg_parser.add_argument('--repeat', help="concatenate the log N times to get a bigger input", metavar="N", type=int, default=100)
+    arg_parser.add_argument('--workers', help="comma-separated worker counts to measure", metavar="LIST", default="1,2,4,8")
+    arg_parser.add_argument('--rounds', help="take the best of N rounds per worker count", metavar="N", type=int, default=3)
+    args = arg_parser.parse_args()
+
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        filename = os.path.join(tmp_dir, "bench.torctl.log")
+        with open(args.log, 'rb') as inf:
+            content = inf.read()
+        with open(filename, 'wb') as outf:
+            for _ in range(args.repeat):
+                outf.write(content)
+        print("input: {0} bytes, {1} CPUs".format(os.path.getsize(filename), os.cpu_count()))
+
+        serial_seconds, serial_result = None, None
+        print("{0:>8} {1:>10} {2:>8} {3:>10}".format("workers", "seconds", "speedup", "identical"))
+        for num_workers in [int(n) for n in args.workers.split(',')]:
+            best = None
+            for _ in range(args.rounds):
+                seconds, result = parse(filename, num_workers)
+                best = seconds if best is None else min(best, seconds)
+            if serial_result is None:
+                serial_seconds, serial_result = best, result
+            print("{0:>8} {1:>10.3f} {2:>8.2f} {3:>10}".format(num_workers, best, serial_seconds / best, str(result == serial_result)))
+    finally:
+        shutil.rmtree(tmp_dir)
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -5,32 +5,185 @@
   See LICENSE for licensing information
 '''
 
-import os, re, json, datetime, logging
+import os, sys, re, json, datetime, logging, pickle, threading, bisect, copy, gc, glob, hashlib, itertools, traceback
+
+from array import array
 
 from abc import ABCMeta, abstractmethod
+from multiprocessing import Pool, Process, Queue, cpu_count, current_process
 
 # stem imports
-from stem import CircEvent, CircStatus, CircPurpose, StreamStatus, GuardStatus, GuardType
-from stem.response.events import CircuitEvent, CircMinorEvent, StreamEvent, BuildTimeoutSetEvent, GuardEvent
+from stem import CircEvent, CircStatus, CircPurpose, StreamStatus, GuardStatus, GuardType, ProtocolError
 from stem.response import ControlMessage, convert
+from stem.util import connection, tor_tools
 
 # tgentools imports
-from tgentools.analysis import Analysis, TGenParser
+from tgentools.analysis import Analysis, TGenParser, Stream, StreamStatusEvent, StreamSuccessEvent, StreamErrorEvent
+from tgentools._version import __version__ as tgentools_version
 
 # onionperf imports
-from . import util
+from . import util, sketches, profiling
+
+TGEN_INIT_LINE = re.compile(r"Initializing\sTGen\sv")
+
+# the revision of the parsing and analysis code; increase it whenever a change
+# makes analyzing the same logs give different results, so that reprocessing
+# runs analyze the logs again rather than keeping the results they recorded
+ANALYSIS_REVISION = 1
+
+def _parse_log_files(parser, json_db_key, filepaths, parse_args, time_window, build_index, profiler):
+    for filepath in filepaths:
+        logging.info("parsing log file at {0}".format(filepath))
+        with profiling.phase(profiler, "{0}.parse".format(json_db_key), file=filepath) as record:
+            source = util.DataSource(filepath, time_window=time_window, build_index=build_index, count_lines=profiler is not None)
+            parser.parse(source, **parse_args)
+            record.update(lines=source.lines_read, bytes=source.bytes_read, file_bytes=source.get_size())
+
+def _parse_log_files_by_day(make_parser, json_db_key, filepaths, newline, parse_args, profiler, num_workers=1):
+    '''
+    Parses the log files at filepaths in a single pass, handing each line to
+    the parser that make_parser(date) returns for the UTC date of the line.
+    Like a parse filtered by date, each parser also reads the head lines of
+    every log, which carry the startup messages, in the order of the logs.
+    With num_workers > 1, the parsers of different dates run in that many
+    worker processes, which each get the lines of every num_workers-th date.
+    Returns a dict of date -> parser and the list of the head lines of each log.
+    '''
+    dates = []
+    heads = []
+    parsers = {}
+    if num_workers > 1:
+        # the workers are forked, so make_parser need not be picklable
+        feed_queues = [Queue(maxsize=TORCTL_CHUNKS_PER_WORKER) for _ in range(num_workers)]
+        result_queue = Queue()
+        workers = [Process(target=_parse_days_task, args=(make_parser, parse_args, feed_queue, result_queue), daemon=True)
+                   for feed_queue in feed_queues]
+        for worker in workers:
+            worker.start()
+        date_workers = {}
+
+    def feed(date, lines):
+        if num_workers > 1:
+            feed_queues[date_workers.setdefault(date, len(date_workers) % num_workers)].put((date, lines))
+            return
+        if date not in parsers:
+            parsers[date] = make_parser(date)
+        parsers[date].parse(lines, **parse_args)
+
+    for filepath in filepaths:
+        logging.info("parsing log file at {0} by date".format(filepath))
+        with profiling.phase(profiler, "{0}.parse".format(json_db_key), file=filepath) as record:
+            source = util.DataSource(filepath, count_lines=profiler is not None)
+            source.open(newline=newline)
+            lines = iter(source)
+            head = list(itertools.islice(lines, util.LogIndex.HEAD_LINES))
+            seen = set()
+            for (date, batch) in util.iter_lines_by_date(itertools.chain(head, lines)):
+                if date not in dates:
+                    dates.append(date)
+                    for earlier_head in heads:
+                        feed(date, _get_head_lines(earlier_head, date))
+                if date not in seen:
+                    seen.add(date)
+                    feed(date, _get_head_lines(head, date))
+                feed(date, batch)
+            source.close()
+            for date in dates:
+                if date not in seen:
+                    feed(date, _get_head_lines(head, date))
+            heads.append(head)
+            record.update(lines=source.lines_read, bytes=source.bytes_read, file_bytes=source.get_size())
+
+    if num_workers > 1:
+        for feed_queue in feed_queues:
+            feed_queue.put(None)
+        errors = []
+        for _ in workers:
+            (worker_parsers, error) = result_queue.get()
+            if error is not None:
+                errors.append(error)
+            else:
+                parsers.update(worker_parsers)
+        for worker in workers:
+            worker.join()
+        if len(errors) > 0:
+            raise RuntimeError("parsing {0} logs by date failed in a worker process: {1}".format(json_db_key, errors[0]))
+    return (parsers, heads)
+
+def _get_head_lines(head, date):
+    ''' returns the head lines of a log that a parser of the given date reads before the lines of its date '''
+    return [line for line in head if util.get_line_date(line) != date]
+
+def _parse_days_task(make_parser, parse_args, feed_queue, result_queue):
+    parsers = {}
+    try:
+        for (date, lines) in iter(feed_queue.get, None):
+            if date not in parsers:
+                parsers[date] = make_parser(date)
+            parsers[date].parse(lines, **parse_args)
+    except Exception:
+        result_queue.put((None, traceback.format_exc()))
+        # keep draining, so that the main process never blocks on a full queue
+        for _ in iter(feed_queue.get, None):
+            pass
+        return
+    result_queue.put((parsers, None))
+
+def _parse_tgen_files(args):
+    '''
+    Parses the tgen log files for OPAnalysis.analyze, possibly in a worker
+    process, and returns the parsed name and data along with the profiled
+    phases, which are plain dicts that are cheap to send back.
+    '''
+    (filepaths, date_filter, time_window, build_index, do_profile) = args
+    profiler = profiling.Profiler("analyze") if do_profile else None
+    parser = TGenStreamParser(date_filter=date_filter)
+    _parse_log_files(parser, 'tgen', filepaths, {'do_complete': True}, time_window, build_index, profiler)
+    with profiling.phase(profiler, "tgen.get_data"):
+        data = parser.get_data()
+    return (parser.get_name(), data, profiler.phases if profiler is not None else [])
 
 class OPAnalysis(Analysis):
 
     def __init__(self, nickname=None, ip_address=None):
         super().__init__(nickname, ip_address)
-        self.json_db = {'type': 'onionperf', 'version': '3.1', 'data': {}}
+        self.json_db = {'type': 'onionperf', 'version': '3.2', 'data': {}}
         self.torctl_filepaths = []
+        self.torctl_parser = None
+        self.tgen_parser = None
+        self.country_lookup = None
+        self.profiler = None
+        # set by load when it skipped sections, so that they can be loaded on first use
+        self.filepath = None
+        self.skipped_sections = set()
 
     def add_torctl_file(self, filepath):
         self.torctl_filepaths.append(filepath)
 
-    def analyze(self, date_filter=None, exclude_cbt=False):
+    def set_country_lookup(self, country_lookup):
+        ''' sets the util.CountryLookup used to find the countries of guards '''
+        self.country_lookup = country_lookup
+
+    def set_profiler(self, profiler):
+        ''' sets the profiling.Profiler that records how long each phase of analyze and save takes '''
+        self.profiler = profiler
+
+    def add_torctl_parser(self, parser):
+        '''
+        Uses a TorCtlParser that was already fed with events, such as the one
+        returned by TorCtlLiveSink.rotate, in place of parsing torctl log files.
+        '''
+        self.torctl_parser = parser
+
+    def add_tgen_parser(self, parser):
+        '''
+        Uses a TGenStreamParser that was already fed with the lines of a tgen
+        log, such as one read from an archive, in place of parsing tgen log files.
+        '''
+        self.tgen_parser = parser
+
+    def analyze(self, date_filter=None, exclude_cbt=False, build_index=False, torctl_workers=1, state_horizon=None,
+                concurrent=None):
         if self.did_analysis:
             return
         self.exclude_cbt = exclude_cbt
@@ -39,91 +192,297 @@ class OPAnalysis(Analysis):
             tor_circuits_filters = filters.setdefault("tor/circuits", [])
             tor_circuits_filters.append({"name": "exclude_cbt"})
         self.date_filter = date_filter
-        super().analyze(do_complete=True, date_filter=self.date_filter)
-        torctl_parser = TorCtlParser(date_filter=self.date_filter, exclude_cbt=self.exclude_cbt)
-
-        for (filepaths, parser, json_db_key) in [(self.torctl_filepaths, torctl_parser, 'tor')]:
+        # with a date filter, logs that have a sidecar time index (or get one
+        # if build_index is set) are only read around the requested date
+        time_window = util.get_date_window(self.date_filter) if self.date_filter is not None else None
+        torctl_parser = self.torctl_parser
+        if torctl_parser is None:
+            torctl_parser = TorCtlParser(date_filter=self.date_filter, exclude_cbt=self.exclude_cbt, num_workers=torctl_workers,
+                                         state_horizon=state_horizon)
+        if self.country_lookup is not None:
+            torctl_parser.country_lookup = self.country_lookup
+
+        tgen_args = (self.tgen_filepaths, self.date_filter, time_window, build_index, self.profiler is not None)
+        if concurrent is None:
+            # a worker process only slows things down without a spare CPU to
+            # run on, and cannot be started from a worker of a process pool
+            concurrent = cpu_count() > 1 and not current_process().daemon
+        if self.tgen_parser is not None:
+            tgen_name, tgen_data, tgen_phases = self.tgen_parser.get_name(), self.tgen_parser.get_data(), []
+            _parse_log_files(torctl_parser, 'tor', self.torctl_filepaths, {}, time_window, build_index, self.profiler)
+        elif concurrent and len(self.tgen_filepaths) > 0 and len(self.torctl_filepaths) > 0:
+            # the two parses are independent, so parse the tgen logs in a worker
+            # process while this one parses the torctl logs
+            with Pool(1) as pool:
+                tgen_result = pool.apply_async(_parse_tgen_files, (tgen_args,))
+                _parse_log_files(torctl_parser, 'tor', self.torctl_filepaths, {}, time_window, build_index, self.profiler)
+                tgen_name, tgen_data, tgen_phases = tgen_result.get()
+        else:
+            tgen_name, tgen_data, tgen_phases = _parse_tgen_files(tgen_args) if len(self.tgen_filepaths) > 0 else (None, None, [])
+            _parse_log_files(torctl_parser, 'tor', self.torctl_filepaths, {}, time_window, build_index, self.profiler)
+        if self.profiler is not None:
+            self.profiler.phases.extend(tgen_phases)
+
+        if tgen_data is not None:
+            self.__add_parser_data(tgen_name, tgen_data, 'tgen')
+        if len(self.torctl_filepaths) > 0 or torctl_parser is self.torctl_parser:
+            with profiling.phase(self.profiler, "tor.get_data"):
+                self.__add_parser_data(torctl_parser.get_name(), torctl_parser.get_data(), 'tor')
+
+        self.__finish_analysis(torctl_parser)
+
+    def analyze_follow(self, checkpoint_filename, exclude_cbt=False, state_horizon=None):
+        '''
+        Analyzes the log files while they are still being written: only the
+        lines appended since the checkpoint in checkpoint_filename was saved
+        are parsed, starting from the parser state stored in it, and the
+        updated checkpoint is saved again afterwards. The checkpoint is
+        discarded if any of the log files was replaced or truncated since.
+        '''
+        if self.did_analysis:
+            return
+        self.exclude_cbt = exclude_cbt
+        if exclude_cbt:
+            filters = self.json_db.setdefault("filters", {})
+            tor_circuits_filters = filters.setdefault("tor/circuits", [])
+            tor_circuits_filters.append({"name": "exclude_cbt"})
+        self.date_filter = None
+        checkpoint = AnalysisCheckpoint.load(checkpoint_filename)
+        if checkpoint is None or not checkpoint.is_valid(self.tgen_filepaths + self.torctl_filepaths):
+            checkpoint = AnalysisCheckpoint(TGenStreamParser(), TorCtlParser(exclude_cbt=self.exclude_cbt))
+        # the parser state of a long follow grows the most without a horizon
+        checkpoint.torctl_parser.state_horizon = state_horizon
+
+        for (filepaths, parser, json_db_key, parse_args) in [(self.tgen_filepaths, checkpoint.tgen_parser, 'tgen', {'do_complete': True}),
+                                                             (self.torctl_filepaths, checkpoint.torctl_parser, 'tor', {})]:
             if len(filepaths) > 0:
                 for filepath in filepaths:
-                    logging.info("parsing log file at {0}".format(filepath))
-                    parser.parse(util.DataSource(filepath))
-
-                if self.nickname is None:
-                    parsed_name = parser.get_name()
-                    if parsed_name is not None:
-                        self.nickname = parsed_name
-                    elif self.hostname is not None:
-                        self.nickname = self.hostname
-                    else:
-                        self.nickname = "unknown"
-
-                if self.measurement_ip is None:
-                    self.measurement_ip = "unknown"
-
-                self.json_db['data'].setdefault(self.nickname, {'measurement_ip': self.measurement_ip}).setdefault(json_db_key, parser.get_data())
-        self.json_db['data'][self.nickname]["tgen"].pop("heartbeats")
+                    offset = start_offset = checkpoint.offsets.get(filepath, 0)
+                    logging.info("parsing log file at {0} from offset {1}".format(filepath, offset))
+                    with profiling.phase(self.profiler, "{0}.parse".format(json_db_key), file=filepath, offset=offset) as record:
+                        while True:
+                            source = util.TailSource(filepath, offset)
+                            parser.parse(source, **parse_args)
+                            if source.offset == offset:
+                                break
+                            offset = source.offset
+                        record.update(bytes=offset - start_offset, file_bytes=os.path.getsize(filepath))
+                    checkpoint.set_offset(filepath, offset)
+
+        checkpoint.torctl_parser.country_lookup = None
+        checkpoint.save(checkpoint_filename)
+        checkpoint.torctl_parser.country_lookup = self.country_lookup
+        for (filepaths, parser, json_db_key) in [(self.tgen_filepaths, checkpoint.tgen_parser, 'tgen'),
+                                                 (self.torctl_filepaths, checkpoint.torctl_parser, 'tor')]:
+            if len(filepaths) > 0:
+                self.__add_parser_data(parser.get_name(), parser.get_data(), json_db_key)
+        self.__finish_analysis(checkpoint.torctl_parser)
+
+    def __add_parser_data(self, parsed_name, data, json_db_key):
+        if self.nickname is None:
+            if parsed_name is not None:
+                self.nickname = parsed_name
+            elif self.hostname is not None:
+                self.nickname = self.hostname
+            else:
+                self.nickname = "unknown"
+
+        if self.measurement_ip is None:
+            self.measurement_ip = "unknown"
+
+        self.json_db['data'].setdefault(self.nickname, {'measurement_ip': self.measurement_ip}).setdefault(json_db_key, data)
+
+    def __finish_analysis(self, torctl_parser):
+        for event_type, counts in sorted(torctl_parser.get_event_counts().items()):
+            logging.info("torctl {0} events: {1} read, {2} skipped, {3} handled, {4} failed".format(event_type, counts['read'], counts['skipped'], counts['handled'], counts['failed']))
+        parse_errors, parse_error_samples = torctl_parser.get_parse_errors()
+        if parse_errors > 0:
+            logging.warning("{0} torctl lines failed to parse, the first one being: {1}".format(parse_errors, parse_error_samples[0]['line']))
+        state_stats = torctl_parser.get_state_stats()
+        logging.info("torctl parser held at most {0} open circuits and {1} open streams, and evicted {2} circuits and {3} streams".format(
+            state_stats['peak_circuits_state'], state_stats['peak_streams_state'], state_stats['evicted_circuits'], state_stats['evicted_streams']))
+        if self.profiler is not None:
+            self.profiler.add_parse_errors('torctl', parse_errors, parse_error_samples)
+            self.profiler.add_stats('torctl', state_stats)
         self.json_db['data'][self.nickname]["tgen"].pop("init_ts")
-        self.json_db['data'][self.nickname]["tgen"].pop("stream_summary")
+        # percentile summaries that can be merged across analyses without their transfers
+        with profiling.phase(self.profiler, "sketches"):
+            self.json_db['data'][self.nickname]['sketches'] = sketches.build_hourly_sketches(self.json_db['data'][self.nickname]["tgen"])
         self.did_analysis = True
 
-    def save(self, filename=None, output_prefix=os.getcwd(), do_compress=True, date_prefix=None, sort_keys=True):
+    def analyze_by_day(self, exclude_cbt=False, build_index=False, torctl_workers=1, state_horizon=None):
+        '''
+        Analyzes every UTC date covered by the added log files while reading
+        each log only once, and returns a dict of date -> OPAnalysis whose
+        results match those of calling analyze(date_filter=date) for each date.
+        Each batch of lines is handed to a parser for its date, which also gets
+        the head lines of every log, as a date-filtered parse would read them.
+        With build_index, the logs that lack a sidecar time index get one, so
+        that later analyses filtered by date can skip to their dates, and with
+        torctl_workers > 1 the torctl parsers of different dates run in that
+        many worker processes.
+        '''
+        if build_index:
+            for filepath in self.tgen_filepaths + self.torctl_filepaths:
+                if util.LogIndex.load(filepath) is None:
+                    logging.info("building time index for log file at {0}".format(filepath))
+                    util.LogIndex.build(filepath).save()
+        kinds = []
+        if len(self.tgen_filepaths) > 0:
+            kinds.append(('tgen', self.tgen_filepaths, None, {'do_complete': True}, 1,
+                          lambda date: TGenStreamParser(date_filter=date)))
+        if len(self.torctl_filepaths) > 0:
+            kinds.append(('tor', self.torctl_filepaths, '\r\n', {}, torctl_workers,
+                          lambda date: TorCtlParser(date_filter=date, exclude_cbt=exclude_cbt, state_horizon=state_horizon)))
+        parsers, heads = {}, {}
+        for (json_db_key, filepaths, newline, parse_args, num_workers, make_parser) in kinds:
+            (parsers[json_db_key], heads[json_db_key]) = _parse_log_files_by_day(make_parser, json_db_key, filepaths, newline, parse_args,
+                                                                                 self.profiler, num_workers=num_workers)
+        dates = set()
+        for day_parsers in parsers.values():
+            dates.update(day_parsers.keys())
+        # a date that only one kind of log covers still gets a parser of the
+        # other kind that only read the head lines
+        for (json_db_key, _, _, parse_args, _, make_parser) in kinds:
+            for date in dates - set(parsers[json_db_key].keys()):
+                parser = parsers[json_db_key][date] = make_parser(date)
+                for head in heads[json_db_key]:
+                    parser.parse(_get_head_lines(head, date), **parse_args)
+
+        analyses = {}
+        for date in sorted(dates):
+            logging.info("analyzing logs for {0}".format(util.date_to_string(date)))
+            analysis = OPAnalysis(self.nickname, self.measurement_ip)
+            analysis.set_country_lookup(self.country_lookup)
+            analysis.set_profiler(self.profiler)
+            if 'tgen' in parsers:
+                analysis.add_tgen_parser(parsers['tgen'].pop(date))
+            if 'tor' in parsers:
+                analysis.add_torctl_parser(parsers['tor'].pop(date))
+            analysis.analyze(date_filter=date, exclude_cbt=exclude_cbt)
+            analyses[date] = analysis
+        return analyses
+
+    @staticmethod
+    def get_output_path(output_prefix=os.getcwd(), filename=None, do_compress=True, date=None, codec='xz'):
+        ''' returns the path that save writes an analysis of the given date to '''
+        codec = util.get_codec(codec if do_compress else 'plain')
         if filename is None:
-            base_filename = "onionperf.analysis.json.xz"
-            if date_prefix is not None:
-                filename = "{0}.{1}".format(util.date_to_string(date_prefix), base_filename)
-            elif self.date_filter is not None:
-                filename = "{0}.{1}".format(util.date_to_string(self.date_filter), base_filename)
+            base_filename = "onionperf.analysis.json" + codec.extension
+            if date is not None:
+                filename = "{0}.{1}".format(util.date_to_string(date), base_filename)
             else:
                 filename = base_filename
+        return os.path.abspath(os.path.expanduser("{0}/{1}".format(output_prefix, filename)))
 
-        filepath = os.path.abspath(os.path.expanduser("{0}/{1}".format(output_prefix, filename)))
+    def save(self, filename=None, output_prefix=os.getcwd(), do_compress=True, date_prefix=None, sort_keys=True,
+             indent=2, codec='xz', level=None, threads=1):
+        codec = util.get_codec(codec if do_compress else 'plain')
+        filepath = OPAnalysis.get_output_path(output_prefix, filename, do_compress,
+                                              date_prefix if date_prefix is not None else self.date_filter, codec.name)
         if not os.path.exists(output_prefix):
             os.makedirs(output_prefix)
 
+        # a partially loaded analysis is saved with everything it was loaded from
+        self.load_sections(set(name for (_, name) in self.skipped_sections))
+
         logging.info("saving analysis results to {0}".format(filepath))
 
-        outf = util.FileWritable(filepath, do_compress=do_compress)
-        json.dump(self.json_db, outf, sort_keys=sort_keys, separators=(',', ': '), indent=2)
-        outf.close()
+        with profiling.phase(self.profiler, "save", file=filepath, codec=codec.name) as record:
+            outf = util.FileWritable(filepath, do_truncate=True, codec=codec.name, level=level, threads=threads)
+            if self.profiler is not None:
+                outf = profiling.TimedWritable(outf)
+            if indent is not None:
+                json.dump(self.json_db, outf, sort_keys=sort_keys, separators=(',', ': '), indent=indent)
+            else:
+                # without indentation, encode one section at a time with the fastest available encoder
+                chunks, size = [], 0
+                for chunk in util.iter_json_sections(self.json_db, util.get_json_encoder(sort_keys), sort_keys=sort_keys):
+                    chunks.append(chunk)
+                    size += len(chunk)
+                    if size >= 1 << 20:
+                        outf.write(''.join(chunks))
+                        chunks, size = [], 0
+                outf.write(''.join(chunks))
+            outf.close()
+            if self.profiler is not None:
+                # the rest of the time in this phase is spent encoding
+                record.update(compress_seconds=outf.write_seconds, file_bytes=os.path.getsize(filepath))
 
         logging.info("done!")
+        return filepath
 
 
     def get_tgen_streams(self, node):
-        try:
-            return self.json_db['data'][node]['tgen']['streams']
-        except:
-            return None
+        return self.__get_section(node, 'tgen.streams')
 
     def get_tgen_transfers(self, node):
-        try:
-            return self.json_db['data'][node]['tgen']['transfers']
-        except:
-            return None
+        return self.__get_section(node, 'tgen.transfers')
 
     def get_tor_guards(self, node):
-        try:
-            return self.json_db['data'][node]['tor']['guards']
-        except:
-            return None
+        return self.__get_section(node, 'tor.guards')
 
     def get_tor_circuits(self, node):
-        try:
-            return self.json_db['data'][node]['tor']['circuits']
-        except:
-            return None
+        return self.__get_section(node, 'tor.circuits')
 
     def set_tor_circuits(self, node, tor_circuits):
+        self.skipped_sections.discard((node, 'tor.circuits'))
         self.json_db['data'][node]['tor']['circuits'] = tor_circuits
 
     def get_tor_streams(self, node):
+        return self.__get_section(node, 'tor.streams')
+
+    def get_sketches(self, node):
+        ''' returns the hourly quantile sketches of node, or None for analyses before version 3.2 '''
+        if (node, 'sketches.hours') in self.skipped_sections:
+            self.load_sections(['sketches.hours'])
         try:
-            return self.json_db['data'][node]['tor']['streams']
+            return self.json_db['data'][node]['sketches']
         except:
             return None
 
+    def __get_section(self, node, name):
+        if (node, name) in self.skipped_sections:
+            self.load_sections([name])
+        try:
+            (parent, child) = name.split('.')
+            return self.json_db['data'][node][parent][child]
+        except:
+            return None
+
+    def load_sections(self, sections):
+        '''
+        Loads the sections, such as "tor.circuits", that load skipped, for all
+        nodes, by reading the analysis file again.
+        '''
+        missing = set((node, name) for (node, name) in self.skipped_sections if name in sections)
+        if len(missing) == 0:
+            return
+        logging.info("loading sections {0} from {1}".format(', '.join(sorted(set(name for (_, name) in missing))), self.filepath))
+        db, _ = load_json_sections(OPAnalysis.__read_text(self.filepath), sections)
+        for (node, name) in missing:
+            (parent, child) = name.split('.')
+            self.json_db['data'][node].setdefault(parent, {})[child] = db['data'][node][parent][child]
+        self.skipped_sections.difference_update(missing)
+
+    @staticmethod
+    def __read_text(filepath):
+        inf = util.DataSource(filepath)
+        inf.open()
+        text = inf.get_file_handle().read()
+        inf.close()
+        return text
+
     @classmethod
-    def load(cls, filename="onionperf.analysis.json.xz", input_prefix=os.getcwd()):
+    def load(cls, filename="onionperf.analysis.json.xz", input_prefix=os.getcwd(), sections=None, cache=None):
+        '''
+        Loads an analysis results file. If sections is given, only the per-node
+        sections it names, such as "tgen.transfers" or "tor.circuits", are
+        decoded; the other sections are skipped and loaded on first use by the
+        get_* accessors. Everything outside the nodes' sections, such as the
+        filters, is always loaded. If an AnalysisCache is given, the analysis
+        is taken from it when possible, and added to it after a full load.
+        '''
         filepath = os.path.abspath(os.path.expanduser("{0}".format(filename)))
         if not os.path.exists(filepath):
             filepath = os.path.abspath(os.path.expanduser("{0}/{1}".format(input_prefix, filename)))
@@ -133,10 +492,19 @@ class OPAnalysis(Analysis):
 
         logging.info("loading analysis results from {0}".format(filepath))
 
-        inf = util.DataSource(filepath)
-        inf.open()
-        db = json.load(inf.get_file_handle())
-        inf.close()
+        skipped_sections = set()
+        db = cache.get(filepath) if cache is not None else None
+        if db is not None:
+            logging.info("using the cached copy of the analysis results")
+        elif sections is None:
+            inf = util.DataSource(filepath)
+            inf.open()
+            db = json.load(inf.get_file_handle())
+            inf.close()
+            if cache is not None:
+                cache.put(filepath, db)
+        else:
+            db, skipped_sections = load_json_sections(OPAnalysis.__read_text(filepath), sections)
 
         logging.info("done!")
 
@@ -149,8 +517,343 @@ class OPAnalysis(Analysis):
         else:
             analysis_instance = cls()
             analysis_instance.json_db = db
+            analysis_instance.filepath = filepath
+            analysis_instance.skipped_sections = skipped_sections
             return analysis_instance
 
+def find_analysis_files(dirpath):
+    '''
+    Returns the sorted paths of the analysis files that OPAnalysis.save writes,
+    with or without a date and in any codec, in dirpath and its subdirectories,
+    leaving out other files like their AnalysisCache entries.
+    '''
+    paths = set()
+    for codec in util.COMPRESSION_CODECS.values():
+        pattern = os.path.join(glob.escape(dirpath), "**", "*onionperf.analysis.json" + codec.extension)
+        paths.update(glob.glob(pattern, recursive=True))
+    return sorted(paths)
+
+_JSON_WHITESPACE = re.compile(r'[ \t\n\r]*')
+_JSON_INDENT = re.compile(r'[ \t]*')
+
+def _skip_json_whitespace(text, pos):
+    return _JSON_WHITESPACE.match(text, pos).end()
+
+def _expect_json(text, pos, expected):
+    if not text.startswith(expected, pos):
+        raise json.JSONDecodeError("Expecting '{0}'".format(expected), text, pos)
+    return pos + len(expected)
+
+def _skip_json_value(text, pos, decoder):
+    ''' returns the position after the JSON value starting at text[pos], if possible without decoding it '''
+    if text[pos] in '{[' and text.startswith('\n', pos + 1):
+        # json.dump with an indent puts the closing bracket on a line of its
+        # own, indented like the line the value starts on, and strings never
+        # contain raw newlines, so the end of the value can simply be searched
+        line_start = text.rfind('\n', 0, pos) + 1
+        indent = text[line_start:_JSON_INDENT.match(text, line_start).end()]
+        closing = '\n' + indent + ('}' if text[pos] == '{' else ']')
+        end = text.find(closing, pos)
+        if end < 0:
+            raise json.JSONDecodeError("Unterminated value", text, pos)
+        return end + len(closing)
+    # compact JSON has no such landmarks, decode the value and drop it
+    return decoder.raw_decode(text, pos)[1]
+
+def _decode_json_object(text, pos, decode_value):
+    ''' decodes the object at text[pos], using decode_value(key, pos) -> (value, end) for its members '''
+    obj = {}
+    pos = _skip_json_whitespace(text, _expect_json(text, pos, '{'))
+    if text.startswith('}', pos):
+        return obj, pos + 1
+    while True:
+        key, pos = json.decoder.scanstring(text, _expect_json(text, pos, '"'))
+        pos = _skip_json_whitespace(text, _expect_json(text, _skip_json_whitespace(text, pos), ':'))
+        value, pos = decode_value(key, pos)
+        if value is not _SKIPPED:
+            obj[key] = value
+        pos = _skip_json_whitespace(text, pos)
+        if text.startswith('}', pos):
+            return obj, pos + 1
+        pos = _skip_json_whitespace(text, _expect_json(text, pos, ','))
+
+_SKIPPED = object()
+
+def load_json_sections(text, sections):
+    '''
+    Decodes the analysis results document in text, except for the sections of
+    each node (data/<node>/<parent>/<child>, named "<parent>.<child>") that
+    are not in sections, which are skipped without building objects for them
+    where the document is indented. Returns the document and the set of
+    (node, section name) that were skipped.
+    '''
+    decoder = json.JSONDecoder()
+    skipped = set()
+
+    def decode(key, pos):
+        return decoder.raw_decode(text, pos)
+
+    def decode_node(node, pos):
+        if not text.startswith('{', pos):
+            return decode(node, pos)
+        def decode_parent(parent, pos):
+            if not text.startswith('{', pos):
+                return decode(parent, pos)
+            def decode_section(child, pos):
+                name = "{0}.{1}".format(parent, child)
+                if name in sections or text[pos] not in '{[':
+                    return decode(child, pos)
+                skipped.add((node, name))
+                return _SKIPPED, _skip_json_value(text, pos, decoder)
+            return _decode_json_object(text, pos, decode_section)
+        return _decode_json_object(text, pos, decode_parent)
+
+    def decode_top(key, pos):
+        if key == 'data' and text.startswith('{', pos):
+            return _decode_json_object(text, pos, decode_node)
+        return decode(key, pos)
+
+    db, _ = _decode_json_object(text, _skip_json_whitespace(text, 0), decode_top)
+    return db, skipped
+
+class TorCtlLiveSink(object):
+    '''
+    Collects the events a TorMonitor receives in a TorCtlParser while they
+    arrive, so that the torctl log does not have to be parsed again to
+    analyze it. TorMonitor calls log from stem's event thread, while rotate
+    is called from the log rotation thread.
+    '''
+    def __init__(self, exclude_cbt=False):
+        self.exclude_cbt = exclude_cbt
+        self.parser = TorCtlParser(exclude_cbt=exclude_cbt)
+        self.lock = threading.Lock()
+
+    def log(self, writable, line, event=None):
+        '''
+        Writes a line to the torctl log and handles it, as a status line or as
+        the given event that it logs, in one step with respect to rotate, so
+        that the line ends up in the same day's log file and parser.
+        '''
+        with self.lock:
+            writable.write(line)
+            if event is None:
+                self.parser.parse([line])
+            else:
+                # use the timestamp exactly as logged, so that the live analysis
+                # matches what parsing the log file would give
+                self.parser.parse_event(event, float(line.split(' ', 3)[2]))
+
+    def rotate(self, writable=None, filename_datetime=None):
+        '''
+        Returns the parser holding everything received since the last rotation
+        and starts a new one, like rotating the torctl log and parsing the
+        rotated file would. If writable is given, it is the torctl log, which
+        is rotated to filename_datetime in the same step, so that each line
+        that log wrote is both in the rotated file and in the returned parser
+        or in neither.
+        '''
+        with self.lock:
+            if writable is not None:
+                writable.rotate_file(filename_datetime=filename_datetime)
+            parser, self.parser = self.parser, TorCtlParser(exclude_cbt=self.exclude_cbt)
+        return parser
+
+class AnalysisCheckpoint(object):
+    '''
+    The state of the tgen and torctl parsers after parsing a set of growing log
+    files up to the stored byte offsets, including the open circuits, streams,
+    guards and CBT state of the TorCtlParser. The first bytes of each file are
+    kept to detect when a file was replaced, e.g. by log rotation.
+    '''
+    VERSION = 6
+    HEAD_BYTES = 4096
+
+    def __init__(self, tgen_parser, torctl_parser):
+        self.tgen_parser = tgen_parser
+        self.torctl_parser = torctl_parser
+        self.offsets = {}
+        self.heads = {}
+
+    def set_offset(self, filepath, offset):
+        self.offsets[filepath] = offset
+        with open(filepath, 'rb') as f:
+            self.heads[filepath] = f.read(min(offset, AnalysisCheckpoint.HEAD_BYTES))
+
+    def is_valid(self, filepaths):
+        for filepath in filepaths:
+            if filepath not in self.offsets:
+                continue
+            if not os.path.exists(filepath) or os.path.getsize(filepath) < self.offsets[filepath]:
+                logging.info("log file at {0} was truncated, not resuming from checkpoint".format(filepath))
+                return False
+            with open(filepath, 'rb') as f:
+                if f.read(len(self.heads[filepath])) != self.heads[filepath]:
+                    logging.info("log file at {0} was replaced, not resuming from checkpoint".format(filepath))
+                    return False
+        return True
+
+    @classmethod
+    def load(cls, filename):
+        if not os.path.exists(filename):
+            return None
+        try:
+            with open(filename, 'rb') as f:
+                version, checkpoint = pickle.load(f)
+        except Exception as e:
+            logging.warning("ignoring unreadable checkpoint at {0}: {1}".format(filename, repr(e)))
+            return None
+        return checkpoint if version == cls.VERSION else None
+
+    def save(self, filename):
+        tmp_path = "{0}.{1}.tmp".format(filename, os.getpid())
+        with open(tmp_path, 'wb') as f:
+            pickle.dump((AnalysisCheckpoint.VERSION, self), f, protocol=pickle.HIGHEST_PROTOCOL)
+        # replace atomically, so that a crash never leaves a partial checkpoint behind
+        os.replace(tmp_path, filename)
+
+class AnalysisCache(object):
+    '''
+    Pickled copies of loaded analysis results, which load several times
+    faster than decompressing and decoding the JSON again. An entry is only
+    used if the size and mtime of its analysis file and the cache format
+    VERSION match. Entries are kept in cache_dir, or next to each analysis
+    file if cache_dir is None, and the least recently used entries in a
+    directory are removed once the entries there exceed max_bytes.
+    '''
+    VERSION = 1
+    SUFFIX = ".cache.pickle"
+
+    def __init__(self, cache_dir=None, max_bytes=2 << 30):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+
+    def get_entry_path(self, filepath):
+        if self.cache_dir is None:
+            return filepath + AnalysisCache.SUFFIX
+        name = hashlib.sha256(os.path.abspath(filepath).encode('utf-8')).hexdigest()[:32]
+        return os.path.join(self.cache_dir, name + AnalysisCache.SUFFIX)
+
+    def get(self, filepath):
+        ''' returns the cached json_db of the analysis file at filepath, or None '''
+        entry_path = self.get_entry_path(filepath)
+        if not os.path.exists(entry_path):
+            return None
+        try:
+            stat_result = os.stat(filepath)
+            with open(entry_path, 'rb') as f:
+                if pickle.load(f) != (AnalysisCache.VERSION, stat_result.st_size, stat_result.st_mtime):
+                    return None
+                # the cyclic garbage collector would run many times while
+                # creating so many objects, although none of them are garbage
+                gc_enabled = gc.isenabled()
+                gc.disable()
+                try:
+                    db = pickle.load(f)
+                finally:
+                    if gc_enabled:
+                        gc.enable()
+            # the entry's mtime records when it was last used
+            os.utime(entry_path)
+        except Exception as e:
+            logging.warning("ignoring unreadable analysis cache entry at {0}: {1}".format(entry_path, repr(e)))
+            return None
+        return db
+
+    def put(self, filepath, db):
+        entry_path = self.get_entry_path(filepath)
+        tmp_path = "{0}.{1}.tmp".format(entry_path, os.getpid())
+        try:
+            if not os.path.exists(os.path.dirname(entry_path)):
+                os.makedirs(os.path.dirname(entry_path))
+            stat_result = os.stat(filepath)
+            with open(tmp_path, 'wb') as f:
+                pickle.dump((AnalysisCache.VERSION, stat_result.st_size, stat_result.st_mtime), f, protocol=pickle.HIGHEST_PROTOCOL)
+                pickle.dump(db, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, entry_path)
+        except OSError as e:
+            logging.warning("unable to cache analysis at {0}: {1}".format(entry_path, repr(e)))
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            return
+        self.evict(os.path.dirname(entry_path), keep=entry_path)
+
+    def evict(self, directory, keep=None):
+        ''' removes the least recently used entries in directory until they fit into max_bytes '''
+        entries = []
+        for name in os.listdir(directory):
+            if name.endswith(AnalysisCache.SUFFIX):
+                stat_result = os.stat(os.path.join(directory, name))
+                entries.append((stat_result.st_mtime, stat_result.st_size, os.path.join(directory, name)))
+        total = sum(size for (_, size, _) in entries)
+        for (_, size, entry_path) in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            if entry_path != keep:
+                logging.info("evicting analysis cache entry {0}".format(entry_path))
+                os.remove(entry_path)
+                total -= size
+
+class TGenStreamParser(TGenParser):
+    '''
+    A TGenParser that only builds the streams of a TGen log. The heartbeats
+    and stream summaries that TGenParser also collects hold a list per second
+    of the log, which OPAnalysis dropped again right after parsing, so this
+    parser skips those lines and leaves them out of get_data.
+    '''
+
+    def parse(self, source, do_complete=False):
+        # source may also be a plain list of lines, like for TorCtlParser
+        if not isinstance(source, list):
+            source.open()
+        for line in source:
+            if self.version_mismatch:
+                break
+            try:
+                self.__parse_line(line, do_complete)
+            except Exception:
+                logging.warning("TGenParser: skipping line due to parsing error: {}".format(line))
+        if not isinstance(source, list):
+            source.close()
+
+    def __parse_line(self, line, do_complete):
+        # the same steps as TGenParser, but with substring tests in place of
+        # regular expressions, and only for the lines that make up streams
+        if self.name is None and TGEN_INIT_LINE.search(line) is not None:
+            parts = line.strip().split()
+            if len(parts) < 9:
+                return
+            self.unix_ts_init = int(util.timestamp_to_seconds(parts[2]))
+            version_str = parts[8].strip('v')
+            if version_str != tgentools_version:
+                self.version_mismatch = True
+                logging.warning("Version mismatch: the log file we are parsing was generated using "
+                                "tgen v{}, but this version of tgentools is v{}".format(version_str, tgentools_version))
+                return
+            if len(parts) < 18:
+                return
+            self.name = parts[17]
+
+        if self.date_filter is not None:
+            parts = line.strip().split(' ', 3)
+            if len(parts) < 4:
+                return
+            line_date = datetime.datetime.utcfromtimestamp(float(parts[2])).date()
+            if not util.do_dates_match(self.date_filter, line_date):
+                return
+        if not do_complete:
+            return
+        if "stream-status" in line:
+            status = StreamStatusEvent(line)
+            self.state.setdefault(status.stream_id, Stream(status.stream_id)).add_event(status)
+        elif "stream-success" in line or "stream-error" in line:
+            complete = StreamSuccessEvent(line) if "stream-success" in line else StreamErrorEvent(line)
+            stream = self.state.pop(complete.stream_id, None) or Stream(complete.stream_id)
+            stream.add_event(complete)
+            self.streams[stream.id] = stream.get_data()
+
+    def get_data(self):
+        return {'init_ts': self.unix_ts_init, 'streams': self.streams}
+
 class Parser(object, metaclass=ABCMeta):
     @abstractmethod
     def parse(self, source):
@@ -164,6 +867,11 @@ class Parser(object, metaclass=ABCMeta):
 
 
 class TorStream(object):
+    # slots and interned event keys keep the many streams of a long log small;
+    # get_data converts a stream to its JSON shape only when asked for it
+    __slots__ = ('stream_id', 'circuit_id', 'unix_ts_start', 'unix_ts_end', 'failure_reason_local',
+                 'failure_reason_remote', 'source', 'target', 'last_purpose', 'event_keys', 'event_times')
+
     def __init__(self, sid):
         self.stream_id = sid
         self.circuit_id = None
@@ -173,14 +881,16 @@ class TorStream(object):
         self.failure_reason_remote = None
         self.source = None
         self.target = None
-        self.elapsed_seconds = []
         self.last_purpose = None
+        self.event_keys = []
+        self.event_times = array('d')
 
     def add_event(self, purpose, status, arrived_at):
         if purpose is not None:
             self.last_purpose = purpose
         key = "{0}:{1}".format(self.last_purpose, status)
-        self.elapsed_seconds.append([key, arrived_at])
+        self.event_keys.append(sys.intern(key))
+        self.event_times.append(arrived_at)
 
     def set_circ_id(self, circ_id):
         if circ_id is not None:
@@ -205,25 +915,36 @@ class TorStream(object):
     def set_source(self, source):
         self.source = source
 
+    def is_complete(self):
+        return self.unix_ts_start is not None and self.unix_ts_end is not None
+
+    def freeze(self):
+        # no more events arrive after a record completed, so drop the spare capacity
+        self.event_keys = tuple(self.event_keys)
+        self.event_times = array('d', self.event_times)
+
     def get_data(self):
-        if self.unix_ts_start is None or self.unix_ts_end is None:
+        if not self.is_complete():
             return None
-        d = self.__dict__
-        for item in d['elapsed_seconds']:
-            item[1] = item[1] - self.unix_ts_start
-        del(d['last_purpose'])
-        if d['failure_reason_local'] is None: del(d['failure_reason_local'])
-        if d['failure_reason_remote'] is None: del(d['failure_reason_remote'])
-        if d['source'] is None: del(d['source'])
-        if d['target'] is None: del(d['target'])
+        d = {'stream_id': self.stream_id, 'circuit_id': self.circuit_id,
+             'unix_ts_start': self.unix_ts_start, 'unix_ts_end': self.unix_ts_end,
+             'elapsed_seconds': [[key, arrived_at - self.unix_ts_start] for (key, arrived_at) in zip(self.event_keys, self.event_times)]}
+        for name in ('failure_reason_local', 'failure_reason_remote', 'source', 'target'):
+            if getattr(self, name) is not None:
+                d[name] = getattr(self, name)
         return d
 
     def __str__(self):
-        return('stream id=%d circ_id=%s %s' % (self.id, self.circ_id,
+        return('stream id=%d circ_id=%s %s' % (self.stream_id, self.circuit_id,
                ' '.join(['%s=%s' % (event, arrived_at)
-               for (event, arrived_at) in sorted(self.elapsed_seconds, key=lambda item: item[1])])))
+               for (event, arrived_at) in sorted(zip(self.event_keys, self.event_times), key=lambda item: item[1])])))
 
 class TorCircuit(object):
+    # see TorStream
+    __slots__ = ('circuit_id', 'unix_ts_start', 'unix_ts_end', 'failure_reason_local', 'failure_reason_remote',
+                 'buildtime_seconds', 'build_timeout', 'build_quantile', 'cbt_set', 'current_guards', 'filtered_out',
+                 'event_keys', 'event_times', 'path_hops', 'path_times')
+
     def __init__(self, cid):
         self.circuit_id = cid
         self.unix_ts_start = None
@@ -235,18 +956,23 @@ class TorCircuit(object):
         self.build_quantile = None
         self.cbt_set = False
         self.current_guards = None
-        self.elapsed_seconds = []
-        self.path = []
+        self.filtered_out = None
+        self.event_keys = []
+        self.event_times = array('d')
+        self.path_hops = []
+        self.path_times = array('d')
 
     def add_event(self, event, arrived_at):
-        self.elapsed_seconds.append([str(event), arrived_at])
+        self.event_keys.append(sys.intern(str(event)))
+        self.event_times.append(arrived_at)
 
     def add_current_guards(self, guards):
-        g = [guard.get_data() for guard in guards]
-        self.current_guards = g
+        # copies, because the guards can still change after the circuit closed
+        self.current_guards = [copy.copy(guard) for guard in guards]
 
     def add_hop(self, hop, arrived_at):
-        self.path.append(["${0}~{1}".format(hop[0], hop[1]), arrived_at])
+        self.path_hops.append(sys.intern("${0}~{1}".format(hop[0], hop[1])))
+        self.path_times.append(arrived_at)
 
     def set_launched(self, unix_ts, build_timeout, build_quantile, cbt_set):
         if self.unix_ts_start is None:
@@ -268,28 +994,41 @@ class TorCircuit(object):
         if self.buildtime_seconds is None:
             self.buildtime_seconds = unix_ts
 
+    def is_complete(self):
+        return self.unix_ts_start is not None and self.unix_ts_end is not None
+
+    def freeze(self):
+        # no more events arrive after a record completed, so drop the spare capacity
+        self.event_keys = tuple(self.event_keys)
+        self.event_times = array('d', self.event_times)
+        self.path_hops = tuple(self.path_hops)
+        self.path_times = array('d', self.path_times)
+
     def get_data(self):
-        if self.unix_ts_start is None or self.unix_ts_end is None:
+        if not self.is_complete():
             return None
-        d = self.__dict__
-        for item in d['elapsed_seconds']:
-            item[1] = item[1] - self.unix_ts_start
-        for item in d['path']:
-            item[1] = item[1] - self.unix_ts_start
-        if d['buildtime_seconds'] is None:
-            del(d['buildtime_seconds'])
-        else:
+        d = {'circuit_id': self.circuit_id, 'unix_ts_start': self.unix_ts_start, 'unix_ts_end': self.unix_ts_end,
+             'failure_reason_local': self.failure_reason_local, 'failure_reason_remote': self.failure_reason_remote,
+             'build_timeout': self.build_timeout, 'build_quantile': self.build_quantile, 'cbt_set': self.cbt_set,
+             'filtered_out': self.filtered_out,
+             'elapsed_seconds': [[key, arrived_at - self.unix_ts_start] for (key, arrived_at) in zip(self.event_keys, self.event_times)]}
+        if self.buildtime_seconds is not None:
             d['buildtime_seconds'] = self.buildtime_seconds - self.unix_ts_start
-        if len(d['path']) == 0: del(d['path'])
+        if len(self.path_hops) > 0:
+            d['path'] = [[hop, arrived_at - self.unix_ts_start] for (hop, arrived_at) in zip(self.path_hops, self.path_times)]
+        if self.current_guards is not None:
+            d['current_guards'] = [guard.get_data() for guard in self.current_guards]
         d = {k: v for k, v in d.items() if v is not None}
         return d
 
     def __str__(self):
-        return('circuit id=%d %s' % (self.id, ' '.join(['%s=%s' %
+        return('circuit id=%d %s' % (self.circuit_id, ' '.join(['%s=%s' %
                (event, arrived_at) for (event, arrived_at) in
-               sorted(self.elapsed_seconds, key=lambda item: item[1])])))
+               sorted(zip(self.event_keys, self.event_times), key=lambda item: item[1])])))
 
 class TorGuard(object):
+    __slots__ = ('fingerprint', 'nickname', 'country', 'new_ts', 'up_ts', 'down_ts', 'dropped_ts')
+
     def __init__(self, fingerprint, nickname, country=None):
         self.fingerprint = fingerprint
         self.nickname = nickname
@@ -300,19 +1039,243 @@ class TorGuard(object):
         self.dropped_ts = None
 
     def get_data(self):
-        d = self.__dict__
+        d = {name: getattr(self, name) for name in TorGuard.__slots__}
         d = {k: v for k, v in d.items() if v is not None}
         return d
 
+class TorGuardRegistry(object):
+    '''
+    Keeps the guards seen so far, indexed by fingerprint and by the
+    [up_ts, dropped_ts) intervals in which they were up, so that neither
+    guard events nor closing circuits have to scan all guards ever seen.
+    '''
+    def __init__(self):
+        self.guards = []
+        # fingerprint -> position in guards of the latest guard with that fingerprint
+        self.latest = {}
+        # fingerprint -> position of the guards that are up and not dropped yet
+        self.up = {}
+        # positions of the guards that were up and then dropped, sorted by dropped_ts
+        self.dropped_ts = []
+        self.dropped = []
+
+    def get_latest(self, fingerprint):
+        i = self.latest.get(fingerprint)
+        return self.guards[i] if i is not None else None
+
+    def add(self, guard):
+        self.latest[guard.fingerprint] = len(self.guards)
+        self.guards.append(guard)
+
+    def set_up(self, guard, unix_ts):
+        # only the latest guard of a fingerprint can still change
+        guard.up_ts = unix_ts
+        self.up[guard.fingerprint] = self.latest[guard.fingerprint]
+
+    def set_dropped(self, guard, unix_ts):
+        guard.dropped_ts = unix_ts
+        i = self.up.pop(guard.fingerprint, None)
+        if i is not None:
+            pos = bisect.bisect_right(self.dropped_ts, unix_ts)
+            self.dropped_ts.insert(pos, unix_ts)
+            self.dropped.insert(pos, i)
+
+    def get_current(self, unix_ts):
+        '''
+        returns the guards that were up at unix_ts, in the order they were seen;
+        this takes O(log n) plus the number of guards dropped since unix_ts,
+        which is small for the recent launch times of closing circuits; a
+        unix_ts of None, like that of a circuit whose launch was not logged,
+        has no current guards
+        '''
+        if unix_ts is None:
+            return []
+        current = [i for i in self.up.values() if unix_ts >= self.guards[i].up_ts]
+        # dropped guards can only be current if they were dropped after unix_ts
+        for i in self.dropped[bisect.bisect_right(self.dropped_ts, unix_ts):]:
+            if unix_ts >= self.guards[i].up_ts:
+                current.append(i)
+        return [self.guards[i] for i in sorted(current)]
+
+# positional attribute names and keyword-to-attribute maps of the torctl
+# events that TorCtlParser consumes, using the same names as stem's events
+TORCTL_EVENT_ARGS = {
+    'CIRC': (('id', 'status', 'path'),
+             {'PURPOSE': 'purpose', 'HS_STATE': 'hs_state', 'REND_QUERY': 'rend_query',
+              'REASON': 'reason', 'REMOTE_REASON': 'remote_reason'}),
+    'CIRC_MINOR': (('id', 'event', 'path'),
+                   {'PURPOSE': 'purpose', 'HS_STATE': 'hs_state', 'REND_QUERY': 'rend_query',
+                    'OLD_PURPOSE': 'old_purpose'}),
+    'STREAM': (('id', 'status', 'circ_id', 'target'),
+               {'REASON': 'reason', 'REMOTE_REASON': 'remote_reason',
+                'SOURCE_ADDR': 'source_addr', 'PURPOSE': 'purpose'}),
+    'BUILDTIMEOUT_SET': (('set_type',),
+                         {'TIMEOUT_MS': 'timeout', 'CUTOFF_QUANTILE': 'quantile'}),
+    'GUARD': (('guard_type', 'endpoint', 'status'), {}),
+}
+
+TORCTL_KEYWORD_ARG = re.compile(r'^([A-Za-z0-9_]+)=(\S*)$')
+TORCTL_CIRC_ID = re.compile(r'^[a-zA-Z0-9]{1,16}$')
+TORCTL_PATH_ENTRY = re.compile(r'^\$([0-9a-fA-F]{40})[=~]([a-zA-Z0-9]{1,19})$')
+
+class TorCtlEvent(object):
+    ''' a lightweight stand-in for the stem events consumed by TorCtlParser '''
+    def __init__(self, event_type):
+        self.type = event_type
+
+    def get_attributes(self):
+        positional_names, keyword_names = TORCTL_EVENT_ARGS[self.type]
+        names = list(positional_names) + list(keyword_names.values())
+        if self.type == 'GUARD':
+            names += ['endpoint_fingerprint', 'endpoint_nickname']
+        return names
+
+TORCTL_EVENT_ATTRIBUTES = {event_type: TorCtlEvent(event_type).get_attributes() for event_type in TORCTL_EVENT_ARGS}
+
+def parse_torctl_path_entry(entry):
+    '''
+    Parses a relay in a circuit path or guard event, either "$fingerprint",
+    "nickname" or both joined by "=" or "~", into a (fingerprint, nickname)
+    tuple in which the part that is missing is None, like stem's private
+    stem.control._parse_circ_entry, which we do not want to depend on.
+    '''
+    if '=' in entry:
+        fingerprint, nickname = entry.split('=')
+    elif '~' in entry:
+        fingerprint, nickname = entry.split('~')
+    elif entry[0] == '$':
+        fingerprint, nickname = entry, None
+    else:
+        fingerprint, nickname = None, entry
+    if fingerprint is not None:
+        if not tor_tools.is_valid_fingerprint(fingerprint, True):
+            raise ProtocolError('Fingerprint in the circuit path is malformed ({0})'.format(fingerprint))
+        fingerprint = fingerprint[1:]
+    if nickname is not None and not tor_tools.is_valid_nickname(nickname):
+        raise ProtocolError('Nickname in the circuit path is malformed ({0})'.format(nickname))
+    return (fingerprint, nickname)
+
+def parse_torctl_path(path):
+    ''' parses a circuit path into (fingerprint, nickname) tuples like stem does '''
+    if not path:
+        return ()
+    hops = []
+    for entry in path.split(','):
+        match = TORCTL_PATH_ENTRY.match(entry)
+        # old-style entries take the slower way
+        hops.append(match.groups() if match is not None else parse_torctl_path_entry(entry))
+    return tuple(hops)
+
+def parse_torctl_event(content):
+    '''
+    Tokenizes the content of a torctl event line (without the leading "650")
+    into a TorCtlEvent, following the same rules as stem's event parsing.
+    Returns None for event types TorCtlParser does not consume and for
+    anything unusual, in which case the caller should fall back to stem.
+    '''
+    if '"' in content:
+        # quoted keyword values need stem's full parser
+        return None
+    tokens = content.split()
+    if len(tokens) == 0 or tokens[0] not in TORCTL_EVENT_ARGS:
+        return None
+
+    event = TorCtlEvent(tokens[0])
+    positional_names, keyword_names = TORCTL_EVENT_ARGS[event.type]
+
+    # stem strips keyword arguments from the right end of the line
+    keyword_args = {}
+    end = len(tokens)
+    while end > 1:
+        match = TORCTL_KEYWORD_ARG.match(tokens[end - 1]) if '=' in tokens[end - 1] else None
+        if match is None:
+            break
+        keyword_args[match.group(1)] = match.group(2)
+        end -= 1
+
+    positional_args = tokens[1:end]
+    for i, name in enumerate(positional_names):
+        setattr(event, name, positional_args[i] if i < len(positional_args) else None)
+    for keyword, name in keyword_names.items():
+        setattr(event, name, keyword_args.get(keyword))
+
+    try:
+        if event.type == 'CIRC' or event.type == 'CIRC_MINOR':
+            if event.id is None or TORCTL_CIRC_ID.match(event.id) is None:
+                return None
+            event.path = parse_torctl_path(event.path)
+        elif event.type == 'STREAM':
+            for address in (event.target, event.source_addr):
+                if address is None:
+                    continue
+                if ':' not in address or not connection.is_valid_port(address.rsplit(':', 1)[1], allow_zero=True):
+                    return None
+            if event.target is None:
+                return None
+            if event.circ_id == '0':
+                event.circ_id = None
+        elif event.type == 'BUILDTIMEOUT_SET':
+            if event.timeout is not None:
+                event.timeout = int(event.timeout)
+            if event.quantile is not None:
+                event.quantile = float(event.quantile)
+        elif event.type == 'GUARD':
+            event.endpoint_fingerprint, event.endpoint_nickname = parse_torctl_path_entry(event.endpoint)
+    except Exception:
+        return None
+
+    return event
+
+def get_torctl_event_record(event):
+    ''' returns the attributes that TorCtlParser uses from a parsed event as a compact, picklable tuple '''
+    return (event.type, tuple(getattr(event, name, None) for name in TORCTL_EVENT_ATTRIBUTES[event.type]))
+
+def get_torctl_event(record):
+    ''' turns a tuple returned by get_torctl_event_record back into a TorCtlEvent '''
+    event = TorCtlEvent(record[0])
+    event.__dict__.update(zip(TORCTL_EVENT_ATTRIBUTES[record[0]], record[1]))
+    return event
+
+# more chunks than workers keeps all workers busy when some chunks parse slower than others
+TORCTL_CHUNKS_PER_WORKER = 4
+
+def _parse_torctl_chunk(args):
+    filename, chunk, date_filter, fast_parse, verify_fast_parse = args
+    parser = TorCtlParser(date_filter=date_filter, fast_parse=fast_parse, verify_fast_parse=verify_fast_parse)
+    parser.deferred_events = []
+    lines = util.read_line_range(filename, chunk, newline='\r\n')
+    parser.parse(lines)
+    return (parser.name, parser.boot_succeeded, parser.event_counts, parser.fast_parse_mismatches, parser.deferred_events,
+            parser.parse_errors, parser.parse_error_samples, len(lines), sum(len(line) for line in lines))
+
 class TorCtlParser(Parser):
 
-    def __init__(self, date_filter=None, exclude_cbt=False):
-        ''' date_filter should be given in UTC '''
+    def __init__(self, date_filter=None, exclude_cbt=False, fast_parse=True, verify_fast_parse=False, num_workers=1, country_lookup=None,
+                 state_horizon=None):
+        '''
+        date_filter should be given in UTC
+
+        fast_parse tokenizes the consumed event types without stem, and
+        verify_fast_parse additionally parses each of those events with stem
+        and uses stem's result (logging a warning) whenever the two differ
+
+        num_workers > 1 parses chunks of uncompressed log files in that many
+        processes, while the parsed events are still handled in file order
+
+        country_lookup is the util.CountryLookup used to find the countries
+        of guards after parsing, by default one that asks onionoo
+
+        state_horizon is the number of seconds after which circuits and
+        streams that are still open but had no events are dropped and only
+        counted as evicted, or None, the default, to keep them until they close
+        '''
         self.circuits_state = {}
         self.circuits = {}
         self.streams_state = {}
         self.streams = {}
-        self.guards = []
+        self.guard_registry = TorGuardRegistry()
+        # all guards in the order they were seen, which is also their order in get_data
+        self.guards = self.guard_registry.guards
         self.name = None
         self.boot_succeeded = False
         self.build_timeout_last = None
@@ -320,17 +1283,38 @@ class TorCtlParser(Parser):
         self.cbt_set = False
         self.date_filter = date_filter
         self.exclude_cbt = exclude_cbt
+        self.fast_parse = fast_parse
+        self.verify_fast_parse = verify_fast_parse
+        self.fast_parse_mismatches = 0
+        self.event_counts = {}
+        # the number of lines that raised an error, and the first few of them
+        self.parse_errors = 0
+        self.parse_error_samples = []
+        self.current_event_type = None
+        self.num_workers = num_workers
+        self.country_lookup = country_lookup
+        # set by chunk workers, which only parse events and leave handling them to the main process
+        self.deferred_events = None
+        self.state_horizon = state_horizon
+        self.next_eviction_ts = None
+        self.evicted_circuits = 0
+        self.evicted_streams = 0
+        self.peak_circuits_state = 0
+        self.peak_streams_state = 0
 
     def __handle_circuit(self, event, arrival_dt):
         # first make sure we have a circuit object
         cid = int(event.id)
-        circ = self.circuits_state.setdefault(cid, TorCircuit(cid))
+        circ = self.circuits_state.get(cid)
+        if circ is None:
+            circ = self.circuits_state[cid] = TorCircuit(cid)
+            self.peak_circuits_state = max(self.peak_circuits_state, len(self.circuits_state))
         is_hs_circ = True if event.purpose in (CircPurpose.HS_CLIENT_INTRO, CircPurpose.HS_CLIENT_REND, \
                                    CircPurpose.HS_SERVICE_INTRO, CircPurpose.HS_SERVICE_REND) else False
 
         # now figure out what status we want to track
         key = None
-        if isinstance(event, CircuitEvent):
+        if event.type == 'CIRC':
             if event.status == CircStatus.LAUNCHED:
                 circ.set_launched(arrival_dt, self.build_timeout_last, self.build_quantile_last, self.cbt_set)
 
@@ -352,25 +1336,19 @@ class TorCtlParser(Parser):
                     circ.add_event(key, arrival_dt)
 
             if event.status == CircStatus.CLOSED or event.status == CircStatus.FAILED:
-                current_guards = []
-                for g in self.guards:
-                    if g.up_ts and circ.unix_ts_start >= g.up_ts and (not g.dropped_ts or circ.unix_ts_start < g.dropped_ts):
-                        current_guards.append(g)
+                current_guards = self.guard_registry.get_current(circ.unix_ts_start)
                 if current_guards:
                     circ.add_current_guards(current_guards)
                 circ.set_end_time(arrival_dt)
-                started, built, ended = circ.unix_ts_start, circ.buildtime_seconds, circ.unix_ts_end
-
-                data = circ.get_data()
-                if data is not None:
-                    if self.exclude_cbt and data["cbt_set"] == False:
-                       data['filtered_out'] = True
-                    else:
-                       data['filtered_out'] = False
-                    self.circuits[cid] = data
+
+                # keep the compact record, get_data converts it to its JSON shape
+                if circ.is_complete():
+                    circ.freeze()
+                    circ.filtered_out = self.exclude_cbt and circ.cbt_set == False
+                    self.circuits[cid] = circ
                 self.circuits_state.pop(cid)
 
-        elif isinstance(event, CircMinorEvent):
+        elif event.type == 'CIRC_MINOR':
             if event.purpose != event.old_purpose or event.event != CircEvent.PURPOSE_CHANGED:
                 key = "{0}:{1}".format(event.event, event.purpose)
                 circ.add_event(key, arrival_dt)
@@ -383,7 +1361,10 @@ class TorCtlParser(Parser):
 
     def __handle_stream(self, event, arrival_dt):
         sid = int(event.id)
-        strm = self.streams_state.setdefault(sid, TorStream(sid))
+        strm = self.streams_state.get(sid)
+        if strm is None:
+            strm = self.streams_state[sid] = TorStream(sid)
+            self.peak_streams_state = max(self.peak_streams_state, len(self.streams_state))
 
         if event.circ_id is not None:
             strm.set_circ_id(event.circ_id)
@@ -401,12 +1382,10 @@ class TorCtlParser(Parser):
 
         if event.status == StreamStatus.CLOSED or event.status == StreamStatus.FAILED:
             strm.set_end_time(arrival_dt)
-            stream_type = strm.last_purpose
-            started, ended = strm.unix_ts_start, strm.unix_ts_end
 
-            data = strm.get_data()
-            if data is not None:
-                self.streams[sid] = data
+            if strm.is_complete():
+                strm.freeze()
+                self.streams[sid] = strm
             self.streams_state.pop(sid)
 
     def __handle_buildtimeout(self, event, arrival_dt):
@@ -422,37 +1401,47 @@ class TorCtlParser(Parser):
             return
         fingerprint = event.endpoint_fingerprint
         nickname = event.endpoint_nickname
-        guard = None
-        for g in reversed(self.guards):
-            if g.fingerprint == fingerprint:
-                guard = g
-                break
+        guard = self.guard_registry.get_latest(fingerprint)
         if guard is None or guard.dropped_ts is not None:
-            try:
-                country = util.get_country_by_fingerprint(fingerprint)
-            except IndexError:
-                pass
-            guard = TorGuard(fingerprint=fingerprint, nickname=nickname, country=country)
-            self.guards.append(guard)
+            # the country is looked up for all guards at once in get_data
+            guard = TorGuard(fingerprint=fingerprint, nickname=nickname)
+            self.guard_registry.add(guard)
         if event.status == GuardStatus.NEW and guard.new_ts is None:
             guard.new_ts = arrival_dt
         elif event.status == GuardStatus.UP and guard.up_ts is None:
-            guard.up_ts = arrival_dt
+            self.guard_registry.set_up(guard, arrival_dt)
         elif event.status == GuardStatus.DOWN and guard.down_ts is None:
             guard.down_ts = arrival_dt
         elif event.status == GuardStatus.DROPPED and guard.dropped_ts is None:
-            guard.dropped_ts = arrival_dt
+            self.guard_registry.set_dropped(guard, arrival_dt)
 
     def __handle_event(self, event, arrival_dt):
-        if isinstance(event, (CircuitEvent, CircMinorEvent)):
+        if self.state_horizon is not None:
+            if self.next_eviction_ts is None:
+                self.next_eviction_ts = arrival_dt + self.state_horizon
+            elif arrival_dt >= self.next_eviction_ts:
+                self.__evict_stale_state(arrival_dt - self.state_horizon)
+                # looking a few times per horizon keeps entries at most 25% longer than it
+                self.next_eviction_ts = arrival_dt + self.state_horizon / 4
+        if event.type == 'CIRC' or event.type == 'CIRC_MINOR':
             self.__handle_circuit(event, arrival_dt)
-        elif isinstance(event, StreamEvent):
+        elif event.type == 'STREAM':
             self.__handle_stream(event, arrival_dt)
-        elif isinstance(event, BuildTimeoutSetEvent):
+        elif event.type == 'BUILDTIMEOUT_SET':
             self.__handle_buildtimeout(event, arrival_dt)
-        elif isinstance(event, GuardEvent):
+        elif event.type == 'GUARD':
             self.__handle_guard(event, arrival_dt)
 
+    def __evict_stale_state(self, cutoff_ts):
+        ''' drops the circuits and streams in the state whose last event arrived before cutoff_ts '''
+        for (state, counter) in [(self.circuits_state, 'evicted_circuits'), (self.streams_state, 'evicted_streams')]:
+            # entries without any events have nothing to lose
+            stale = [key for (key, entry) in state.items() if len(entry.event_times) == 0 or entry.event_times[-1] < cutoff_ts]
+            for key in stale:
+                del state[key]
+            setattr(self, counter, getattr(self, counter) + len(stale))
+        logging.debug("{0} circuits and {1} streams evicted from the torctl parser state so far".format(self.evicted_circuits, self.evicted_streams))
+
     def __is_date_valid(self, date_to_check):
         if self.date_filter is None:
             # we are not asked to filter, so every date is valid
@@ -462,6 +1451,11 @@ class TorCtlParser(Parser):
             # both the filter and the unix timestamp should be in UTC at this point
             return util.do_dates_match(self.date_filter, date_to_check)
 
+    def __parse_event_stem(self, sep, raw_event_str):
+        event = ControlMessage.from_str("{0} {1}".format(sep.strip(), raw_event_str))
+        convert('EVENT', event)
+        return event
+
     def __parse_line(self, line):
         if not self.boot_succeeded:
             if re.search("Starting\storctl\sprogram\son\shost", line) is not None:
@@ -474,41 +1468,164 @@ class TorCtlParser(Parser):
             elif re.search("BOOTSTRAP", line) is not None and re.search("PROGRESS=100", line) is not None:
                 self.boot_succeeded = True
 
-        # parse with stem
         timestamps, sep, raw_event_str = line.partition(" 650 ")
         if sep == '':
             return True
 
+        # skip events that no handler wants before building any objects
+        self.current_event_type = raw_event_str.split(None, 1)[0] if raw_event_str.strip() else ''
+        self.__count_event(self.current_event_type, 'read')
+        if self.current_event_type not in TORCTL_EVENT_ARGS:
+            self.__count_event(self.current_event_type, 'skipped')
+            return True
+
         # event.arrived_at is also available but at worse granularity
         unix_ts = float(timestamps.strip().split()[2])
 
         # check if we should ignore the line
         line_date = datetime.datetime.utcfromtimestamp(unix_ts).date()
         if not self.__is_date_valid(line_date):
+            self.__count_event(self.current_event_type, 'skipped')
             return True
 
-        event = ControlMessage.from_str("{0} {1}".format(sep.strip(), raw_event_str))
-        convert('EVENT', event)
+        event = None
+        if self.fast_parse:
+            event = parse_torctl_event(raw_event_str)
+        if event is None:
+            event = self.__parse_event_stem(sep, raw_event_str)
+        elif self.verify_fast_parse:
+            stem_event = self.__parse_event_stem(sep, raw_event_str)
+            for name in event.get_attributes():
+                if getattr(event, name) != getattr(stem_event, name, None):
+                    self.fast_parse_mismatches += 1
+                    logging.warning("fast torctl parser disagrees with stem on '{0}' for event: {1}".format(name, raw_event_str.strip()))
+                    event = stem_event
+                    break
+        if self.deferred_events is not None:
+            self.deferred_events.append((get_torctl_event_record(event), unix_ts))
+            return True
         self.__handle_event(event, unix_ts)
+        self.__count_event(self.current_event_type, 'handled')
 
         return True
 
+    def parse_event(self, event, unix_ts):
+        '''
+        Handles a torctl event that stem already parsed, such as one that
+        TorMonitor received, as if its line had been read from a log file
+        with the given timestamp.
+        '''
+        self.current_event_type = event.type
+        self.__count_event(event.type, 'read')
+        if event.type not in TORCTL_EVENT_ARGS or not self.__is_date_valid(datetime.datetime.utcfromtimestamp(unix_ts).date()):
+            self.__count_event(event.type, 'skipped')
+            return
+        try:
+            self.__handle_event(event, unix_ts)
+            self.__count_event(event.type, 'handled')
+        except Exception as e:
+            self.__count_event(event.type, 'failed')
+            # sampled like the lines of a log file that fail to parse
+            self.__add_parse_error("{0:.02f} 650 {1}".format(unix_ts, event.raw_content()), e)
+
+    def __count_event(self, event_type, outcome):
+        counts = self.event_counts.setdefault(event_type, {'read': 0, 'skipped': 0, 'handled': 0, 'failed': 0})
+        counts[outcome] += 1
+
     def parse(self, source):
-        source.open(newline='\r\n')
+        # source may also be a plain list of lines, which is how chunk workers call this
+        chunks = source.get_chunks(self.num_workers * TORCTL_CHUNKS_PER_WORKER, newline='\r\n') \
+            if self.num_workers > 1 and isinstance(source, util.DataSource) else None
+        if chunks is not None and len(chunks) > 1:
+            self.__parse_chunks(source, chunks)
+            return
+        if not isinstance(source, list):
+            source.open(newline='\r\n')
         for line in source:
-            # ignore line parsing errors
+            self.current_event_type = None
+            # ignore line parsing errors, but keep track of them
             try:
                 if self.__parse_line(line):
                     continue
                 else:
                     break
-            except:
+            except Exception as e:
+                if self.current_event_type is not None:
+                    self.__count_event(self.current_event_type, 'failed')
+                self.__add_parse_error(line, e)
                 continue
-        source.close()
+        if not isinstance(source, list):
+            source.close()
+
+    def __add_parse_error(self, line, error):
+        self.parse_errors += 1
+        if len(self.parse_error_samples) < profiling.PARSE_ERROR_SAMPLES:
+            self.parse_error_samples.append({'line': line.strip()[:1000], 'error': repr(error)})
+
+    def __parse_chunks(self, source, chunks):
+        filename = source.filename
+        logging.info("parsing {0} chunks of {1} with {2} workers".format(len(chunks), filename, self.num_workers))
+        chunk_args = [(filename, chunk, self.date_filter, self.fast_parse, self.verify_fast_parse) for chunk in chunks]
+        with Pool(self.num_workers) as pool:
+            # imap returns the chunks in file order, which is the order their events have to be handled in
+            for (name, boot_succeeded, event_counts, fast_parse_mismatches, events, parse_errors, parse_error_samples, lines_read, bytes_read) \
+                    in pool.imap(_parse_torctl_chunk, chunk_args):
+                if not self.boot_succeeded:
+                    if name is not None:
+                        self.name = name
+                    self.boot_succeeded = boot_succeeded
+                for event_type, counts in event_counts.items():
+                    for outcome, count in counts.items():
+                        self.event_counts.setdefault(event_type, {'read': 0, 'skipped': 0, 'handled': 0, 'failed': 0})[outcome] += count
+                self.fast_parse_mismatches += fast_parse_mismatches
+                self.parse_errors += parse_errors
+                self.parse_error_samples.extend(parse_error_samples[:max(0, profiling.PARSE_ERROR_SAMPLES - len(self.parse_error_samples))])
+                source.lines_read += lines_read
+                source.bytes_read += bytes_read
+                for (record, unix_ts) in events:
+                    try:
+                        self.__handle_event(get_torctl_event(record), unix_ts)
+                        self.__count_event(record[0], 'handled')
+                    except Exception as e:
+                        self.__count_event(record[0], 'failed')
+                        # the line itself stayed in the worker
+                        self.__add_parse_error("650 {0} {1}".format(record[0], " ".join(str(value) for value in record[1])), e)
+
+    def __resolve_countries(self):
+        fingerprints = sorted(set(guard.fingerprint for guard in self.guards if guard.country is None))
+        if len(fingerprints) == 0:
+            return
+        country_lookup = self.country_lookup if self.country_lookup is not None else util.CountryLookup()
+        countries = country_lookup.get_countries(fingerprints)
+        for guard in self.guards:
+            if guard.country is None:
+                guard.country = countries.get(guard.fingerprint)
+        # circuits keep copies of the guards from when they were closed
+        for circuit in self.circuits.values():
+            for guard in circuit.current_guards or []:
+                if guard.country is None:
+                    guard.country = countries.get(guard.fingerprint)
 
     def get_data(self):
-        return {'circuits': self.circuits, 'streams': self.streams,
-                'guards': [guard.get_data() for guard in self.guards]}
+        self.__resolve_countries()
+        return {'circuits': {cid: circuit.get_data() for (cid, circuit) in self.circuits.items()},
+                'streams': {sid: stream.get_data() for (sid, stream) in self.streams.items()},
+                'guards': [guard.get_data() for guard in self.guards],
+                'incomplete': {'circuits': {'evicted': self.evicted_circuits, 'open': len(self.circuits_state)},
+                               'streams': {'evicted': self.evicted_streams, 'open': len(self.streams_state)}}}
 
     def get_name(self):
         return self.name
+
+    def get_event_counts(self):
+        ''' returns the number of event lines read, skipped, handled, and failed per event type '''
+        return self.event_counts
+
+    def get_state_stats(self):
+        ''' returns the largest numbers of open circuits and streams held at once, and how many were evicted '''
+        return {'peak_circuits_state': self.peak_circuits_state, 'peak_streams_state': self.peak_streams_state,
+                'evicted_circuits': self.evicted_circuits, 'evicted_streams': self.evicted_streams}
+
+    def get_parse_errors(self):
+        ''' returns the number of lines that failed to parse and a list of the first few of them '''
+        return (self.parse_errors, self.parse_error_samples)
@@ -0,0 +1,176 @@
+'''
+  OnionPerf
+  Authored by Rob Jansen, 2015
+  Copyright 2015-2020 The Tor Project
+  See LICENSE for licensing information
+'''
+
+import os, sys, json, time, shutil, tempfile, platform, tracemalloc, logging
+
+from . import util, synthetic, profiling
+from .analysis import OPAnalysis, TGenStreamParser
+from tgentools.analysis import TGenParser
+
+# the version of the results format, which only compares to baselines of the same version
+VERSION = 1
+
+# the steps timed at each size, in the order they run
+STEPS = ("analyze", "save", "load", "filter", "extract")
+
+def run_benchmark(days=(1, 2, 4), repeat=1, work_dir=None, **generator_args):
+    '''
+    Generates synthetic logs covering each number of days in days, and times
+    analyzing them, saving, loading and filtering the analysis results, and
+    extracting the visualization data frame from them, taking the fastest of
+    repeat runs of each step. The logs and analysis results are written to a
+    temporary directory, or kept in work_dir if given. generator_args are
+    passed on to synthetic.SyntheticLogGenerator. Returns the results in the
+    format compare_results expects.
+    '''
+    results = {'version': VERSION, 'python': platform.python_version(), 'platform': platform.platform(),
+               'generator': dict(generator_args), 'runs': []}
+    base_dir = work_dir if work_dir is not None else tempfile.mkdtemp(prefix="onionperf-bench-")
+    try:
+        for num_days in days:
+            run_dir = os.path.join(base_dir, "{0}-days".format(num_days))
+            if not os.path.exists(run_dir):
+                os.makedirs(run_dir)
+            logging.info("generating synthetic logs covering {0} days in {1}".format(num_days, run_dir))
+            (tgen_path, torctl_path, stats) = synthetic.generate_logs(run_dir, days=num_days, **generator_args)
+            run = {'days': num_days, 'transfers': stats['transfers'], 'tgen_log_bytes': os.path.getsize(tgen_path),
+                   'torctl_log_bytes': os.path.getsize(torctl_path), 'steps': {}}
+            for _ in range(repeat):
+                for (name, record) in _run_steps(run_dir, tgen_path, torctl_path):
+                    if name not in run['steps'] or record['wall_seconds'] < run['steps'][name]['wall_seconds']:
+                        run['steps'][name] = record
+            results['runs'].append(run)
+    finally:
+        if work_dir is None:
+            shutil.rmtree(base_dir, ignore_errors=True)
+    return results
+
+def _run_steps(run_dir, tgen_path, torctl_path):
+    ''' yields (step name, profiling record) for each step in STEPS '''
+    # the data frame extraction is in the visualization module, which needs the plotting libraries
+    from .visualization import TGenVisualization
+    from .filtering import Filtering
+
+    profiler = profiling.Profiler("bench")
+    analysis = OPAnalysis()
+    analysis.set_country_lookup(util.CountryLookup(offline=True))
+    analysis.add_tgen_file(tgen_path)
+    analysis.add_torctl_file(torctl_path)
+    with profiler.phase("analyze"):
+        analysis.analyze()
+    analysis_path = os.path.join(run_dir, "onionperf.analysis.json.xz")
+    with profiler.phase("save"):
+        analysis.save(filename=os.path.basename(analysis_path), output_prefix=run_dir)
+    with profiler.phase("load"):
+        OPAnalysis.load(filename=analysis_path)
+    filtering = Filtering()
+    filtering.exclude_cbt = True
+    with profiler.phase("filter"):
+        filtering.apply_filters(input_path=analysis_path, output_dir=run_dir, output_file="onionperf.filtered.json.xz")
+    # the extraction consumes the streams of the analyses it is given, so load a copy outside of the timed step
+    tgen_viz = TGenVisualization()
+    tgen_viz.add_dataset([OPAnalysis.load(filename=analysis_path)], "bench")
+    with profiler.phase("extract") as record:
+        record['rows'] = len(tgen_viz.get_data_frame())
+    for record in profiler.phases:
+        yield (record.pop('name'), record)
+
+def run_tgen_memory_benchmark(days=7, work_dir=None, **generator_args):
+    '''
+    Generates a synthetic TGen log covering days, and compares parsing it and
+    getting the parsed data with the TGenParser of tgentools, which also
+    builds heartbeats and stream summaries, and with the TGenStreamParser
+    that OPAnalysis uses. Returns a dict with the size of the log and, per
+    parser, the wall time taken and the peak memory allocated while parsing,
+    which is measured in a second run because tracing allocations is slow.
+    '''
+    base_dir = work_dir if work_dir is not None else tempfile.mkdtemp(prefix="onionperf-bench-")
+    try:
+        run_dir = os.path.join(base_dir, "{0}-days".format(days))
+        if not os.path.exists(run_dir):
+            os.makedirs(run_dir)
+        logging.info("generating synthetic logs covering {0} days in {1}".format(days, run_dir))
+        (tgen_path, _, stats) = synthetic.generate_logs(run_dir, days=days, **generator_args)
+        results = {'days': days, 'transfers': stats['transfers'], 'tgen_log_bytes': os.path.getsize(tgen_path), 'parsers': {}}
+        for parser_class in (TGenParser, TGenStreamParser):
+            start = time.perf_counter()
+            _parse_tgen_log(parser_class, tgen_path)
+            wall_seconds = time.perf_counter() - start
+            tracemalloc.start()
+            try:
+                streams = _parse_tgen_log(parser_class, tgen_path)
+                (_, peak_bytes) = tracemalloc.get_traced_memory()
+            finally:
+                tracemalloc.stop()
+            results['parsers'][parser_class.__name__] = {'wall_seconds': wall_seconds, 'peak_bytes': peak_bytes, 'streams': streams}
+            logging.info("{0} took {1:.3f} seconds and at most {2} bytes".format(parser_class.__name__, wall_seconds, peak_bytes))
+    finally:
+        if work_dir is None:
+            shutil.rmtree(base_dir, ignore_errors=True)
+    return results
+
+def _parse_tgen_log(parser_class, tgen_path):
+    ''' parses tgen_path with a new parser_class and returns the number of streams in its data '''
+    parser = parser_class()
+    parser.parse(util.DataSource(tgen_path), do_complete=True)
+    return len(parser.get_data()['streams'])
+
+def compare_results(results, baseline, tolerance=0.25):
+    '''
+    Compares the wall time of each step at each number of days in results to
+    that in baseline, and returns a list of (days, step, baseline seconds,
+    seconds, ratio, is_regression) for the pairs found in both, where a step
+    regressed if it took more than 1 + tolerance times as long as before.
+    '''
+    if baseline.get('version') != VERSION:
+        raise ValueError("baseline has results format version {0}, expected {1}".format(baseline.get('version'), VERSION))
+    if baseline.get('generator') != results.get('generator'):
+        logging.warning("the baseline was measured on logs generated with different arguments: {0}".format(baseline.get('generator')))
+    baseline_runs = {run['days']: run for run in baseline['runs']}
+    comparison = []
+    for run in results['runs']:
+        if run['days'] not in baseline_runs:
+            continue
+        for step in STEPS:
+            if step not in run['steps'] or step not in baseline_runs[run['days']]['steps']:
+                continue
+            before = baseline_runs[run['days']]['steps'][step]['wall_seconds']
+            after = run['steps'][step]['wall_seconds']
+            ratio = after / before if before > 0 else float('inf')
+            comparison.append((run['days'], step, before, after, ratio, ratio > 1.0 + tolerance))
+    return comparison
+
+def write_report(results, comparison, out=sys.stdout):
+    ''' prints a table of the results, and of how they compare to the baseline if comparison is not None '''
+    out.write("{0:>5} {1:>10} {2:>8} {3:>12} {4:>12} {5:>12}\n".format("days", "transfers", "step", "seconds", "cpu seconds", "MB/s"))
+    for run in results['runs']:
+        log_bytes = run['tgen_log_bytes'] + run['torctl_log_bytes']
+        for step in STEPS:
+            if step in run['steps']:
+                record = run['steps'][step]
+                rate = "{0:.1f}".format(log_bytes / record['wall_seconds'] / 1e6) if step == "analyze" and record['wall_seconds'] > 0 else ""
+                out.write("{0:>5} {1:>10} {2:>8} {3:>12.3f} {4:>12.3f} {5:>12}\n".format(run['days'], run['transfers'], step,
+                          record['wall_seconds'], record['cpu_seconds'], rate))
+    if 'tgen_memory' in results:
+        tgen_memory = results['tgen_memory']
+        out.write("\n{0} days of TGen log, {1:.1f} MB\n".format(tgen_memory['days'], tgen_memory['tgen_log_bytes'] / 1e6))
+        out.write("{0:>18} {1:>12} {2:>12} {3:>10}\n".format("parser", "seconds", "peak MB", "streams"))
+        for (name, record) in sorted(tgen_memory['parsers'].items()):
+            out.write("{0:>18} {1:>12.3f} {2:>12.1f} {3:>10}\n".format(name, record['wall_seconds'], record['peak_bytes'] / 1e6, record['streams']))
+    if comparison is not None:
+        out.write("\n{0:>5} {1:>8} {2:>12} {3:>12} {4:>8}\n".format("days", "step", "baseline", "seconds", "ratio"))
+        for (days, step, before, after, ratio, is_regression) in comparison:
+            out.write("{0:>5} {1:>8} {2:>12.3f} {3:>12.3f} {4:>8.2f}{5}\n".format(days, step, before, after, ratio,
+                      "  REGRESSION" if is_regression else ""))
+
+def save_results(results, filename):
+    with open(filename, 'wt') as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+
+def load_results(filename):
+    with open(filename, 'rt') as f:
+        return json.load(f)
@@ -8,6 +8,7 @@
 import sys, re
 import logging
 from onionperf.analysis import OPAnalysis
+from onionperf import profiling
 
 class Filtering(object):
 
@@ -16,6 +17,10 @@ class Filtering(object):
         self.fingerprints_to_exclude = None
         self.exclude_cbt = False
         self.fingerprint_pattern = re.compile("\$?([0-9a-fA-F]{40})")
+        self.profiler = None
+
+    def set_profiler(self, profiler):
+        self.profiler = profiler
 
     def include_fingerprints(self, path):
         self.fingerprints_to_include = []
@@ -88,9 +93,13 @@ class Filtering(object):
                     tor_circuits[circuit_id] = dict(sorted(tor_circuit.items()))
 
     def apply_filters(self, input_path, output_dir, output_file):
-        analysis = OPAnalysis.load(filename=input_path)
-        self.filter_tor_circuits(analysis)
-        analysis.json_db["version"] = '3.1'
+        with profiling.phase(self.profiler, "load", file=input_path):
+            analysis = OPAnalysis.load(filename=input_path)
+        analysis.set_profiler(self.profiler)
+        with profiling.phase(self.profiler, "filter"):
+            self.filter_tor_circuits(analysis)
+        if str(analysis.json_db["version"]) < '3.1':
+            analysis.json_db["version"] = '3.1'
         analysis.json_db = dict(sorted(analysis.json_db.items()))
         analysis.save(filename=output_file, output_prefix=output_dir, sort_keys=False)
 
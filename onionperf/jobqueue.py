@@ -0,0 +1,226 @@
+'''
+  OnionPerf
+  Authored by Rob Jansen, 2015
+  Copyright 2015-2020 The Tor Project
+  See LICENSE for licensing information
+'''
+
+import os, json, time, socket, hashlib, threading, traceback, datetime, logging
+
+from . import util
+
+class JobQueue(object):
+    '''
+    A queue of log pairs to analyze, kept in a directory on a filesystem that
+    is shared by any number of worker processes on one or more hosts, without
+    a broker. Each job is a JSON file that moves between the subdirectories
+    pending/, claimed/, done/ and failed/ by atomic renames:
+
+    - a worker claims a pending job by renaming it into claimed/ under a name
+      that ends in its worker id, which only one worker can succeed at
+    - the worker touches its claim every heartbeat_interval seconds while the
+      job runs, and any worker returns claims that were not touched for
+      lease_timeout seconds to pending/, e.g. those of a worker that died
+    - the worker records the result of a job in done/, or puts a failed job
+      back into pending/ until it failed max_attempts times, and then into
+      failed/ along with its errors
+
+    Job names start with the time they were enqueued at and their position
+    in the enqueued list, so that jobs are claimed in that order, and end in
+    a hash of the log paths, sizes and mtimes, so that enqueuing the same
+    unchanged pair again does nothing. Leases compare file mtimes to the
+    local clock, so the clocks of the hosts need to be in sync.
+    '''
+
+    STATES = ("pending", "claimed", "done", "failed")
+
+    def __init__(self, queue_dir, lease_timeout=600, max_attempts=3):
+        self.queue_dir = queue_dir
+        self.lease_timeout = lease_timeout
+        self.heartbeat_interval = lease_timeout / 4.0
+        self.max_attempts = max_attempts
+        for subdir in JobQueue.STATES + ("tmp",):
+            os.makedirs(os.path.join(queue_dir, subdir), exist_ok=True)
+
+    def __get_path(self, state, filename):
+        return os.path.join(self.queue_dir, state, filename)
+
+    def __list(self, state):
+        return sorted(os.listdir(os.path.join(self.queue_dir, state)))
+
+    def __write(self, state, filename, data):
+        tmp_path = self.__get_path("tmp", "{0}.{1}.{2}".format(filename, socket.gethostname(), os.getpid()))
+        with open(tmp_path, 'wt') as f:
+            json.dump(data, f, indent=2, sort_keys=True)
+        os.replace(tmp_path, self.__get_path(state, filename))
+
+    @staticmethod
+    def get_job_id(pair):
+        digest = hashlib.sha1()
+        for path in pair[:2]:
+            stat = os.stat(path)
+            digest.update("{0}\0{1}\0{2}\0".format(os.path.abspath(path), stat.st_size, stat.st_mtime).encode('utf-8'))
+        return "{0}-{1}".format(util.date_to_string(pair[2]), digest.hexdigest()[:16])
+
+    @staticmethod
+    def __get_job_id(filename):
+        # the enqueue time and position come first, a claiming worker id last
+        return filename.split('@', 1)[0][:-len(".json")].split('-', 2)[2]
+
+    def enqueue(self, log_pairs, force=False):
+        '''
+        Adds a pending job for each (tgen log, torctl log, date) in log_pairs
+        that is not queued yet, or was done or failed before unless force is
+        set, and returns the number of jobs added.
+        '''
+        known = {}
+        for state in JobQueue.STATES:
+            for filename in self.__list(state):
+                known.setdefault(JobQueue.__get_job_id(filename), []).append((state, filename))
+        enqueue_ms = int(time.time() * 1000)
+        added = 0
+        for (position, pair) in enumerate(log_pairs):
+            job_id = JobQueue.get_job_id(pair)
+            states = known.get(job_id, [])
+            if force:
+                for (state, filename) in states:
+                    if state in ("done", "failed"):
+                        os.remove(self.__get_path(state, filename))
+                states = [(state, filename) for (state, filename) in states if state not in ("done", "failed")]
+            if len(states) > 0:
+                continue
+            job = {'id': job_id, 'tgen': os.path.abspath(pair[0]), 'torctl': os.path.abspath(pair[1]),
+                   'date': util.date_to_string(pair[2]), 'attempts': 0, 'errors': []}
+            self.__write("pending", "{0:013d}-{1:06d}-{2}.json".format(enqueue_ms, position, job_id), job)
+            added += 1
+        return added
+
+    def claim(self, worker_id):
+        '''
+        Claims the oldest pending job for worker_id, and returns the job and
+        the path of the claim, or None if there is no pending job left.
+        '''
+        for filename in self.__list("pending"):
+            pending_path = self.__get_path("pending", filename)
+            claim_path = self.__get_path("claimed", "{0}@{1}".format(filename, worker_id))
+            try:
+                if os.path.exists(self.__get_path("done", filename)):
+                    # a worker whose lease had expired finished it after all
+                    os.remove(pending_path)
+                    continue
+                # start the lease now, not at the time the job was enqueued
+                os.utime(pending_path)
+                os.rename(pending_path, claim_path)
+            except FileNotFoundError:
+                # another worker claimed it first
+                continue
+            with open(claim_path, 'rt') as f:
+                return (json.load(f), claim_path)
+        return None
+
+    def heartbeat(self, claim_path):
+        os.utime(claim_path)
+
+    def __release(self, claim_path):
+        try:
+            os.remove(claim_path)
+        except FileNotFoundError:
+            logging.warning("the lease on {0} expired before the job finished".format(os.path.basename(claim_path)))
+
+    def complete(self, job, claim_path, result):
+        filename = os.path.basename(claim_path).split('@', 1)[0]
+        job = dict(job, attempts=job['attempts'] + 1, result=result)
+        self.__write("done", filename, job)
+        self.__release(claim_path)
+
+    def fail(self, job, claim_path, error):
+        filename = os.path.basename(claim_path).split('@', 1)[0]
+        job = dict(job, attempts=job['attempts'] + 1, errors=job['errors'] + [error])
+        self.__write("pending" if job['attempts'] < self.max_attempts else "failed", filename, job)
+        self.__release(claim_path)
+
+    def recover_expired(self, worker_id):
+        '''
+        Returns the jobs whose claims were not touched for lease_timeout
+        seconds to pending/, counting the attempt as failed, and returns the
+        number of jobs recovered.
+        '''
+        recovered = 0
+        now = time.time()
+        done = set(self.__list("done"))
+        for claim_filename in self.__list("claimed"):
+            claim_path = self.__get_path("claimed", claim_filename)
+            try:
+                if now - os.path.getmtime(claim_path) < self.lease_timeout:
+                    continue
+                # move the claim out of the way first, so that only one worker recovers it
+                recovery_path = self.__get_path("tmp", "{0}@{1}".format(claim_filename, worker_id))
+                os.rename(claim_path, recovery_path)
+            except FileNotFoundError:
+                continue
+            filename, owner = claim_filename.split('@', 1)
+            if filename not in done:
+                with open(recovery_path, 'rt') as f:
+                    job = json.load(f)
+                logging.warning("the lease of {0} on job {1} expired, returning it to the queue".format(owner, job['id']))
+                self.fail(job, recovery_path, "the lease of {0} expired".format(owner))
+                recovered += 1
+            else:
+                os.remove(recovery_path)
+        return recovered
+
+    def get_counts(self):
+        return {state: len(self.__list(state)) for state in JobQueue.STATES}
+
+def get_worker_id():
+    return "{0}-{1}".format(socket.gethostname(), os.getpid())
+
+def run_worker(queue, func, worker_id=None, poll_interval=10):
+    '''
+    Claims and runs jobs from queue until no job is pending or claimed any
+    more, waiting poll_interval seconds between checks while other workers
+    still hold claims, in case their leases expire. func is called with the
+    (tgen log, torctl log, datetime) pair of each job and returns the path of
+    the analysis results. Returns the numbers of jobs this worker completed
+    and failed.
+    '''
+    worker_id = worker_id or get_worker_id()
+    counts = {'completed': 0, 'failed': 0}
+    while True:
+        queue.recover_expired(worker_id)
+        claimed = queue.claim(worker_id)
+        if claimed is None:
+            queue_counts = queue.get_counts()
+            if queue_counts['pending'] == 0 and queue_counts['claimed'] == 0:
+                break
+            time.sleep(poll_interval)
+            continue
+        (job, claim_path) = claimed
+        logging.info("{0} claimed job {1} for logs {2} and {3}".format(worker_id, job['id'], job['tgen'], job['torctl']))
+        date = datetime.datetime.strptime(job['date'], "%Y-%m-%d")
+        done_ev = threading.Event()
+        heartbeat_thread = threading.Thread(target=_heartbeat_task, args=(queue, claim_path, done_ev), daemon=True)
+        heartbeat_thread.start()
+        start = time.perf_counter()
+        try:
+            output = func((job['tgen'], job['torctl'], date))
+        except Exception as e:
+            logging.warning("job {0} failed: {1}".format(job['id'], traceback.format_exc()))
+            queue.fail(job, claim_path, "{0} on {1}".format(repr(e), worker_id))
+            counts['failed'] += 1
+            continue
+        finally:
+            done_ev.set()
+            heartbeat_thread.join()
+        queue.complete(job, claim_path, {'output': output, 'worker': worker_id, 'seconds': time.perf_counter() - start})
+        counts['completed'] += 1
+    logging.info("{0} found no more jobs after completing {1} and failing {2}".format(worker_id, counts['completed'], counts['failed']))
+    return counts
+
+def _heartbeat_task(queue, claim_path, done_ev):
+    while not done_ev.wait(queue.heartbeat_interval):
+        try:
+            queue.heartbeat(claim_path)
+        except FileNotFoundError:
+            # the lease expired and another worker recovered the job
+            return
@@ -140,7 +140,7 @@ def watchdog_thread_task(cmd, cwd, writable, done_ev, send_stdin, ready_search_s
     # too many failures, or master asked us to stop, close the writable before exiting thread
     writable.close()
 
-def logrotate_thread_task(writables, tgen_writable, torctl_writable, docroot, nickname, done_ev, analysis_args):
+def logrotate_thread_task(writables, tgen_writable, torctl_writable, docroot, nickname, done_ev, analysis_args, torctl_sink=None):
     next_midnight = None
 
     while not done_ev.wait(1):
@@ -172,7 +172,12 @@ def logrotate_thread_task(writables, tgen_writable, torctl_writable, docroot, ni
                     if tgen_writable is not None:
                         anal.add_tgen_file(tgen_writable.rotate_file(filename_datetime=next_midnight))
                     if torctl_writable is not None:
-                        anal.add_torctl_file(torctl_writable.rotate_file(filename_datetime=next_midnight))
+                        if torctl_sink is not None:
+                            # the live sink already has the events of the rotated log,
+                            # and rotates the log with its parser so that none is missed
+                            anal.add_torctl_parser(torctl_sink.rotate(torctl_writable, filename_datetime=next_midnight))
+                        else:
+                            anal.add_torctl_file(torctl_writable.rotate_file(filename_datetime=next_midnight))
 
                     # run the analysis, i.e. parse the files
                     anal.analyze(**analysis_args)
@@ -190,7 +195,7 @@ def logrotate_thread_task(writables, tgen_writable, torctl_writable, docroot, ni
 
 class Measurement(object):
 
-    def __init__(self, tor_bin_path, tgen_bin_path, datadir_path, privatedir_path, nickname, additional_client_conf=None, torclient_conf_file=None, torserver_conf_file=None, single_onion=False, drop_guards_interval_hours=0, newnym_interval_seconds=300, stop_regex=None):
+    def __init__(self, tor_bin_path, tgen_bin_path, datadir_path, privatedir_path, nickname, additional_client_conf=None, torclient_conf_file=None, torserver_conf_file=None, single_onion=False, drop_guards_interval_hours=0, newnym_interval_seconds=300, stop_regex=None, live_analysis=False, log_codec='gz', log_level=None):
         self.tor_bin_path = tor_bin_path
         self.tgen_bin_path = tgen_bin_path
         self.datadir_path = datadir_path
@@ -208,6 +213,10 @@ class Measurement(object):
         self.drop_guards_interval_hours = drop_guards_interval_hours
         self.newnym_interval_seconds = newnym_interval_seconds
         self.stop_regex = stop_regex
+        self.live_analysis = live_analysis
+        self.log_codec = log_codec
+        self.log_level = log_level
+        self.torctl_client_sink = None
 
     def run(self, do_onion=True, do_inet=True, tgen_model=None, tgen_client_conf=None, tgen_server_conf=None):
         '''
@@ -355,7 +364,7 @@ class Measurement(object):
         analysis_args["exclude_cbt"] = False
         if self.drop_guards_interval_hours != 0:
             analysis_args["exclude_cbt"] = True
-        logrotate_args = (general_writables, tgen_writable, torctl_writable, self.www_docroot, self.nickname, self.done_event, analysis_args)
+        logrotate_args = (general_writables, tgen_writable, torctl_writable, self.www_docroot, self.nickname, self.done_event, analysis_args, self.torctl_client_sink)
         logrotate = threading.Thread(target=logrotate_thread_task, name="logrotate", args=logrotate_args)
         logrotate.start()
         self.threads.append(logrotate)
@@ -382,7 +391,7 @@ class Measurement(object):
             tgen_model.dump_to_file(tgen_confpath)
 
         tgen_logpath = "{0}/onionperf.tgen.log".format(tgen_datadir)
-        tgen_writable = util.FileWritable(tgen_logpath)
+        tgen_writable = util.FileWritable(tgen_logpath, rotate_codec=self.log_codec, rotate_level=self.log_level)
         logging.info("Logging TGen {1} process output to {0}".format(tgen_logpath, name))
 
         tgen_cmd = "{0} {1}".format(self.tgen_bin_path, tgen_confpath)
@@ -461,12 +470,15 @@ WarnUnsafeSocks 0\nSafeLogging 0\nMaxCircuitDirtiness 60 seconds\nDataDirectory
         return response.service_id
 
     def __start_tor_client(self, control_port, socks_port):
-        return self.__start_tor("client", control_port, socks_port)
+        if self.live_analysis:
+            # analyze the client's torctl events while they arrive instead of parsing its log at midnight
+            self.torctl_client_sink = analysis.TorCtlLiveSink(exclude_cbt=self.drop_guards_interval_hours != 0)
+        return self.__start_tor("client", control_port, socks_port, sink=self.torctl_client_sink)
 
     def __start_tor_server(self, control_port, socks_port, hs_port_mapping):
         return self.__start_tor("server", control_port, socks_port, hs_port_mapping)
 
-    def __start_tor(self, name, control_port, socks_port, hs_port_mapping=None):
+    def __start_tor(self, name, control_port, socks_port, hs_port_mapping=None, sink=None):
         logging.info("Starting Tor {0} process with ControlPort={1}, SocksPort={2}...".format(name, control_port, socks_port))
         tor_datadir = "{0}/tor-{1}".format(self.datadir_path, name)
         key_path_v3 = "{0}/os_key_v3".format(self.privatedir_path)
@@ -478,7 +490,7 @@ WarnUnsafeSocks 0\nSafeLogging 0\nMaxCircuitDirtiness 60 seconds\nDataDirectory
             f.write(tor_config)
 
         tor_logpath = "{0}/onionperf.tor.log".format(tor_datadir)
-        tor_writable = util.FileWritable(tor_logpath)
+        tor_writable = util.FileWritable(tor_logpath, rotate_codec=self.log_codec, rotate_level=self.log_level)
         logging.info("Logging Tor {0} process output to {1}".format(name, tor_logpath))
 
         # from stem.process import launch_tor_with_config
@@ -496,14 +508,14 @@ WarnUnsafeSocks 0\nSafeLogging 0\nMaxCircuitDirtiness 60 seconds\nDataDirectory
         tor_ready_ev.wait()
 
         torctl_logpath = "{0}/onionperf.torctl.log".format(tor_datadir)
-        torctl_writable = util.FileWritable(torctl_logpath)
+        torctl_writable = util.FileWritable(torctl_logpath, rotate_codec=self.log_codec, rotate_level=self.log_level)
         logging.info("Logging Tor {0} control port monitor output to {1}".format(name, torctl_logpath))
 
         # give a few seconds to make sure Tor had time to start listening on the control port
         time.sleep(3)
 
         torctl_events = [e for e in monitor.get_supported_torctl_events() if e not in ['DEBUG', 'INFO', 'NOTICE', 'WARN', 'ERR']]
-        torctl_args = (control_port, torctl_writable, torctl_events, self.newnym_interval_seconds, self.drop_guards_interval_hours, self.done_event)
+        torctl_args = (control_port, torctl_writable, torctl_events, self.newnym_interval_seconds, self.drop_guards_interval_hours, self.done_event, sink)
         torctl_helper = threading.Thread(target=monitor.tor_monitor_run, name="torctl_{0}_helper".format(name), args=torctl_args)
         torctl_helper.start()
         self.threads.append(torctl_helper)
@@ -18,10 +18,12 @@ def get_supported_torctl_events():
 
 class TorMonitor(object):
 
-    def __init__(self, tor_ctl_port, writable, events=get_supported_torctl_events()):
+    def __init__(self, tor_ctl_port, writable, events=get_supported_torctl_events(), sink=None):
         self.tor_ctl_port = tor_ctl_port
         self.writable = writable
         self.events = events
+        # an optional analysis.TorCtlLiveSink that gets everything we log
+        self.sink = sink
 
     def run(self, newnym_interval_seconds=None, drop_guards_interval_hours=0, done_ev=None):
         with Controller.from_port(port=self.tor_ctl_port) as torctl:
@@ -81,15 +83,21 @@ class TorMonitor(object):
         self.writable.close()
 
     def __handle_tor_event(self, writable, event):
-        self.__log(writable, event.raw_content())
+        self.__log(writable, event.raw_content(), event)
 
-    def __log(self, writable, msg):
+    def __log(self, writable, msg, event=None):
         now = datetime.datetime.now()
         utcnow = datetime.datetime.utcnow()
         epoch = datetime.datetime(1970, 1, 1)
         unix_ts = (utcnow - epoch).total_seconds()
-        writable.write("{0} {1:.02f} {2}".format(now.strftime("%Y-%m-%d %H:%M:%S"), unix_ts, msg))
+        line = "{0} {1:.02f} {2}".format(now.strftime("%Y-%m-%d %H:%M:%S"), unix_ts, msg)
+        if self.sink is not None:
+            # the sink writes the line itself, so that a log rotation cannot
+            # come between writing and handling it
+            self.sink.log(writable, line, event)
+        else:
+            writable.write(line)
 
-def tor_monitor_run(tor_ctl_port, writable, events, newnym_interval_seconds, drop_guards_interval_hours, done_ev):
-    torctl_monitor = TorMonitor(tor_ctl_port, writable, events)
+def tor_monitor_run(tor_ctl_port, writable, events, newnym_interval_seconds, drop_guards_interval_hours, done_ev, sink=None):
+    torctl_monitor = TorMonitor(tor_ctl_port, writable, events, sink)
     torctl_monitor.run(newnym_interval_seconds=newnym_interval_seconds, drop_guards_interval_hours=drop_guards_interval_hours, done_ev=done_ev)
@@ -0,0 +1,138 @@
+'''
+  OnionPerf
+  Authored by Rob Jansen, 2015
+  Copyright 2015-2020 The Tor Project
+  See LICENSE for licensing information
+'''
+
+import contextlib, cProfile, json, os, sys, time, datetime
+import logging
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# the number of offending lines kept per parser
+PARSE_ERROR_SAMPLES = 10
+
+def get_cpu_seconds():
+    ''' returns the user and system CPU time of this process and of its waited-for children '''
+    times = os.times()
+    return times.user + times.system + times.children_user + times.children_system
+
+def get_peak_rss_bytes():
+    ''' returns the largest resident set size of this process and of its largest waited-for child so far '''
+    if resource is None:
+        return None
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    scale = 1 if sys.platform == 'darwin' else 1024
+    return max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss) * scale
+
+def phase(profiler, name, **info):
+    '''
+    Returns profiler.phase(name, **info), or a context that records nothing
+    if profiler is None, so that callers can time their phases unconditionally.
+    '''
+    if profiler is None:
+        return contextlib.nullcontext({})
+    return profiler.phase(name, **info)
+
+class Profiler(object):
+    '''
+    Records the wall and CPU time, throughput and memory use of the phases of
+    an onionperf command, along with the lines that failed to parse, and
+    writes them to a JSON report. Optionally runs the whole command under
+    cProfile and dumps its statistics for use with pstats or snakeviz.
+    '''
+
+    def __init__(self, command, report_path=None, cprofile_path=None):
+        self.command = command
+        self.report_path = report_path
+        self.cprofile_path = cprofile_path
+        self.cprofile = None
+        self.phases = []
+        self.parse_errors = {}
+        self.stats = {}
+        self.start_dt = datetime.datetime.utcnow()
+        self.start_wall = time.perf_counter()
+        self.start_cpu = get_cpu_seconds()
+
+    def start(self):
+        if self.cprofile_path is not None:
+            self.cprofile = cProfile.Profile()
+            self.cprofile.enable()
+
+    @contextlib.contextmanager
+    def phase(self, name, **info):
+        '''
+        Times the enclosed block as a phase called name. The yielded dict is
+        stored in the report, so callers can add to it: the number of 'lines'
+        and 'bytes' processed, which are turned into per-second rates, or
+        anything else worth knowing about the phase, like its input file.
+        '''
+        record = dict(info)
+        start_wall, start_cpu = time.perf_counter(), get_cpu_seconds()
+        try:
+            yield record
+        finally:
+            record['name'] = name
+            record['wall_seconds'] = time.perf_counter() - start_wall
+            record['cpu_seconds'] = get_cpu_seconds() - start_cpu
+            record['peak_rss_bytes'] = get_peak_rss_bytes()
+            for unit in ('lines', 'bytes'):
+                if unit in record and record['wall_seconds'] > 0:
+                    record['{0}_per_second'.format(unit)] = record[unit] / record['wall_seconds']
+            self.phases.append(record)
+            logging.info("{0} took {1:.3f} seconds ({2:.3f} CPU seconds)".format(name, record['wall_seconds'], record['cpu_seconds']))
+
+    def add_parse_errors(self, parser_name, count, samples):
+        ''' adds count lines that parser_name failed to parse, of which samples is a list of examples '''
+        errors = self.parse_errors.setdefault(parser_name, {'count': 0, 'samples': []})
+        errors['count'] += count
+        errors['samples'].extend(samples[:max(0, PARSE_ERROR_SAMPLES - len(errors['samples']))])
+
+    def add_stats(self, name, stats):
+        ''' adds a dict of other numbers worth reporting, such as the sizes of parser state tables '''
+        self.stats.setdefault(name, {}).update(stats)
+
+    def get_report(self):
+        return {'command': self.command,
+                'start': self.start_dt.strftime("%Y-%m-%d %H:%M:%S"),
+                'wall_seconds': time.perf_counter() - self.start_wall,
+                'cpu_seconds': get_cpu_seconds() - self.start_cpu,
+                'peak_rss_bytes': get_peak_rss_bytes(),
+                'phases': self.phases,
+                'parse_errors': self.parse_errors,
+                'stats': self.stats}
+
+    def stop(self):
+        ''' writes the JSON report and, if enabled, the cProfile statistics '''
+        if self.cprofile is not None:
+            self.cprofile.disable()
+            self.cprofile.dump_stats(self.cprofile_path)
+            logging.info("wrote cProfile statistics to {0}".format(self.cprofile_path))
+        if self.report_path is not None:
+            with open(self.report_path, 'wt') as f:
+                json.dump(self.get_report(), f, indent=2, sort_keys=True)
+            logging.info("wrote profiling report to {0}".format(self.report_path))
+
+class TimedWritable(object):
+    '''
+    Forwards writes to a util.Writable and adds up the time spent in them,
+    which is the time spent compressing and writing as opposed to encoding.
+    '''
+
+    def __init__(self, writable):
+        self.writable = writable
+        self.write_seconds = 0.0
+
+    def write(self, msg):
+        start = time.perf_counter()
+        self.writable.write(msg)
+        self.write_seconds += time.perf_counter() - start
+
+    def close(self):
+        start = time.perf_counter()
+        self.writable.close()
+        self.write_seconds += time.perf_counter() - start
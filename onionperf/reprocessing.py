@@ -1,74 +1,560 @@
-from onionperf.analysis import OPAnalysis
-from onionperf import util
+from onionperf.analysis import OPAnalysis, AnalysisCache, TGenStreamParser, TorCtlParser, ANALYSIS_REVISION
+from onionperf import util, profiling, jobqueue
+from tgentools._version import __version__ as tgentools_version
 from functools import partial
-from multiprocessing import Pool, cpu_count
+from multiprocessing import Pool, SimpleQueue, TimeoutError, active_children, cpu_count
 import datetime
 import fnmatch
+import hashlib
+import json
 import logging
 import os
 import re
+import signal
 import sys
+import time
+import traceback
+
+try:
+    import resource
+except ImportError:
+    resource = None
 
 
 def collect_logs(dirpath, pattern):
     logs = []
     for root, dirnames, filenames in os.walk(dirpath):
         for filename in fnmatch.filter(sorted(filenames), pattern):
+            if filename.endswith(util.LOG_INDEX_SUFFIX) or filename.endswith(AnalysisCache.SUFFIX):
+                continue
             logs.append(os.path.join(root, filename))
     return logs
 
 
-def match(tgen_logs, tor_logs, date_filter):
-    log_pairs = []
-    for tgen_log in tgen_logs:
-        m = re.search(r'(\d+-\d+-\d+)', tgen_log)
-        if m:
-            date = m.group(0)
-            fdate = datetime.datetime.strptime(date, "%Y-%m-%d")
-            found = False
-            if date_filter is None or util.do_dates_match(date_filter, fdate):
-                for tor_log in tor_logs:
-                    if date in tor_log:
-                        log_pairs.append((tgen_log, tor_log, fdate))
-                        found = True
-                        break
-                if not found:
-                    logging.warning(
-                        'Skipping file {0}, could not find a match for it'.
-                        format(tgen_log))
+# dates in log paths, optionally followed by the time of day at which the log was rotated
+LOG_DATE = re.compile(r'(\d{4})-(\d{2})-(\d{2})(_\d{2}:\d{2}:\d{2})?')
+LOG_KIND = re.compile(r'(tgen|torctl)\.log')
 
-        else:
-            logging.warning(
-                'Filename {0} does not contain a date'.format(tgen_log))
-    if not log_pairs:
+
+def get_log_date(path):
+    '''
+    Returns the date in the file name of path, or else the last date in its
+    directory path, or None if there is no valid date in either.
+    '''
+    matches = list(LOG_DATE.finditer(os.path.basename(path))) or list(LOG_DATE.finditer(os.path.dirname(path)))[-1:]
+    for m in matches:
+        try:
+            return datetime.date(int(m.group(1)), int(m.group(2)), int(m.group(3)))
+        except ValueError:
+            continue
+    return None
+
+
+def get_log_vantage(name):
+    '''
+    Returns a log file name up to the log kind with dates and times left out,
+    which is the same for the tgen and torctl logs that one vantage point wrote
+    on any date, if they are in directories that only differ by date.
+    '''
+    kinds = list(LOG_KIND.finditer(name))
+    stem = name[:kinds[-1].start()] if kinds else name
+    return LOG_DATE.sub('*', stem).rstrip('._-')
+
+
+def index_logs(logs):
+    '''
+    Returns a dict of (vantage, date) -> sorted list of log paths, where the
+    vantage is the directory of a log relative to the directory holding all of
+    them and its file name, without dates, and the date is None for logs
+    without one.
+    '''
+    index = {}
+    if len(logs) == 0:
+        return index
+    root = os.path.commonpath(set(os.path.dirname(log) for log in logs))
+    dir_vantages = {}
+    for log in logs:
+        (dirname, name) = os.path.split(log)
+        if dirname not in dir_vantages:
+            dir_vantages[dirname] = LOG_DATE.sub('*', os.path.relpath(dirname, root))
+        index.setdefault(((dir_vantages[dirname], get_log_vantage(name)), get_log_date(log)), []).append(log)
+    for paths in index.values():
+        paths.sort()
+    return index
+
+
+def get_indexed_dates(log, build_index=False):
+    ''' returns the dates covered by the lines of log according to its time index, or None if it has none '''
+    index = util.LogIndex.load(log)
+    if index is None and build_index:
+        index = util.LogIndex.build(log)
+        index.save()
+    return index.get_dates() if index is not None else None
+
+
+def match(tgen_logs, tor_logs, date_filter, build_index=False):
+    '''
+    Pairs the tgen logs with the torctl logs written by the same vantage point
+    on the same date, which are told apart by the directories and file names
+    of the logs without their dates. Logs without a date in their path are
+    paired by vantage point alone and analyzed for every date in their time
+    index, which is built first if build_index is set. Returns a list of
+    (tgen log, torctl log, date) with the largest amount of log data per date
+    first, so that a process pool working through it stays busy until the end.
+    '''
+    tgen_index = index_logs(tgen_logs)
+    tor_index = index_logs(tor_logs)
+    # the fallback for pairs whose names differ in more than the date, as
+    # long as there is only one tgen and one torctl log for the date
+    tgen_by_date, tor_by_date = {}, {}
+    for (by_date, index) in [(tgen_by_date, tgen_index), (tor_by_date, tor_index)]:
+        for ((_, date), paths) in index.items():
+            by_date.setdefault(date, []).extend(paths)
+
+    jobs = []
+    for ((vantage, date), tgen_paths) in sorted(tgen_index.items(), key=lambda item: (item[0][0], str(item[0][1]))):
+        tor_paths = tor_index.get((vantage, date))
+        if tor_paths is None and date is not None and len(tgen_by_date[date]) == 1 and len(tor_by_date.get(date, [])) == 1:
+            tor_paths = tor_by_date[date]
+        if tor_paths is None or len(tor_paths) != len(tgen_paths):
+            for tgen_log in tgen_paths:
+                logging.warning('Skipping file {0}, could not find a match for it'.format(tgen_log))
+            continue
+        for (tgen_log, tor_log) in zip(tgen_paths, tor_paths):
+            dates = [date] if date is not None else get_indexed_dates(tgen_log, build_index)
+            if dates is None:
+                logging.warning('Filename {0} does not contain a date and the file has no time index'.format(tgen_log))
+                continue
+            dates = [d for d in dates if date_filter is None or util.do_dates_match(date_filter, d)]
+            if len(dates) == 0:
+                continue
+            size = (os.path.getsize(tgen_log) + os.path.getsize(tor_log)) / len(dates)
+            for d in dates:
+                jobs.append((size, tgen_log, tor_log, datetime.datetime(d.year, d.month, d.day)))
+
+    if not jobs:
         logging.warning(
             'Could not find any log matches. No analyses will be performed')
-    return log_pairs
+    jobs.sort(key=lambda job: (-job[0], job[3], job[1]))
+    return [(tgen_log, tor_log, date) for (_, tgen_log, tor_log, date) in jobs]
 
 
-def analyze_func(prefix, nick, pair):
+def analyze_func(prefix, nick, pair, build_index=False, country_lookup=None, save_args=None):
     analysis = OPAnalysis(nickname=nick)
+    analysis.set_country_lookup(country_lookup)
     logging.info('Analysing pair for date {0}'.format(pair[2]))
     analysis.add_tgen_file(pair[0])
     analysis.add_torctl_file(pair[1])
-    analysis.analyze(date_filter=pair[2])
-    analysis.save(output_prefix=prefix)
-    return 1
+    analysis.analyze(date_filter=pair[2], build_index=build_index)
+    return analysis.save(output_prefix=prefix, **(save_args or {}))
+
+
+# how long to wait beyond the task timeout for any result before giving up
+# on the workers, e.g. because one was killed while analyzing a pair
+LOST_WORKER_GRACE_SECONDS = 60
+
+# how often to check whether the workers running pairs are still alive, as
+# the pool replaces a killed worker without ever returning a result for its pair
+WORKER_POLL_SECONDS = 1
 
+# set in each worker process, to tell the pool which worker runs which pair
+_started_queue = None
 
-def multiprocess_logs(log_pairs, prefix, nick=None):
-    pool = Pool(cpu_count())
-    analyses = None
+
+# not an Exception, so that the parsers, which skip lines that fail to parse,
+# do not skip over a timeout that arrives while they handle a line
+class TaskTimeout(BaseException):
+    pass
+
+
+def _raise_task_timeout(signum, frame):
+    raise TaskTimeout("the analysis took longer than the task timeout")
+
+
+def _init_worker(max_memory_bytes, started_queue=None):
+    global _started_queue
+    _started_queue = started_queue
+    # the kernel does not enforce RLIMIT_RSS, so cap the address space, which
+    # makes allocations beyond it raise MemoryError in the task instead
+    if max_memory_bytes is not None and resource is not None:
+        resource.setrlimit(resource.RLIMIT_AS, (max_memory_bytes, resource.getrlimit(resource.RLIMIT_AS)[1]))
+
+
+def _analyze_task(prefix, nick, task, build_index=False, country_lookup=None, save_args=None, task_timeout=None):
+    ''' runs analyze_func in a worker process and returns its outcome instead of raising '''
+    (index, pair) = task
+    if _started_queue is not None:
+        _started_queue.put((index, os.getpid()))
+    result = {'index': index, 'output': None, 'error': None}
+    start = time.perf_counter()
+    use_alarm = task_timeout is not None and hasattr(signal, 'setitimer')
+    if use_alarm:
+        signal.signal(signal.SIGALRM, _raise_task_timeout)
+        signal.setitimer(signal.ITIMER_REAL, task_timeout)
     try:
-        func = partial(analyze_func, prefix, nick)
-        mr = pool.map_async(func, log_pairs)
-        pool.close()
-        while not mr.ready():
-            mr.wait(1)
+        result['output'] = analyze_func(prefix, nick, pair, build_index=build_index, country_lookup=country_lookup, save_args=save_args)
+    except (Exception, TaskTimeout) as e:
+        result['error'] = repr(e)
+        result['traceback'] = traceback.format_exc()
+    finally:
+        if use_alarm:
+            signal.setitimer(signal.ITIMER_REAL, 0)
+    result['seconds'] = time.perf_counter() - start
+    result['peak_rss_bytes'] = profiling.get_peak_rss_bytes()
+    return result
+
+
+def multiprocess_logs(log_pairs, prefix, nick=None, build_index=False, country_lookup=None, save_args=None, manifest=None,
+                      num_workers=None, max_tasks_per_child=None, max_memory_bytes=None, task_timeout=None, retries=1,
+                      summary_path=None):
+    '''
+    Analyzes log_pairs in num_workers processes (one per CPU by default), each
+    of which is replaced after max_tasks_per_child pairs if given. Workers
+    handle pairs as they become free, and progress is logged after each pair.
+    A pair fails if its analysis raises, including MemoryError once a worker
+    exceeds max_memory_bytes of address space and a timeout after task_timeout
+    seconds. Failed pairs are analyzed again, up to retries more times. So are
+    pairs whose worker vanished without a result, e.g. because the system
+    killed it for using too much memory. If no pair finishes within
+    task_timeout plus a grace period, the workers are assumed to be stuck,
+    and the unfinished pairs fail.
+
+    Returns a summary of the outcome of each pair, which is also written to
+    summary_path as JSON if given.
+    '''
+    num_workers = num_workers or cpu_count()
+    start = time.perf_counter()
+    tasks = [{'tgen': pair[0], 'torctl': pair[1], 'date': util.date_to_string(pair[2]), 'status': 'pending', 'attempts': 0,
+              'seconds': 0.0, 'output': None, 'error': None} for pair in log_pairs]
+    todo = list(range(len(log_pairs)))
+    attempt = 0
+    while len(todo) > 0 and attempt <= retries:
+        if attempt > 0:
+            logging.info("retrying {0} failed log pairs, attempt {1} of {2}".format(len(todo), attempt + 1, retries + 1))
+        todo = _run_pool(log_pairs, todo, tasks, prefix, nick, build_index, country_lookup, save_args, manifest,
+                         num_workers, max_tasks_per_child, max_memory_bytes, task_timeout)
+        attempt += 1
+
+    succeeded = [task for task in tasks if task['status'] == 'ok']
+    failed = [task for task in tasks if task['status'] != 'ok']
+    for task in failed:
+        logging.error("Giving up on pair for date {0} ({1}, {2}) after {3} attempts: {4}".format(
+            task['date'], task['tgen'], task['torctl'], task['attempts'], task['error']))
+    summary = {'pairs': len(tasks), 'succeeded': len(succeeded), 'failed': len(failed),
+               'wall_seconds': time.perf_counter() - start, 'tasks': tasks}
+    logging.info("Reprocessed {0} log pairs in {1:.1f} seconds, {2} failed".format(len(tasks), summary['wall_seconds'], len(failed)))
+    if summary_path is not None:
+        with open(summary_path, 'wt') as f:
+            json.dump(summary, f, indent=2, sort_keys=True)
+        logging.info("wrote reprocessing summary to {0}".format(summary_path))
+    return summary
+
+
+def _run_pool(log_pairs, todo, tasks, prefix, nick, build_index, country_lookup, save_args, manifest,
+              num_workers, max_tasks_per_child, max_memory_bytes, task_timeout):
+    ''' analyzes the pairs at the indices in todo in a new pool and returns the indices of those that failed '''
+    # written without a feeder thread, so that a worker killed right after
+    # starting a pair has still reported it
+    started_queue = SimpleQueue()
+    pool = Pool(min(num_workers, len(todo)), initializer=_init_worker, initargs=(max_memory_bytes, started_queue),
+                maxtasksperchild=max_tasks_per_child)
+    func = partial(_analyze_task, prefix, nick, build_index=build_index, country_lookup=country_lookup, save_args=save_args,
+                   task_timeout=task_timeout)
+    wait_seconds = task_timeout + LOST_WORKER_GRACE_SECONDS if task_timeout is not None else None
+    start = last_result = time.perf_counter()
+    pending = set(todo)
+    failed = []
+    # the worker pid of each pending pair that started, and the pairs whose
+    # worker was gone without a result at the last poll
+    running, vanished = {}, set()
+    lost_workers = False
+    try:
+        results = pool.imap_unordered(func, [(index, log_pairs[index]) for index in todo])
+        while len(pending) > 0:
+            _read_started(started_queue, pending, running)
+            try:
+                result = results.next(timeout=WORKER_POLL_SECONDS)
+            except TimeoutError:
+                for index in _find_lost_pairs(running, vanished):
+                    logging.warning("The worker analysing pair for date {0} ({1}) was lost".format(tasks[index]['date'], tasks[index]['tgen']))
+                    tasks[index].update(status='failed', error="the worker was lost while analysing the pair")
+                    tasks[index]['attempts'] += 1
+                    pending.discard(index)
+                    failed.append(index)
+                    lost_workers = True
+                if wait_seconds is not None and len(pending) > 0 and time.perf_counter() - last_result >= wait_seconds:
+                    logging.error("No log pair finished within {0} seconds, giving up on the workers".format(wait_seconds))
+                    for index in pending:
+                        tasks[index].update(status='failed', error="the worker stopped responding")
+                        tasks[index]['attempts'] += 1
+                    failed.extend(pending)
+                    pool.terminate()
+                    pool.join()
+                    return failed
+                continue
+            last_result = time.perf_counter()
+            index = result['index']
+            pending.discard(index)
+            running.pop(index, None)
+            vanished.discard(index)
+            task = tasks[index]
+            task['attempts'] += 1
+            task['seconds'] = result['seconds']
+            task['peak_rss_bytes'] = result['peak_rss_bytes']
+            if result['error'] is None:
+                task.update(status='ok', output=result['output'], error=None)
+                # record each pair as soon as it is done, so that an interrupted
+                # run does not have to analyze it again
+                if manifest is not None:
+                    manifest.add(log_pairs[index], result['output'])
+                    manifest.save()
+            else:
+                task.update(status='failed', error=result['error'])
+                failed.append(index)
+                logging.warning("Analysing pair for date {0} ({1}) failed: {2}".format(task['date'], task['tgen'], result['traceback']))
+            done = len(todo) - len(pending)
+            elapsed = time.perf_counter() - start
+            logging.info("Finished {0} of {1} log pairs, {2} failed, about {3} left".format(
+                done, len(todo), len(failed), datetime.timedelta(seconds=int(elapsed / done * len(pending)))))
+        if lost_workers:
+            # the pool still waits for the results of the lost pairs, so
+            # closing it would wait forever
+            pool.terminate()
+        else:
+            pool.close()
+        pool.join()
     except KeyboardInterrupt:
         logging.info("interrupted, terminating process pool")
         pool.terminate()
         pool.join()
         sys.exit()
-    except Exception as e:
-        logging.error(e)
+    return failed
+
+
+def _read_started(started_queue, pending, running):
+    while not started_queue.empty():
+        (index, pid) = started_queue.get()
+        # a pair may start again after a lost worker, or finish before its start was read
+        if index in pending:
+            running[index] = pid
+
+
+def _find_lost_pairs(running, vanished):
+    '''
+    Returns the indices of the running pairs whose worker is gone and did not
+    return a result within a poll interval, which a result that the worker
+    sent right before it exited, e.g. after max_tasks_per_child, would have.
+    '''
+    alive = set(process.pid for process in active_children())
+    lost = []
+    for (index, pid) in list(running.items()):
+        if pid in alive:
+            continue
+        if index not in vanished:
+            vanished.add(index)
+            continue
+        del running[index]
+        vanished.discard(index)
+        lost.append(index)
+    return lost
+
+
+def process_queue(queue, prefix, nick=None, build_index=False, country_lookup=None, save_args=None, num_workers=1):
+    '''
+    Analyzes the pairs in the jobqueue.JobQueue queue in num_workers processes
+    on this host until the queue is drained, while any number of processes on
+    other hosts may be doing the same, and returns the numbers of jobs that
+    the processes on this host completed and failed.
+    '''
+    func = partial(analyze_func, prefix, nick, build_index=build_index, country_lookup=country_lookup, save_args=save_args)
+    if num_workers <= 1:
+        return jobqueue.run_worker(queue, func)
+    with Pool(num_workers) as pool:
+        worker_counts = pool.starmap(jobqueue.run_worker, [(queue, func)] * num_workers)
+    return {key: sum(counts[key] for counts in worker_counts) for key in ('completed', 'failed')}
+
+
+def get_archive_log_key(name):
+    '''
+    Returns the kind, vantage point and date of the log that is the archive
+    member called name, where the vantage point is the directory and file
+    name of the member without dates, or None if name is not a dated log.
+    '''
+    (dirname, basename) = os.path.split(name)
+    kinds = list(LOG_KIND.finditer(basename))
+    date = get_log_date(name)
+    if not kinds or date is None or name.endswith(util.LOG_INDEX_SUFFIX):
+        return None
+    return (kinds[-1].group(1), (LOG_DATE.sub('*', dirname), get_log_vantage(basename)), date)
+
+
+def _analyze_parsed_pair(prefix, nick, tgen_parser, torctl_parser, date, country_lookup=None, save_args=None):
+    analysis = OPAnalysis(nickname=nick)
+    analysis.set_country_lookup(country_lookup)
+    logging.info('Analysing pair for date {0}'.format(date))
+    analysis.add_tgen_parser(tgen_parser)
+    analysis.add_torctl_parser(torctl_parser)
+    analysis.analyze(date_filter=datetime.datetime(date.year, date.month, date.day))
+    return analysis.save(output_prefix=prefix, **(save_args or {}))
+
+
+def analyze_archives(archive_paths, prefix, nick=None, date_filter=None, country_lookup=None, save_args=None):
+    '''
+    Analyzes the tgen and torctl logs in the tar archives at archive_paths
+    without extracting them, reading each archive front to back only once and
+    parsing each log for the date in its name while it streams past. Logs are
+    paired by the directories and file names of the members without their
+    dates and kinds, and analyzed as soon as both halves of a pair were read,
+    so that only the parsed logs still waiting for their other half are kept.
+    Logs left over at the end are paired by date alone if there is only one
+    tgen and one torctl log left for the date. Members without a date in their
+    names are skipped, as there is no time index to find their dates with.
+    Returns the paths of the analysis results.
+    '''
+    parsed = {'tgen': {}, 'torctl': {}}
+    seen = {'tgen': set(), 'torctl': set()}
+    outputs = []
+
+    def analyze_pair(tgen_key, torctl_key):
+        tgen_parser, torctl_parser = parsed['tgen'].pop(tgen_key), parsed['torctl'].pop(torctl_key)
+        try:
+            outputs.append(_analyze_parsed_pair(prefix, nick, tgen_parser, torctl_parser, tgen_key[1],
+                                                country_lookup=country_lookup, save_args=save_args))
+        except Exception:
+            logging.warning('Analysis of logs for {0} failed: {1}'.format(tgen_key[1], traceback.format_exc()))
+
+    for archive_path in archive_paths:
+        logging.info("reading log files from archive {0}".format(archive_path))
+        for source in util.iter_archive_members(archive_path):
+            log_key = get_archive_log_key(source.member_name)
+            if log_key is None:
+                continue
+            (kind, vantage, date) = log_key
+            if date_filter is not None and not util.do_dates_match(date_filter, date):
+                continue
+            if (vantage, date) in seen[kind]:
+                logging.warning('Skipping file {0}, a {1} log of the same vantage point and date came first'.format(source.filename, kind))
+                continue
+            seen[kind].add((vantage, date))
+            logging.info("parsing log file at {0}".format(source.filename))
+            try:
+                if kind == 'tgen':
+                    parser = TGenStreamParser(date_filter=date)
+                    parser.parse(source, do_complete=True)
+                else:
+                    parser = TorCtlParser(date_filter=date)
+                    parser.parse(source)
+            except Exception:
+                # one broken log should not end the only pass over the archive
+                logging.warning('Skipping file {0}, parsing it failed: {1}'.format(source.filename, traceback.format_exc()))
+                continue
+            finally:
+                source.close()
+            parsed[kind][(vantage, date)] = parser
+            if (vantage, date) in parsed['tgen'] and (vantage, date) in parsed['torctl']:
+                analyze_pair((vantage, date), (vantage, date))
+
+    # the fallback for pairs whose names differ in more than the date
+    for tgen_key in sorted(parsed['tgen'], key=lambda key: (key[1], key[0])):
+        tgen_keys = [key for key in parsed['tgen'] if key[1] == tgen_key[1]]
+        torctl_keys = [key for key in parsed['torctl'] if key[1] == tgen_key[1]]
+        if len(tgen_keys) == 1 and len(torctl_keys) == 1:
+            analyze_pair(tgen_key, torctl_keys[0])
+    for kind in parsed:
+        for (vantage, date) in sorted(parsed[kind], key=lambda key: (key[1], key[0])):
+            logging.warning('Skipping {0} log of {1} for {2}, could not find a match for it'.format(kind, os.path.join(*vantage), date))
+    if not outputs:
+        logging.warning('Could not analyze any log pairs in archives {0}'.format(", ".join(archive_paths)))
+    return outputs
+
+
+def get_log_fingerprint(path, do_hash=False):
+    stat = os.stat(path)
+    fingerprint = {'path': os.path.abspath(path), 'size': stat.st_size, 'mtime': stat.st_mtime}
+    if do_hash:
+        digest = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for block in iter(partial(f.read, 1 << 20), b''):
+                digest.update(block)
+        fingerprint['sha256'] = digest.hexdigest()
+    return fingerprint
+
+
+class ReprocessingManifest(object):
+    '''
+    Records, in the output directory of a reprocessing run, the size and
+    mtime (and optionally the SHA-256 hash) of the logs each analysis was
+    made from, along with the analysis version and revision and the options
+    that change the output, so that the next run only analyzes the log pairs
+    that are new, have changed, or were analyzed differently.
+    '''
+    VERSION = 1
+    FILENAME = "onionperf.reprocessing.manifest.json"
+
+    def __init__(self, prefix, nick=None, do_hash=False, build_index=False, save_args=None):
+        self.prefix = prefix
+        self.path = os.path.join(prefix, ReprocessingManifest.FILENAME)
+        self.do_hash = do_hash
+        save_args = save_args or {}
+        # the save arguments that change the output file, with OPAnalysis.save's defaults
+        self.codec = save_args.get('codec', 'xz')
+        self.options = {'analysis_version': OPAnalysis().json_db['version'], 'analysis_revision': ANALYSIS_REVISION,
+                        'tgentools_version': tgentools_version, 'nickname': nick, 'build_index': build_index,
+                        'save_args': {'codec': self.codec, 'level': save_args.get('level'), 'indent': save_args.get('indent', 2)}}
+        self.entries = {}
+        self.fingerprints = {}
+        if os.path.exists(self.path):
+            try:
+                with open(self.path, 'rt') as f:
+                    manifest = json.load(f)
+                if manifest.get('version') == ReprocessingManifest.VERSION:
+                    self.entries = manifest['entries']
+            except (ValueError, KeyError) as e:
+                logging.warning("ignoring unreadable manifest at {0}: {1}".format(self.path, repr(e)))
+
+    def __get_key(self, pair):
+        return "{0}:{1}:{2}".format(util.date_to_string(pair[2]), os.path.abspath(pair[0]), os.path.abspath(pair[1]))
+
+    def __get_fingerprints(self, pair):
+        key = self.__get_key(pair)
+        if key not in self.fingerprints:
+            self.fingerprints[key] = {'tgen': get_log_fingerprint(pair[0], self.do_hash),
+                                      'torctl': get_log_fingerprint(pair[1], self.do_hash)}
+        return self.fingerprints[key]
+
+    def is_current(self, pair):
+        '''
+        returns True if pair was analyzed with the same options since its logs
+        last changed, to the output path this run would write, which still exists
+        '''
+        entry = self.entries.get(self.__get_key(pair))
+        if entry is None or entry['options'] != self.options:
+            return False
+        output_path = OPAnalysis.get_output_path(self.prefix, date=pair[2], codec=self.codec)
+        if entry['output'] != output_path or not os.path.exists(output_path):
+            return False
+        return entry['logs'] == self.__get_fingerprints(pair)
+
+    def add(self, pair, output_path):
+        # the fingerprints taken when planning, so that logs changed during the run are analyzed again next time
+        self.entries[self.__get_key(pair)] = {'logs': self.__get_fingerprints(pair), 'options': self.options, 'output': output_path}
+
+    def save(self):
+        tmp_path = "{0}.{1}.tmp".format(self.path, os.getpid())
+        with open(tmp_path, 'wt') as f:
+            json.dump({'version': ReprocessingManifest.VERSION, 'entries': self.entries}, f, indent=2, sort_keys=True)
+        os.replace(tmp_path, self.path)
+
+
+def plan_reprocessing(log_pairs, manifest, force=False):
+    '''
+    Splits log_pairs into those that need to be analyzed and those that the
+    manifest shows are already analyzed, analyzing all of them if force is set.
+    '''
+    todo, skipped = [], []
+    for pair in log_pairs:
+        if not force and manifest.is_current(pair):
+            skipped.append(pair)
+        else:
+            todo.append(pair)
+    return todo, skipped
@@ -0,0 +1,184 @@
+'''
+  OnionPerf
+  Authored by Rob Jansen, 2015
+  Copyright 2015-2020 The Tor Project
+  See LICENSE for licensing information
+'''
+
+import math
+
+# the measurements that are summarized per hour, server type and file size
+METRICS = ("ttfb", "ttlb", "mbps")
+
+class DDSketch(object):
+    '''
+    A quantile sketch whose quantiles are within relative_accuracy of the
+    exact ones, and which merges exactly with other sketches of the same
+    relative accuracy by adding up their bins. Values are counted in bins
+    whose bounds grow geometrically, as in Masson et al., "DDSketch: A Fast
+    and Fully-Mergeable Quantile Sketch with Relative-Error Guarantees".
+    Values of zero and below are counted separately and reported as 0.
+    '''
+
+    def __init__(self, relative_accuracy=0.01):
+        self.relative_accuracy = relative_accuracy
+        self.gamma = (1.0 + relative_accuracy) / (1.0 - relative_accuracy)
+        self.log_gamma = math.log(self.gamma)
+        self.bins = {}
+        self.zero_count = 0
+        self.count = 0
+        self.min = None
+        self.max = None
+        self.sum = 0.0
+
+    def add(self, value):
+        if value > 0:
+            index = int(math.ceil(math.log(value) / self.log_gamma))
+            self.bins[index] = self.bins.get(index, 0) + 1
+        else:
+            self.zero_count += 1
+        self.count += 1
+        self.sum += value
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+
+    def merge(self, other):
+        if other.relative_accuracy != self.relative_accuracy:
+            raise ValueError("cannot merge sketches with relative accuracies {0} and {1}".format(self.relative_accuracy, other.relative_accuracy))
+        for (index, count) in other.bins.items():
+            self.bins[index] = self.bins.get(index, 0) + count
+        self.zero_count += other.zero_count
+        self.count += other.count
+        self.sum += other.sum
+        if other.min is not None:
+            self.min = other.min if self.min is None else min(self.min, other.min)
+            self.max = other.max if self.max is None else max(self.max, other.max)
+
+    def get_quantile(self, q):
+        ''' returns the value at quantile q in [0, 1], or None if the sketch is empty '''
+        if self.count == 0:
+            return None
+        rank = q * (self.count - 1)
+        if rank < self.zero_count:
+            return 0.0
+        cumulative = self.zero_count
+        for index in sorted(self.bins):
+            cumulative += self.bins[index]
+            if cumulative > rank:
+                # the value in the middle of the bin, relative to its bounds
+                value = 2.0 * self.gamma ** index / (self.gamma + 1.0)
+                return min(max(value, self.min), self.max)
+        return self.max
+
+    def get_data(self):
+        return {'count': self.count, 'zero_count': self.zero_count, 'sum': self.sum, 'min': self.min, 'max': self.max,
+                'bins': {str(index): count for (index, count) in self.bins.items()}}
+
+    @classmethod
+    def from_data(cls, data, relative_accuracy):
+        sketch = cls(relative_accuracy)
+        sketch.count, sketch.zero_count, sketch.sum = data['count'], data['zero_count'], data['sum']
+        sketch.min, sketch.max = data['min'], data['max']
+        sketch.bins = {int(index): count for (index, count) in data['bins'].items()}
+        return sketch
+
+# Explanation of the math below for computing Mbps: For 1 MiB downloads we
+# extract the number of seconds that have elapsed between receiving bytes
+# 524,288 and 1,048,576, which is a total amount of 524,288 bytes or 4,194,304
+# bits or 4.194304 megabits. For 5 MiB downloads we extract the number of
+# seconds that have elapsed between receiving bytes 4,194,304 and 5,242,880,
+# which is a total amount of 1,048,576 bytes or 8,388,608 bits or 8.388608
+# megabits. We want the reciprocal of that value with unit megabits per second.
+
+def get_stream_metrics(stream_data):
+    '''
+    Returns {metric: value} with the time to first and last byte in seconds
+    and the Mbps of a TGen stream, for those of them that it has.
+    '''
+    values = {}
+    s = stream_data.get("time_info", {})
+    if "usecs-to-first-byte-recv" in s and float(s["usecs-to-first-byte-recv"]) >= 0:
+        values["ttfb"] = float(s["usecs-to-first-byte-recv"]) / 1000000
+    if "usecs-to-last-byte-recv" in s and float(s["usecs-to-last-byte-recv"]) >= 0:
+        values["ttlb"] = float(s["usecs-to-last-byte-recv"]) / 1000000
+    s = stream_data.get("elapsed_seconds", {})
+    if stream_data["stream_info"]["recvsize"] == "5242880" and "1.0" in s.get("payload_progress_recv", {}):
+        try:
+            values["mbps"] = 8.388608 / (s["payload_progress_recv"]["1.0"] - s["payload_progress_recv"]["0.8"])
+        except ZeroDivisionError:
+            values["mbps"] = 8.388608
+    return values
+
+def get_transfer_metrics(transfer_data):
+    '''
+    Returns {metric: value} with the time to first and last byte in seconds
+    and the Mbps of a TGen transfer, for those of them that it has.
+    '''
+    values = {}
+    s = transfer_data.get("elapsed_seconds", {})
+    if "payload_progress" in s:
+        if transfer_data["filesize_bytes"] == 1048576 and "1.0" in s["payload_progress"]:
+            values["mbps"] = 4.194304 / (s["payload_progress"]["1.0"] - s["payload_progress"]["0.5"])
+        if transfer_data["filesize_bytes"] == 5242880 and "1.0" in s["payload_progress"]:
+            values["mbps"] = 8.388608 / (s["payload_progress"]["1.0"] - s["payload_progress"]["0.8"])
+    if "first_byte" in s:
+        values["ttfb"] = s["first_byte"]
+    if "last_byte" in s:
+        values["ttlb"] = s["last_byte"]
+    return values
+
+def get_measurements(tgen_data):
+    '''
+    Yields (unix_ts_start, server, filesize_bytes, {metric: value}) for each
+    successful TGen stream or transfer in tgen_data, where server is "onion"
+    or "public", with the same metrics as the visualization.
+    '''
+    for stream_data in (tgen_data.get("streams") or {}).values():
+        if stream_data["stream_info"].get("error", "NONE") != "NONE" or "unix_ts_start" not in stream_data:
+            continue
+        server = "onion" if ".onion:" in stream_data["transport_info"]["remote"] else "public"
+        yield (stream_data["unix_ts_start"], server, int(stream_data["stream_info"]["recvsize"]), get_stream_metrics(stream_data))
+    for transfer_data in (tgen_data.get("transfers") or {}).values():
+        if transfer_data.get("error_code", "NONE") != "NONE" or "unix_ts_start" not in transfer_data:
+            continue
+        server = "onion" if ".onion:" in transfer_data["endpoint_remote"] else "public"
+        yield (transfer_data["unix_ts_start"], server, transfer_data["filesize_bytes"], get_transfer_metrics(transfer_data))
+
+def build_hourly_sketches(tgen_data, relative_accuracy=0.01):
+    '''
+    Summarizes the successful measurements in tgen_data in one DDSketch per
+    hour, server type, file size and metric, in the shape stored in the
+    'sketches' section of an analysis:
+    {'relative_accuracy': a, 'hours': {hour_ts: {server: {filesize: {metric: sketch}}}}}
+    '''
+    hours = {}
+    for (unix_ts_start, server, filesize_bytes, values) in get_measurements(tgen_data):
+        hour = str(int(unix_ts_start // 3600 * 3600))
+        by_metric = hours.setdefault(hour, {}).setdefault(server, {}).setdefault(str(filesize_bytes), {})
+        for (metric, value) in values.items():
+            by_metric.setdefault(metric, DDSketch(relative_accuracy)).add(value)
+    return {'relative_accuracy': relative_accuracy,
+            'hours': {hour: {server: {filesize: {metric: sketch.get_data() for (metric, sketch) in by_metric.items()}
+                                      for (filesize, by_metric) in by_filesize.items()}
+                             for (server, by_filesize) in by_server.items()}
+                      for (hour, by_server) in hours.items()}}
+
+def merge_hourly_sketches(sketches_data, merged=None, start_ts=None, end_ts=None):
+    '''
+    Merges the hourly sketches of an analysis' 'sketches' section whose hour
+    starts in [start_ts, end_ts) into merged, a dict of
+    (server, filesize_bytes, metric) -> DDSketch, which is returned.
+    '''
+    merged = {} if merged is None else merged
+    relative_accuracy = sketches_data['relative_accuracy']
+    for (hour, by_server) in sketches_data['hours'].items():
+        if (start_ts is not None and int(hour) < start_ts) or (end_ts is not None and int(hour) >= end_ts):
+            continue
+        for (server, by_filesize) in by_server.items():
+            for (filesize, by_metric) in by_filesize.items():
+                for (metric, data) in by_metric.items():
+                    key = (server, int(filesize), metric)
+                    if key not in merged:
+                        merged[key] = DDSketch(relative_accuracy)
+                    merged[key].merge(DDSketch.from_data(data, relative_accuracy))
+    return merged
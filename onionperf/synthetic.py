@@ -0,0 +1,269 @@
+'''
+  OnionPerf
+  Authored by Rob Jansen, 2015
+  Copyright 2015-2020 The Tor Project
+  See LICENSE for licensing information
+'''
+
+import datetime, heapq, logging, math, os, random
+
+from . import util
+
+# the file sizes that the default OnionPerf TGen model downloads
+FILESIZES = (51200, 1048576, 5242880)
+
+class SyntheticLogGenerator(object):
+    '''
+    Writes a TGen log and a torctl log that look like those of an OnionPerf
+    instance measuring for a number of days, for benchmarks at scales that
+    the test logs do not reach. Everything is derived from seed, so the same
+    arguments always give the same logs.
+
+    Measurements alternate between the public and the onion server, and a
+    failure_rate fraction of them fails, either because the stream cannot be
+    attached to a circuit or because it times out halfway. Besides the
+    measurement circuits, tor builds circuits_per_hour circuits of its own,
+    some of which fail as well. guard_churn_per_day of the client's three
+    entry guards are replaced per day on average. Like the real logs, the
+    torctl log has a BW event and the TGen log a heartbeat per second, and
+    the circuits still open when the logs end are never closed.
+    '''
+
+    def __init__(self, seed=1, days=1, transfers_per_hour=12, failure_rate=0.05, guard_churn_per_day=1.0,
+                 circuits_per_hour=30, relays=500, start_date=datetime.date(2021, 1, 1), nickname="op-synthetic",
+                 filesizes=FILESIZES):
+        self.seed = seed
+        self.days = days
+        self.transfers_per_hour = transfers_per_hour
+        self.failure_rate = failure_rate
+        self.guard_churn_per_day = guard_churn_per_day
+        self.circuits_per_hour = circuits_per_hour
+        self.num_relays = relays
+        self.start_ts = (datetime.datetime.combine(start_date, datetime.time()) - datetime.datetime(1970, 1, 1)).total_seconds()
+        self.end_ts = self.start_ts + days * 86400
+        self.nickname = nickname
+        self.filesizes = filesizes
+
+    def write(self, tgen_path, torctl_path, codec='plain'):
+        '''
+        Writes the logs to tgen_path and torctl_path, compressed with codec,
+        and returns the number of transfers, failed transfers, and lines
+        written to each log.
+        '''
+        self.rng = random.Random(self.seed)
+        self.relays = ["${0:040X}~relay{1}".format(self.rng.getrandbits(160), i) for i in range(self.num_relays)]
+        self.guards = [self.__new_guard() for _ in range(3)]
+        self.onion_address = "".join(self.rng.choice("abcdefghijklmnopqrstuvwxyz234567") for _ in range(56))
+        self.stats = {'transfers': 0, 'failures': 0, 'tgen_lines': 0, 'torctl_lines': 0}
+        self.next_circ_id = 1
+        self.next_stream_id = 1
+        self.cbt_timeout_ms = None
+        # lines that lie in the future, as (unix_ts, sequence number, line) heaps
+        self.tgen_pending, self.torctl_pending = [], []
+        self.sequence = 0
+
+        with util.get_codec(codec).open(tgen_path, 'wt', newline='') as tgen_file, \
+                util.get_codec(codec).open(torctl_path, 'wt', newline='') as torctl_file:
+            self.__generate(tgen_file, torctl_file)
+        logging.info("wrote {0} transfers ({1} failed) to {2} and {3}".format(self.stats['transfers'], self.stats['failures'], tgen_path, torctl_path))
+        return self.stats
+
+    def __generate(self, tgen_file, torctl_file):
+        self.__torctl(self.start_ts, "Starting torctl program on host {0} using Tor version 0.4.5.7 status=recommended\n".format(self.nickname))
+        self.__torctl(self.start_ts, "NOTICE BOOTSTRAP PROGRESS=100 TAG=done SUMMARY=\"Done\"\n")
+        self.__tgen(self.start_ts, "[message] [tgen-main.c:95] [_tgenmain_run] Initializing TGen v1.0.0 running GLib v2.56.4 and IGraph v0.7.1 on host {0} process id 1234".format(self.nickname))
+        for guard in self.guards:
+            self.__torctl_event(self.start_ts + 0.1, "GUARD ENTRY {0} NEW".format(guard))
+            self.__torctl_event(self.start_ts + 0.2, "GUARD ENTRY {0} UP".format(guard))
+
+        transfer_interval = 3600.0 / self.transfers_per_hour if self.transfers_per_hour > 0 else None
+        next_transfer = self.start_ts + 60.0
+        circuit_interval = 3600.0 / self.circuits_per_hour if self.circuits_per_hour > 0 else None
+        next_circuit = self.start_ts + 1.0
+        # tor learns its circuit build timeout a few minutes after starting, and updates it every hour
+        next_cbt = self.start_ts + 600.0
+        second = int(self.start_ts)
+        while second < self.end_ts:
+            self.__torctl_event(second + 0.01, "BW {0} {1}".format(self.rng.randint(2000, 60000), self.rng.randint(1000, 20000)))
+            self.__tgen(second + 0.5, "[message] [tgen-driver.c:103] [_tgendriver_onHeartbeat] [driver-heartbeat] "
+                        "[bytes-read={0},bytes-written={1},total-streams-succeeded={2},total-streams-failed={3}]".format(
+                            self.rng.randint(0, 1 << 20), self.rng.randint(0, 4096),
+                            self.stats['transfers'] - self.stats['failures'], self.stats['failures']))
+            if second >= next_cbt:
+                self.__build_timeout(next_cbt)
+                next_cbt += 3600.0
+            if self.guard_churn_per_day > 0 and self.rng.random() < self.guard_churn_per_day / 86400.0:
+                self.__replace_guard(second + self.rng.random())
+            while circuit_interval is not None and next_circuit < second + 1:
+                self.__circuit(next_circuit, "GENERAL", None)
+                next_circuit += self.rng.expovariate(1.0 / circuit_interval)
+            # measurements end within two minutes, so that every one started also ends in the logs
+            while transfer_interval is not None and next_transfer < min(second + 1, self.end_ts - 120.0):
+                self.__transfer(next_transfer)
+                next_transfer += transfer_interval * self.rng.uniform(0.9, 1.1)
+            self.__flush(self.tgen_pending, tgen_file, second, 'tgen_lines')
+            self.__flush(self.torctl_pending, torctl_file, second, 'torctl_lines')
+            second += 1
+        self.__flush(self.tgen_pending, tgen_file, self.end_ts, 'tgen_lines')
+        self.__flush(self.torctl_pending, torctl_file, self.end_ts, 'torctl_lines')
+
+    def __flush(self, pending, f, until_ts, stats_key):
+        ''' writes the pending lines before until_ts in order, and drops those after the end of the logs '''
+        while pending and pending[0][0] < until_ts:
+            (unix_ts, _, line) = heapq.heappop(pending)
+            if unix_ts < self.end_ts:
+                f.write(line)
+                self.stats[stats_key] += 1
+
+    def __push(self, pending, unix_ts, line):
+        self.sequence += 1
+        heapq.heappush(pending, (unix_ts, self.sequence, line))
+
+    def __tgen(self, unix_ts, message):
+        dt = datetime.datetime.utcfromtimestamp(unix_ts)
+        self.__push(self.tgen_pending, unix_ts, "{0} {1:.6f} {2}\n".format(dt.strftime("%Y-%m-%d %H:%M:%S"), unix_ts, message))
+
+    def __torctl(self, unix_ts, message):
+        dt = datetime.datetime.utcfromtimestamp(unix_ts)
+        self.__push(self.torctl_pending, unix_ts, "{0} {1:.02f} {2}".format(dt.strftime("%Y-%m-%d %H:%M:%S"), unix_ts, message))
+
+    def __torctl_event(self, unix_ts, content):
+        self.__torctl(unix_ts, "650 {0}\r\n".format(content))
+
+    def __new_guard(self):
+        return self.rng.choice(self.relays)
+
+    def __replace_guard(self, unix_ts):
+        index = self.rng.randrange(len(self.guards))
+        self.__torctl_event(unix_ts, "GUARD ENTRY {0} DROPPED".format(self.guards[index]))
+        self.guards[index] = self.__new_guard()
+        self.__torctl_event(unix_ts + 0.5, "GUARD ENTRY {0} NEW".format(self.guards[index]))
+        self.__torctl_event(unix_ts + 1.0, "GUARD ENTRY {0} UP".format(self.guards[index]))
+
+    def __build_timeout(self, unix_ts):
+        self.cbt_timeout_ms = int(self.rng.lognormvariate(math.log(1500), 0.2))
+        self.__torctl_event(unix_ts, "BUILDTIMEOUT_SET COMPUTED TOTAL_TIMES=1000 TIMEOUT_MS={0} XM=797 ALPHA=1.470 CUTOFF_QUANTILE=0.800 "
+                            "TIMEOUT_RATE=0.141 CLOSE_MS=60000 CLOSE_RATE=0.012".format(self.cbt_timeout_ms))
+
+    def __circuit(self, unix_ts, purpose, hs_state, lifetime=None):
+        '''
+        Logs the events of a circuit launched at unix_ts and returns
+        (circuit id, unix_ts when built), or (circuit id, None) if it failed.
+        '''
+        circ_id = self.next_circ_id
+        self.next_circ_id += 1
+        created = datetime.datetime.utcfromtimestamp(unix_ts).strftime("%Y-%m-%dT%H:%M:%S.%f")
+        flags = "BUILD_FLAGS=NEED_CAPACITY PURPOSE={0}{1} TIME_CREATED={2}".format(
+            purpose, " HS_STATE={0}".format(hs_state) if hs_state else "", created)
+        self.__torctl_event(unix_ts, "CIRC {0} LAUNCHED {1}".format(circ_id, flags))
+        path = [self.guards[0]] + self.rng.sample(self.relays, 2)
+        hop_ts = unix_ts
+        for i in range(len(path)):
+            hop_ts += self.rng.lognormvariate(math.log(0.15), 0.5)
+            if i == 2 and self.rng.random() < self.failure_rate:
+                self.__torctl_event(hop_ts, "CIRC {0} FAILED {1} {2} REASON=TIMEOUT".format(circ_id, ",".join(path[:i]), flags))
+                return (circ_id, None)
+            self.__torctl_event(hop_ts, "CIRC {0} EXTENDED {1} {2}".format(circ_id, ",".join(path[:i + 1]), flags))
+        built_ts = hop_ts + 0.01
+        if hs_state is not None:
+            flags = flags.replace("HS_STATE={0}".format(hs_state), "HS_STATE=HSCR_JOINED REND_QUERY={0}".format(self.onion_address))
+        self.__torctl_event(built_ts, "CIRC {0} BUILT {1} {2}".format(circ_id, ",".join(path), flags))
+        # tor closes clean circuits after an hour and used ones ten minutes after their last stream
+        closed_ts = built_ts + (lifetime if lifetime is not None else self.rng.uniform(60.0, 3600.0))
+        self.__torctl_event(closed_ts, "CIRC {0} CLOSED {1} {2} REASON=FINISHED".format(circ_id, ",".join(path), flags))
+        return (circ_id, built_ts)
+
+    def __transfer(self, unix_ts):
+        ''' logs the TGen stream and the tor circuit and stream of a measurement started at unix_ts '''
+        self.stats['transfers'] += 1
+        transfer_id = self.stats['transfers']
+        onion = transfer_id % 2 == 1
+        filesize = self.filesizes[(transfer_id // 2) % len(self.filesizes)]
+        port = 30000 + transfer_id % 30000
+        if onion:
+            remote = "{0}.onion:0.0.0.0:8080".format(self.onion_address)
+            target = "{0}.onion:8080".format(self.onion_address)
+        else:
+            remote = "op-synthetic.example.org:203.0.113.10:443"
+            target = "203.0.113.10:443"
+
+        # the stream waits for a circuit, then for the connection to the server
+        stream_id = self.next_stream_id
+        self.next_stream_id += 1
+        self.__torctl_event(unix_ts + 0.001, "STREAM {0} NEW 0 {1} SOURCE_ADDR=127.0.0.1:{2} PURPOSE=USER".format(stream_id, target, port))
+        (circ_id, built_ts) = self.__circuit(unix_ts, "HS_CLIENT_REND" if onion else "GENERAL", "HSCR_CONNECTING" if onion else None,
+                                             lifetime=self.rng.uniform(600.0, 660.0))
+        failed = built_ts is None or self.rng.random() < self.failure_rate / 2
+        times = {'usecs-to-socket-create': 12, 'usecs-to-socket-connect': 250, 'usecs-to-proxy-init': 300,
+                 'usecs-to-proxy-choice': 550, 'usecs-to-proxy-request': 620}
+        if failed and built_ts is None:
+            # the circuit failed, and tor gives up on the stream
+            end_ts = unix_ts + 120.0
+            self.__torctl_event(end_ts, "STREAM {0} FAILED 0 {1} REASON=TIMEOUT".format(stream_id, target))
+            self.__tgen_stream(transfer_id, "stream-error", unix_ts, end_ts, port, remote, filesize, 0, times,
+                               transport_state="ERROR", transport_error="PROXY", stream_error="PROXY")
+            self.stats['failures'] += 1
+            return
+
+        connected_ts = built_ts + self.rng.lognormvariate(math.log(0.6 if onion else 0.3), 0.4)
+        self.__torctl_event(built_ts + 0.001, "STREAM {0} SENTCONNECT {1} {2}".format(stream_id, circ_id, target))
+        self.__torctl_event(connected_ts, "STREAM {0} SUCCEEDED {1} {2}".format(stream_id, circ_id, target))
+        times['usecs-to-proxy-response'] = int((connected_ts - unix_ts) * 1e6)
+        times['usecs-to-command'] = times['usecs-to-proxy-response'] + 150
+        first_byte_ts = connected_ts + self.rng.lognormvariate(math.log(0.5 if onion else 0.3), 0.4)
+        times['usecs-to-response'] = times['usecs-to-first-byte-recv'] = int((first_byte_ts - unix_ts) * 1e6)
+        mbps = self.rng.lognormvariate(math.log(6.0 if onion else 12.0), 0.6)
+        last_byte_ts = first_byte_ts + filesize * 8 / (mbps * 1e6)
+
+        # a 1 Hz progress line while the payload arrives
+        progress_ts = math.floor(first_byte_ts) + 1
+        while progress_ts < last_byte_ts:
+            if failed and progress_ts >= first_byte_ts + (last_byte_ts - first_byte_ts) / 2:
+                break
+            received = int(filesize * (progress_ts - first_byte_ts) / (last_byte_ts - first_byte_ts))
+            self.__tgen_stream(transfer_id, "stream-status", unix_ts, progress_ts, port, remote, filesize, received, times)
+            progress_ts += 1
+
+        if failed:
+            # the transfer stalls and tgen gives up after its timeout
+            end_ts = unix_ts + 60.0
+            self.__torctl_event(end_ts, "STREAM {0} CLOSED {1} {2} REASON=END REMOTE_REASON=DONE".format(stream_id, circ_id, target))
+            self.__tgen_stream(transfer_id, "stream-error", unix_ts, end_ts, port, remote, filesize, filesize // 2, times,
+                               transport_state="SUCCESS_OPEN", transport_error="NONE", stream_error="TIMEOUT")
+            self.stats['failures'] += 1
+            return
+        times['usecs-to-last-byte-recv'] = times['usecs-to-checksum-recv'] = int((last_byte_ts - unix_ts) * 1e6)
+        self.__torctl_event(last_byte_ts + 0.01, "STREAM {0} CLOSED {1} {2} REASON=DONE".format(stream_id, circ_id, target))
+        self.__tgen_stream(transfer_id, "stream-success", unix_ts, last_byte_ts, port, remote, filesize, filesize, times)
+
+    def __tgen_stream(self, transfer_id, kind, start_ts, unix_ts, port, remote, filesize, received, times,
+                      transport_state="SUCCESS_OPEN", transport_error="NONE", stream_error="NONE"):
+        all_times = dict.fromkeys(('usecs-to-proxy-response', 'usecs-to-command', 'usecs-to-response', 'usecs-to-first-byte-recv',
+                                   'usecs-to-last-byte-recv', 'usecs-to-checksum-recv', 'usecs-to-first-byte-send',
+                                   'usecs-to-last-byte-send', 'usecs-to-checksum-send'), -1)
+        all_times.update(times)
+        # tgen's timestamps are microseconds on a monotonic clock
+        created_ts = int((start_ts - self.start_ts) * 1e6) + 1000000000
+        recvstate = "RECV_SUCCESS" if received == filesize else ("RECV_PAYLOAD" if received > 0 else "RECV_NONE")
+        self.__tgen(unix_ts, "[message] [tgen-stream.c:1618] [_tgenstream_log] [{0}] "
+                    "transport [fd={1},local=localhost:127.0.0.1:{2},proxy=localhost:127.0.0.1:9050,remote={3},state={4},error={5}] "
+                    "stream [id={6},vertexid=stream,name={7},peername={7},sendsize=0,recvsize={8},sendstate=SEND_SUCCESS,recvstate={9},error={10}] "
+                    "bytes [total-bytes-recv={11},total-bytes-send=2192,payload-bytes-recv={12},payload-bytes-send=0,"
+                    "payload-progress-recv={13:.2f}%,payload-progress-send=100.00%] "
+                    "times [created-ts={14},{15},now-ts={16}]".format(
+                        kind, 10 + port % 50, port, remote, transport_state, transport_error, transfer_id, self.nickname,
+                        filesize, recvstate, stream_error, received + 131 if received > 0 else 0, received, 100.0 * received / filesize,
+                        created_ts, ",".join("{0}={1}".format(key, value) for (key, value) in sorted(all_times.items())),
+                        created_ts + int((unix_ts - start_ts) * 1e6)))
+
+def generate_logs(output_dir, codec='plain', **kwargs):
+    '''
+    Writes onionperf.tgen.log and onionperf.torctl.log, with the extension of
+    codec, to output_dir using a SyntheticLogGenerator created with kwargs, and
+    returns their paths along with the statistics returned by its write.
+    '''
+    extension = util.get_codec(codec).extension
+    tgen_path = os.path.join(output_dir, "onionperf.tgen.log" + extension)
+    torctl_path = os.path.join(output_dir, "onionperf.torctl.log" + extension)
+    stats = SyntheticLogGenerator(**kwargs).write(tgen_path, torctl_path, codec=codec)
+    return (tgen_path, torctl_path, stats)
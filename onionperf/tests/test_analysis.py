@@ -1,8 +1,19 @@
 import os
+import re
+import gc
+import json
+import datetime
+import tracemalloc
+import shutil
+import tempfile
+import threading
 import pkg_resources
 from nose.tools import *
 from onionperf import util
+from stem.response import ControlMessage, convert
 from tgentools import analysis
+from onionperf import analysis as op_analysis
+from onionperf import synthetic
 
 
 def absolute_data_path(relative_path=""):
@@ -152,3 +163,438 @@ def test_stream_object_end_to_end():
 def test_parsing_parse_error():
     parser = analysis.TGenParser()
     parser.parse(util.DataSource(DATA_DIR + 'parse_error'))
+
+def test_parse_torctl_event_circ():
+    event = op_analysis.parse_torctl_event('CIRC 23 EXTENDED $3CE90527D5712296B58E7EB7CD57F7D388D25FBB~modupe BUILD_FLAGS=IS_INTERNAL,NEED_CAPACITY PURPOSE=HS_CLIENT_HSDIR HS_STATE=HSCI_CONNECTING TIME_CREATED=2019-01-31T11:29:51.154893')
+    assert_equals(event.type, 'CIRC')
+    assert_equals(event.id, '23')
+    assert_equals(event.status, 'EXTENDED')
+    assert_equals(event.path, (('3CE90527D5712296B58E7EB7CD57F7D388D25FBB', 'modupe'),))
+    assert_equals(event.purpose, 'HS_CLIENT_HSDIR')
+    assert_equals(event.hs_state, 'HSCI_CONNECTING')
+    assert_equals(event.reason, None)
+
+def test_parse_torctl_path_old_style():
+    content = 'CIRC 7 EXTENDED $3CE90527D5712296B58E7EB7CD57F7D388D25FBB,modupe,$ADB2C26629643DBB9F8FE0096E7D16F9414B4F8D=relay PURPOSE=GENERAL'
+    event = op_analysis.parse_torctl_event(content)
+    stem_event = ControlMessage.from_str("650 {0}\r\n".format(content))
+    convert('EVENT', stem_event)
+    assert_equals(event.path, tuple(stem_event.path))
+    assert_equals(event.path, (('3CE90527D5712296B58E7EB7CD57F7D388D25FBB', None), (None, 'modupe'),
+                               ('ADB2C26629643DBB9F8FE0096E7D16F9414B4F8D', 'relay')))
+    assert_equals(op_analysis.parse_torctl_event('CIRC 7 EXTENDED $123,modupe PURPOSE=GENERAL'), None)
+
+def test_parse_torctl_event_unconsumed():
+    assert_equals(op_analysis.parse_torctl_event('BW 1024 2048'), None)
+
+def test_torctl_parser_fast_parse_matches_stem():
+    fast_parser = op_analysis.TorCtlParser(fast_parse=True, verify_fast_parse=True)
+    fast_parser.parse(util.DataSource(DATA_DIR + 'logs/onionperf.torctl.log'))
+    stem_parser = op_analysis.TorCtlParser(fast_parse=False)
+    stem_parser.parse(util.DataSource(DATA_DIR + 'logs/onionperf.torctl.log'))
+    assert_equals(fast_parser.fast_parse_mismatches, 0)
+    assert_equals(fast_parser.get_data(), stem_parser.get_data())
+
+def test_torctl_parser_event_counts():
+    parser = op_analysis.TorCtlParser()
+    parser.parse(util.DataSource(DATA_DIR + 'logs/onionperf.torctl.log'))
+    counts = parser.get_event_counts()
+    assert_equals(counts['BW'], {'read': 163, 'skipped': 163, 'handled': 0, 'failed': 0})
+    assert_equals(counts['CIRC']['read'], 113)
+    assert_equals(counts['CIRC']['skipped'], 0)
+    assert_equals(counts['CIRC']['handled'], 113)
+
+def test_analyze_by_day_matches_date_filter():
+    tgen_log = DATA_DIR + 'logs/onionperf.tgen.log'
+    torctl_log = DATA_DIR + 'logs/onionperf.torctl.log'
+    analysis = op_analysis.OPAnalysis()
+    analysis.add_tgen_file(tgen_log)
+    analysis.add_torctl_file(torctl_log)
+    analyses = analysis.analyze_by_day()
+    assert_equals(sorted(analyses.keys()), [datetime.date(2019, 1, 31), datetime.date(2019, 2, 11)])
+    for date, day_analysis in analyses.items():
+        filtered_analysis = op_analysis.OPAnalysis()
+        filtered_analysis.add_tgen_file(tgen_log)
+        filtered_analysis.add_torctl_file(torctl_log)
+        filtered_analysis.analyze(date_filter=date)
+        assert_equals(day_analysis.json_db, filtered_analysis.json_db)
+    parallel_analysis = op_analysis.OPAnalysis()
+    parallel_analysis.add_tgen_file(tgen_log)
+    parallel_analysis.add_torctl_file(torctl_log)
+    parallel_analyses = parallel_analysis.analyze_by_day(torctl_workers=2)
+    assert_equals(sorted(parallel_analyses.keys()), sorted(analyses.keys()))
+    for date, day_analysis in parallel_analyses.items():
+        assert_equals(day_analysis.json_db, analyses[date].json_db)
+
+def test_analyze_by_day_multi_day_log():
+    work_dir = tempfile.mkdtemp()
+    (tgen_path, torctl_path, stats) = synthetic.generate_logs(work_dir, days=3, transfers_per_hour=2, start_date=datetime.date(2021, 6, 1))
+    analysis = op_analysis.OPAnalysis()
+    analysis.set_country_lookup(util.CountryLookup(offline=True))
+    analysis.add_tgen_file(tgen_path)
+    analysis.add_torctl_file(torctl_path)
+    analyses = analysis.analyze_by_day()
+    assert_equals(sorted(analyses.keys()), [datetime.date(2021, 6, 1), datetime.date(2021, 6, 2), datetime.date(2021, 6, 3)])
+    for date, day_analysis in analyses.items():
+        filtered_analysis = op_analysis.OPAnalysis()
+        filtered_analysis.set_country_lookup(util.CountryLookup(offline=True))
+        filtered_analysis.add_tgen_file(tgen_path)
+        filtered_analysis.add_torctl_file(torctl_path)
+        filtered_analysis.analyze(date_filter=date, concurrent=False)
+        assert_true(len(day_analysis.json_db['data']['op-synthetic']['tgen']['streams']) > 0)
+        assert_equals(day_analysis.json_db, filtered_analysis.json_db)
+    shutil.rmtree(work_dir)
+
+def test_torctl_parser_parallel_matches_serial():
+    serial_parser = op_analysis.TorCtlParser()
+    serial_parser.parse(util.DataSource(DATA_DIR + 'logs/onionperf.torctl.log'))
+    parallel_parser = op_analysis.TorCtlParser(num_workers=2)
+    parallel_parser.parse(util.DataSource(DATA_DIR + 'logs/onionperf.torctl.log'))
+    assert_equals(parallel_parser.get_name(), serial_parser.get_name())
+    assert_equals(parallel_parser.get_event_counts(), serial_parser.get_event_counts())
+    assert_equals(parallel_parser.get_data(), serial_parser.get_data())
+
+def test_torctl_parser_parse_errors():
+    work_dir = tempfile.mkdtemp()
+    with open(DATA_DIR + 'logs/onionperf.torctl.log', 'rt', newline='\r\n') as f:
+        lines = f.readlines()
+    bad_lines = ['2019-01-31 11:29:51 1548934191.21 650 CIRC abc LAUNCHED PURPOSE=GENERAL\r\n',
+                 '2019-01-31 11:29:51 1548934191.21 650 STREAM 5\r\n']
+    log_path = os.path.join(work_dir, 'onionperf.torctl.log')
+    with open(log_path, 'wt', newline='') as f:
+        f.writelines(lines[:200] + bad_lines + lines[200:])
+    for num_workers in [1, 2]:
+        source = util.DataSource(log_path, count_lines=True)
+        parser = op_analysis.TorCtlParser(num_workers=num_workers)
+        parser.parse(source)
+        (parse_errors, samples) = parser.get_parse_errors()
+        assert_equals(parse_errors, 2)
+        assert_true(any(sample['line'] == bad_lines[1].strip() for sample in samples))
+        assert_equals(source.lines_read, len(lines) + 2)
+        assert_equals(source.bytes_read, os.path.getsize(log_path))
+    shutil.rmtree(work_dir)
+
+def test_torctl_parser_state_horizon():
+    work_dir = tempfile.mkdtemp()
+    log_path = os.path.join(work_dir, 'onionperf.torctl.log')
+    with open(log_path, 'wt', newline='') as f:
+        f.write('2019-01-31 11:00:00 1548932400.00 650 CIRC 1 LAUNCHED PURPOSE=GENERAL\r\n')
+        f.write('2019-01-31 11:00:00 1548932400.00 650 CIRC 2 LAUNCHED PURPOSE=GENERAL\r\n')
+        f.write('2019-01-31 11:00:00 1548932400.00 650 STREAM 1 NEW 0 1.2.3.4:443 SOURCE_ADDR=127.0.0.1:1234 PURPOSE=USER\r\n')
+        # circuit 2 and stream 2 stay active, while circuit 1 and stream 1 go quiet
+        for minute in range(1, 120):
+            unix_ts = 1548932400 + minute * 60
+            f.write('2019-01-31 11:00:00 {0}.00 650 CIRC 2 EXTENDED $3CE90527D5712296B58E7EB7CD57F7D388D25FBB~modupe PURPOSE=GENERAL\r\n'.format(unix_ts))
+            f.write('2019-01-31 11:00:00 {0}.00 650 STREAM 2 NEW 0 1.2.3.4:443 SOURCE_ADDR=127.0.0.1:1235 PURPOSE=USER\r\n'.format(unix_ts))
+        f.write('2019-01-31 13:00:00 1548939600.00 650 CIRC 2 CLOSED PURPOSE=GENERAL REASON=FINISHED\r\n')
+    parser = op_analysis.TorCtlParser(state_horizon=3600)
+    parser.parse(util.DataSource(log_path))
+    data = parser.get_data()
+    assert_equals(list(data['circuits'].keys()), [2])
+    assert_equals(data['incomplete'], {'circuits': {'evicted': 1, 'open': 0}, 'streams': {'evicted': 1, 'open': 1}})
+    assert_equals(parser.get_state_stats(), {'peak_circuits_state': 2, 'peak_streams_state': 2, 'evicted_circuits': 1, 'evicted_streams': 1})
+    unbounded_parser = op_analysis.TorCtlParser(state_horizon=None)
+    unbounded_parser.parse(util.DataSource(log_path))
+    assert_equals(unbounded_parser.get_data()['incomplete'], {'circuits': {'evicted': 0, 'open': 1}, 'streams': {'evicted': 0, 'open': 2}})
+    shutil.rmtree(work_dir)
+
+def test_tgen_stream_parser_matches_tgen_parser():
+    work_dir = tempfile.mkdtemp()
+    (tgen_path, _, stats) = synthetic.generate_logs(work_dir, days=1, transfers_per_hour=6, start_date=datetime.date(2021, 6, 1))
+    tgen_parser = analysis.TGenParser()
+    tgen_parser.parse(util.DataSource(tgen_path), do_complete=True)
+    assert_equals(len(tgen_parser.get_data()['streams']), stats['transfers'])
+    # all transfers of the log happen on its only date
+    for (date_filter, num_streams) in [(None, stats['transfers']), (datetime.date(2021, 6, 1), stats['transfers']), (datetime.date(2021, 6, 2), 0)]:
+        stream_parser = op_analysis.TGenStreamParser(date_filter=date_filter)
+        stream_parser.parse(util.DataSource(tgen_path), do_complete=True)
+        assert_equals(stream_parser.get_name(), tgen_parser.get_name())
+        assert_equals(len(stream_parser.get_data()['streams']), num_streams)
+        if num_streams > 0:
+            assert_equals(stream_parser.get_data()['streams'], tgen_parser.get_data()['streams'])
+        assert_equals(sorted(stream_parser.get_data().keys()), ['init_ts', 'streams'])
+        assert_equals(stream_parser.heartbeats, {})
+        assert_equals(stream_parser.stream_summary['time_to_last_byte_recv'], {})
+    shutil.rmtree(work_dir)
+
+def test_tgen_stream_parser_skips_bad_lines():
+    work_dir = tempfile.mkdtemp()
+    (tgen_path, _, stats) = synthetic.generate_logs(work_dir, days=1, transfers_per_hour=2, start_date=datetime.date(2021, 6, 1))
+    with open(tgen_path, 'at') as f:
+        f.write("2021-06-01 23:59:59 1622591999.000000 [message] [tgen-stream.c:1] [_tgenstream_log] [stream-success] garbage\n")
+    stream_parser = op_analysis.TGenStreamParser(date_filter=datetime.date(2021, 6, 1))
+    stream_parser.parse(util.DataSource(tgen_path), do_complete=True)
+    assert_equals(len(stream_parser.get_data()['streams']), stats['transfers'])
+    shutil.rmtree(work_dir)
+
+def test_analyze_concurrent_matches_serial():
+    work_dir = tempfile.mkdtemp()
+    (tgen_path, torctl_path, _) = synthetic.generate_logs(work_dir, days=1, transfers_per_hour=6)
+    json_dbs = []
+    for concurrent in [True, False]:
+        analysis = op_analysis.OPAnalysis()
+        analysis.set_country_lookup(util.CountryLookup(offline=True))
+        analysis.add_tgen_file(tgen_path)
+        analysis.add_torctl_file(torctl_path)
+        analysis.analyze(concurrent=concurrent)
+        json_dbs.append(analysis.json_db)
+    assert_equals(json_dbs[0], json_dbs[1])
+    assert_equals(list(json_dbs[0]['data'].keys()), ['op-synthetic'])
+    shutil.rmtree(work_dir)
+
+def test_analyze_follow_matches_analyze():
+    work_dir = tempfile.mkdtemp()
+    log_paths = {}
+    for name in ['onionperf.tgen.log', 'onionperf.torctl.log']:
+        with open(DATA_DIR + 'logs/' + name, 'rb') as f:
+            content = f.read()
+        log_paths[name] = (os.path.join(work_dir, name), content)
+        open(log_paths[name][0], 'wb').close()
+    checkpoint = os.path.join(work_dir, 'onionperf.analysis.checkpoint')
+    # append the logs in three parts, cut in the middle of lines
+    for part in range(3):
+        for (log_path, content) in log_paths.values():
+            cuts = [0, len(content) // 3 + 7, 2 * len(content) // 3 + 7, len(content)]
+            with open(log_path, 'ab') as f:
+                f.write(content[cuts[part]:cuts[part + 1]])
+        analysis = op_analysis.OPAnalysis()
+        analysis.add_tgen_file(log_paths['onionperf.tgen.log'][0])
+        analysis.add_torctl_file(log_paths['onionperf.torctl.log'][0])
+        analysis.analyze_follow(checkpoint)
+    full_analysis = op_analysis.OPAnalysis()
+    full_analysis.add_tgen_file(DATA_DIR + 'logs/onionperf.tgen.log')
+    full_analysis.add_torctl_file(DATA_DIR + 'logs/onionperf.torctl.log')
+    full_analysis.analyze()
+    assert_equals(analysis.json_db, full_analysis.json_db)
+    shutil.rmtree(work_dir)
+
+def test_find_analysis_files():
+    work_dir = tempfile.mkdtemp()
+    os.makedirs(os.path.join(work_dir, 'node'))
+    names = ['2021-06-01.onionperf.analysis.json.xz', 'node/onionperf.analysis.json',
+             '2021-06-01.onionperf.analysis.json.xz' + op_analysis.AnalysisCache.SUFFIX,
+             '2021-06-01.onionperf.tgen.log', 'node/2021-06-01.onionperf.analysis.json.gz.tmp']
+    for name in names:
+        open(os.path.join(work_dir, name), 'wb').close()
+    assert_equals(op_analysis.find_analysis_files(work_dir),
+                  [os.path.join(work_dir, name) for name in sorted(names[:2])])
+    shutil.rmtree(work_dir)
+
+def test_torctl_live_sink_matches_log_parse():
+    work_dir = tempfile.mkdtemp()
+    writable = util.FileWritable(os.path.join(work_dir, 'onionperf.torctl.log'))
+    sink = op_analysis.TorCtlLiveSink()
+    # log the lines the way TorMonitor does, one status line or event at a time
+    with open(DATA_DIR + 'logs/onionperf.torctl.log', 'rt', newline='') as f:
+        for line in f:
+            event = None
+            timestamps, sep, raw_event_str = line.partition(" 650 ")
+            if sep != '':
+                event = ControlMessage.from_str("650 {0}".format(raw_event_str))
+                convert('EVENT', event)
+            sink.log(writable, line, event)
+    writable.close()
+    live_parser = sink.rotate()
+    log_parser = op_analysis.TorCtlParser()
+    log_parser.parse(util.DataSource(DATA_DIR + 'logs/onionperf.torctl.log'))
+    assert_equals(live_parser.get_name(), log_parser.get_name())
+    assert_equals(live_parser.get_data(), log_parser.get_data())
+    assert_equals(sink.rotate().get_data(), {'circuits': {}, 'streams': {}, 'guards': [],
+                                             'incomplete': {'circuits': {'evicted': 0, 'open': 0}, 'streams': {'evicted': 0, 'open': 0}}})
+    shutil.rmtree(work_dir)
+
+class _BrokenEvent(object):
+    # a CIRC event without any of the attributes that stem would have parsed
+    type = 'CIRC'
+
+    def raw_content(self):
+        return 'CIRC 1 BROKEN'
+
+def test_torctl_parser_event_errors():
+    parser = op_analysis.TorCtlParser()
+    parser.parse_event(_BrokenEvent(), 1548934190.0)
+    assert_equals(parser.get_event_counts()['CIRC']['failed'], 1)
+    (parse_errors, parse_error_samples) = parser.get_parse_errors()
+    assert_equals(parse_errors, 1)
+    assert_equals(parse_error_samples[0]['line'], '1548934190.00 650 CIRC 1 BROKEN')
+
+def test_torctl_live_sink_rotation():
+    # log the events on one thread while the log is rotated halfway through
+    # on another, like TorMonitor and the log rotation thread do
+    work_dir = tempfile.mkdtemp()
+    log_path = os.path.join(work_dir, 'onionperf.torctl.log')
+    writable = util.FileWritable(log_path)
+    sink = op_analysis.TorCtlLiveSink()
+    with open(DATA_DIR + 'logs/onionperf.torctl.log', 'rt', newline='') as f:
+        lines = f.readlines()
+    halfway = threading.Event()
+    def log_lines():
+        for (i, line) in enumerate(lines):
+            if i == len(lines) // 2:
+                halfway.set()
+            event = None
+            timestamps, sep, raw_event_str = line.partition(" 650 ")
+            if sep != '':
+                event = ControlMessage.from_str("650 {0}".format(raw_event_str))
+                convert('EVENT', event)
+            sink.log(writable, line, event)
+    logger = threading.Thread(target=log_lines)
+    logger.start()
+    halfway.wait()
+    parsers = [sink.rotate(writable, filename_datetime=datetime.datetime(2019, 2, 1))]
+    logger.join()
+    writable.close()
+    parsers.append(sink.rotate())
+    archive_dir = os.path.join(work_dir, 'log_archive')
+    log_paths = [os.path.join(archive_dir, name) for name in os.listdir(archive_dir)] + [log_path]
+    contents = b''
+    # every line is in the log file and in the parser of the same side of the rotation
+    for (parser, path) in zip(parsers, log_paths):
+        log_parser = op_analysis.TorCtlParser()
+        log_parser.parse(util.DataSource(path))
+        assert_equals(parser.get_data(), log_parser.get_data())
+        with util.open_binary(path) as f:
+            contents += f.read()
+    assert_equals(contents, "".join(lines).encode('utf-8'))
+    shutil.rmtree(work_dir)
+
+def test_torctl_parser_guard_countries():
+    work_dir = tempfile.mkdtemp()
+    fingerprint = '3CE90527D5712296B58E7EB7CD57F7D388D25FBB'
+    log_path = os.path.join(work_dir, 'onionperf.torctl.log')
+    with open(log_path, 'wt', newline='') as f:
+        f.write('2019-01-31 11:29:50 1548934190.00 650 GUARD ENTRY ${0}~modupe NEW\r\n'.format(fingerprint))
+        f.write('2019-01-31 11:29:50 1548934190.50 650 GUARD ENTRY ${0}~modupe UP\r\n'.format(fingerprint))
+        f.write('2019-01-31 11:29:51 1548934191.21 650 CIRC 23 LAUNCHED BUILD_FLAGS=NEED_CAPACITY PURPOSE=GENERAL TIME_CREATED=2019-01-31T11:29:51.154893\r\n')
+        f.write('2019-01-31 11:29:52 1548934192.21 650 CIRC 23 CLOSED BUILD_FLAGS=NEED_CAPACITY PURPOSE=GENERAL TIME_CREATED=2019-01-31T11:29:51.154893 REASON=FINISHED\r\n')
+    details_path = os.path.join(work_dir, 'details.json')
+    with open(details_path, 'wt') as f:
+        f.write('{"relays": [{"fingerprint": "' + fingerprint + '", "country": "se"}]}')
+    parser = op_analysis.TorCtlParser(country_lookup=util.CountryLookup(details_path=details_path, offline=True))
+    parser.parse(util.DataSource(log_path))
+    data = parser.get_data()
+    assert_equals(data['guards'][0]['country'], 'se')
+    assert_equals(data['circuits'][23]['current_guards'][0]['country'], 'se')
+    shutil.rmtree(work_dir)
+
+def test_guard_registry_current_guards():
+    registry = op_analysis.TorGuardRegistry()
+    first = op_analysis.TorGuard('A' * 40, 'first')
+    registry.add(first)
+    registry.set_up(first, 10.0)
+    second = op_analysis.TorGuard('B' * 40, 'second')
+    registry.add(second)
+    registry.set_up(second, 20.0)
+    registry.set_dropped(first, 30.0)
+    third = op_analysis.TorGuard('A' * 40, 'first')
+    registry.add(third)
+    registry.set_up(third, 40.0)
+    assert_equals(registry.get_latest('A' * 40), third)
+    assert_equals(registry.get_current(5.0), [])
+    assert_equals(registry.get_current(15.0), [first])
+    assert_equals(registry.get_current(25.0), [first, second])
+    assert_equals(registry.get_current(30.0), [second])
+    assert_equals(registry.get_current(45.0), [second, third])
+    assert_equals(registry.get_current(None), [])
+
+def test_torctl_parser_circuit_without_launch():
+    lines = ['2019-01-31 11:29:50 1548934190.00 650 GUARD ENTRY $' + 'A' * 40 + '~first UP\r\n',
+             '2019-01-31 11:29:51 1548934191.00 650 CIRC 5 EXTENDED $' + 'A' * 40 + '~first PURPOSE=GENERAL\r\n',
+             '2019-01-31 11:29:52 1548934192.00 650 CIRC 5 CLOSED $' + 'A' * 40 + '~first PURPOSE=GENERAL REASON=FINISHED\r\n']
+    parser = op_analysis.TorCtlParser(country_lookup=util.CountryLookup(offline=True))
+    parser.parse(lines)
+    assert_equals(parser.get_parse_errors(), (0, []))
+    assert_equals(parser.get_event_counts()['CIRC']['handled'], 2)
+    data = parser.get_data()
+    # without a launch time the circuit is incomplete, but it is no longer left open
+    assert_equals(data['circuits'], {})
+    assert_equals(data['incomplete']['circuits']['open'], 0)
+    assert_equals(len(data['guards']), 1)
+
+def test_torctl_parser_compact_records():
+    circ_re = re.compile(r"(650 CIRC(?:_MINOR)? )(\d+)")
+    stream_re = re.compile(r"(650 STREAM )(\d+)( \S+ )(\d+)")
+    with open(os.path.join(DATA_DIR, "logs/onionperf.torctl.log"), newline='') as f:
+        log_lines = f.readlines()
+    lines = []
+    for i in range(20):
+        offset = i * 100000
+        for line in log_lines:
+            line = circ_re.sub(lambda m: m.group(1) + str(int(m.group(2)) + offset), line)
+            line = stream_re.sub(lambda m: m.group(1) + str(int(m.group(2)) + offset) + m.group(3) + str(int(m.group(4)) + offset), line)
+            lines.append(line)
+    tracemalloc.start()
+    try:
+        parser = op_analysis.TorCtlParser(country_lookup=util.CountryLookup(offline=True))
+        parser.parse(lines)
+        assert_equals(len(parser.circuits), 140)
+        data = parser.get_data()
+        data.pop('guards')
+        with_records, _ = tracemalloc.get_traced_memory()
+        parser.circuits, parser.streams = {}, {}
+        gc.collect()
+        with_dicts, _ = tracemalloc.get_traced_memory()
+        data = None
+        gc.collect()
+        without, _ = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    # the records kept while parsing take well under half the memory of the JSON shape
+    assert_true((with_records - with_dicts) * 2 < with_dicts - without)
+
+def test_save_compact_threaded():
+    work_dir = tempfile.mkdtemp()
+    analysis = op_analysis.OPAnalysis(nickname="test")
+    analysis.set_country_lookup(util.CountryLookup(offline=True))
+    analysis.add_tgen_file(os.path.join(DATA_DIR, "logs/onionperf.tgen.log"))
+    analysis.add_torctl_file(os.path.join(DATA_DIR, "logs/onionperf.torctl.log"))
+    analysis.analyze()
+    analysis.save(filename="indented.json.xz", output_prefix=work_dir)
+    analysis.save(filename="compact.json.xz", output_prefix=work_dir, indent=None, level=1, threads=2)
+    indented = op_analysis.OPAnalysis.load(filename="indented.json.xz", input_prefix=work_dir)
+    compact = op_analysis.OPAnalysis.load(filename="compact.json.xz", input_prefix=work_dir)
+    assert_equals(compact.json_db, indented.json_db)
+    shutil.rmtree(work_dir)
+
+def test_load_sections():
+    analysis_path = os.path.join(DATA_DIR, "analyses/2021-01-01.op-hk5.onionperf.analysis.json.xz")
+    full = op_analysis.OPAnalysis.load(filename=analysis_path)
+    partial = op_analysis.OPAnalysis.load(filename=analysis_path, sections=["tgen.streams"])
+    assert_equals(partial.json_db["data"]["op-hk5"]["tgen"]["streams"], full.json_db["data"]["op-hk5"]["tgen"]["streams"])
+    assert_true("circuits" not in partial.json_db["data"]["op-hk5"]["tor"])
+    assert_true(("op-hk5", "tor.circuits") in partial.skipped_sections)
+    assert_equals(partial.get_tor_circuits("op-hk5"), full.get_tor_circuits("op-hk5"))
+    assert_true(("op-hk5", "tor.circuits") not in partial.skipped_sections)
+    partial.load_sections(["tor.streams", "tor.guards"])
+    assert_equals(partial.json_db, full.json_db)
+
+def test_load_json_sections_compact():
+    db = {"data": {"node": {"measurement_ip": "unknown", "tor": {"circuits": {"1": {"path": []}}, "guards": []}}},
+          "filters": {"tor/circuits": [{"name": "exclude_cbt"}]}, "type": "onionperf", "version": "3.1"}
+    for text in [json.dumps(db), json.dumps(db, indent=2)]:
+        partial, skipped = op_analysis.load_json_sections(text, ["tor.guards"])
+        assert_equals(skipped, set([("node", "tor.circuits")]))
+        del db["data"]["node"]["tor"]["circuits"]
+        assert_equals(partial, db)
+        db["data"]["node"]["tor"]["circuits"] = {"1": {"path": []}}
+
+def test_analysis_cache():
+    work_dir = tempfile.mkdtemp()
+    analysis_paths = []
+    for name in ["2021-01-01.op-hk5.onionperf.analysis.json.xz", "2021-06-01.op-hk6a.onionperf.analysis.json.xz"]:
+        analysis_paths.append(os.path.join(work_dir, name))
+        shutil.copy(os.path.join(DATA_DIR, "analyses", name), analysis_paths[-1])
+    cache = op_analysis.AnalysisCache()
+    full = op_analysis.OPAnalysis.load(filename=analysis_paths[0], cache=cache)
+    entry_path = cache.get_entry_path(analysis_paths[0])
+    assert_true(os.path.exists(entry_path))
+    assert_equals(cache.get(analysis_paths[0]), full.json_db)
+    assert_equals(op_analysis.OPAnalysis.load(filename=analysis_paths[0], cache=cache).json_db, full.json_db)
+    os.utime(analysis_paths[0], (0, 0))
+    assert_equals(cache.get(analysis_paths[0]), None)
+    cache_dir = os.path.join(work_dir, "cache")
+    cache = op_analysis.AnalysisCache(cache_dir=cache_dir, max_bytes=os.path.getsize(entry_path) + 1)
+    op_analysis.OPAnalysis.load(filename=analysis_paths[0], cache=cache)
+    op_analysis.OPAnalysis.load(filename=analysis_paths[1], cache=cache)
+    assert_equals(os.listdir(cache_dir), [os.path.basename(cache.get_entry_path(analysis_paths[1]))])
+    shutil.rmtree(work_dir)
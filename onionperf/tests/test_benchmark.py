@@ -0,0 +1,18 @@
+from nose.tools import *
+from onionperf import benchmark
+
+
+def get_results(seconds_by_step):
+    return {'version': benchmark.VERSION, 'generator': {'seed': 1},
+            'runs': [{'days': 1, 'steps': {step: {'wall_seconds': seconds} for (step, seconds) in seconds_by_step.items()}}]}
+
+def test_compare_results():
+    """
+    Ensures steps slower than the tolerance allows are regressions, and steps missing from either side are skipped.
+    """
+    baseline = get_results({'analyze': 2.0, 'save': 1.0, 'load': 0.5})
+    results = get_results({'analyze': 2.4, 'save': 1.3, 'extract': 0.1})
+    assert_equals(benchmark.compare_results(results, baseline, tolerance=0.25),
+                  [(1, 'analyze', 2.0, 2.4, 1.2, False), (1, 'save', 1.0, 1.3, 1.3, True)])
+    baseline['version'] = benchmark.VERSION + 1
+    assert_raises(ValueError, benchmark.compare_results, results, baseline)
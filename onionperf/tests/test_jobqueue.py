@@ -0,0 +1,90 @@
+import os
+import json
+import time
+import datetime
+import tempfile
+import shutil
+from nose.tools import *
+from onionperf import jobqueue
+from onionperf import reprocessing
+from onionperf import synthetic
+
+
+def write_logs(work_dir, dates):
+    pairs = []
+    for date in dates:
+        paths = []
+        for kind in ['tgen', 'torctl']:
+            path = os.path.join(work_dir, "onionperf_{0}_23:59:59.{1}.log".format(date, kind))
+            with open(path, 'wt') as f:
+                f.write(kind)
+            paths.append(path)
+        pairs.append((paths[0], paths[1], datetime.datetime.strptime(date, "%Y-%m-%d")))
+    return pairs
+
+def test_queue_claim_and_fail():
+    """
+    Ensures jobs are enqueued once, claimed in order, and retried until they failed max_attempts times.
+    """
+    work_dir = tempfile.mkdtemp()
+    pairs = write_logs(work_dir, ["2021-06-01", "2021-06-02"])
+    queue = jobqueue.JobQueue(os.path.join(work_dir, "queue"), max_attempts=2)
+    assert_equals(queue.enqueue(pairs), 2)
+    assert_equals(queue.enqueue(pairs), 0)
+    (job, claim_path) = queue.claim("worker-1")
+    assert_equals((job['date'], job['attempts']), ("2021-06-01", 0))
+    assert_equals(queue.claim("worker-2")[0]['date'], "2021-06-02")
+    assert_equals(queue.claim("worker-3"), None)
+    queue.fail(job, claim_path, "first error")
+    (job, claim_path) = queue.claim("worker-1")
+    assert_equals((job['date'], job['attempts'], job['errors']), ("2021-06-01", 1, ["first error"]))
+    queue.fail(job, claim_path, "second error")
+    assert_equals(queue.get_counts(), {'pending': 0, 'claimed': 1, 'done': 0, 'failed': 1})
+    assert_equals(queue.enqueue(pairs), 0)
+    assert_equals(queue.enqueue(pairs, force=True), 1)
+    shutil.rmtree(work_dir)
+
+def test_queue_recover_expired_lease():
+    """
+    Ensures claims that were not touched within the lease timeout go back to the queue exactly once.
+    """
+    work_dir = tempfile.mkdtemp()
+    pairs = write_logs(work_dir, ["2021-06-01"])
+    queue = jobqueue.JobQueue(os.path.join(work_dir, "queue"), lease_timeout=60)
+    queue.enqueue(pairs)
+    (job, claim_path) = queue.claim("worker-1")
+    assert_equals(queue.recover_expired("worker-2"), 0)
+    os.utime(claim_path, (time.time() - 120, time.time() - 120))
+    assert_equals(queue.recover_expired("worker-2"), 1)
+    assert_equals(queue.recover_expired("worker-3"), 0)
+    (job, _) = queue.claim("worker-2")
+    assert_equals(job['attempts'], 1)
+    assert_true("worker-1" in job['errors'][0])
+    # the first worker finishing late must not lose the job of the second
+    queue.complete(dict(job, attempts=0), claim_path, {'output': None})
+    assert_equals(queue.get_counts(), {'pending': 0, 'claimed': 1, 'done': 1, 'failed': 0})
+    shutil.rmtree(work_dir)
+
+def test_process_queue_with_several_workers():
+    """
+    Ensures several worker processes drain a queue, record the results of good pairs, and fail bad ones.
+    """
+    work_dir = tempfile.mkdtemp()
+    (tgen_path, torctl_path, _) = synthetic.generate_logs(work_dir, days=1, transfers_per_hour=2, start_date=datetime.date(2021, 6, 1))
+    pairs = [(tgen_path, torctl_path, datetime.datetime(2021, 6, 1)), (tgen_path, torctl_path, datetime.datetime(2021, 6, 2)),
+             write_logs(work_dir, ["2021-06-03"])[0]]
+    queue = jobqueue.JobQueue(os.path.join(work_dir, "queue"), max_attempts=2)
+    queue.enqueue(pairs)
+    os.remove(pairs[2][1])
+    output_dir = os.path.join(work_dir, "htdocs")
+    counts = reprocessing.process_queue(queue, output_dir, num_workers=3)
+    assert_equals(counts, {'completed': 2, 'failed': 2})
+    assert_equals(queue.get_counts(), {'pending': 0, 'claimed': 0, 'done': 2, 'failed': 1})
+    for date in ["2021-06-01", "2021-06-02"]:
+        assert(os.path.exists(os.path.join(output_dir, "{0}.onionperf.analysis.json.xz".format(date))))
+    done_dir = os.path.join(work_dir, "queue", "done")
+    for filename in os.listdir(done_dir):
+        with open(os.path.join(done_dir, filename), 'rt') as f:
+            job = json.load(f)
+        assert_equals(job['result']['output'], os.path.join(output_dir, "{0}.onionperf.analysis.json.xz".format(job['date'])))
+    shutil.rmtree(work_dir)
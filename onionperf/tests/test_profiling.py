@@ -0,0 +1,68 @@
+import os
+import json
+import shutil
+import tempfile
+import pkg_resources
+from nose.tools import *
+from onionperf import profiling
+from onionperf.analysis import OPAnalysis
+
+
+def absolute_data_path(relative_path=""):
+    """
+    Returns an absolute path for test data given a relative path.
+    """
+    return pkg_resources.resource_filename("onionperf",
+                                           "tests/data/" + relative_path)
+
+
+DATA_DIR = absolute_data_path()
+
+def test_profiler_report():
+    """
+    Ensures the report has a record with rates for each phase and caps the parse error samples.
+    """
+    work_dir = tempfile.mkdtemp()
+    profiler = profiling.Profiler("test", report_path=os.path.join(work_dir, "report.json"),
+                                  cprofile_path=os.path.join(work_dir, "report.prof"))
+    profiler.start()
+    with profiling.phase(profiler, "count", file="input") as record:
+        record.update(lines=sum(1 for _ in range(100000)), bytes=1 << 20)
+    with profiling.phase(None, "ignored") as record:
+        record.update(lines=1)
+    profiler.add_parse_errors("torctl", 12, [{'line': str(i)} for i in range(12)])
+    profiler.add_parse_errors("torctl", 1, [{'line': "12"}])
+    profiler.stop()
+    with open(os.path.join(work_dir, "report.json")) as f:
+        report = json.load(f)
+    assert_equals(report["command"], "test")
+    assert_equals([phase["name"] for phase in report["phases"]], ["count"])
+    phase = report["phases"][0]
+    assert_equals(phase["file"], "input")
+    assert_almost_equals(phase["lines_per_second"], 100000 / phase["wall_seconds"])
+    assert_true(report["wall_seconds"] >= phase["wall_seconds"])
+    assert_true(report["peak_rss_bytes"] > 0)
+    assert_equals(report["parse_errors"]["torctl"]["count"], 13)
+    assert_equals(len(report["parse_errors"]["torctl"]["samples"]), profiling.PARSE_ERROR_SAMPLES)
+    assert_true(os.path.getsize(os.path.join(work_dir, "report.prof")) > 0)
+    shutil.rmtree(work_dir)
+
+def test_analysis_phases():
+    """
+    Ensures analyze and save record a phase for each log file, the results and the output file.
+    """
+    work_dir = tempfile.mkdtemp()
+    profiler = profiling.Profiler("analyze")
+    analysis = OPAnalysis()
+    analysis.set_profiler(profiler)
+    analysis.add_tgen_file(DATA_DIR + "logs/onionperf.tgen.log")
+    analysis.add_torctl_file(DATA_DIR + "logs/onionperf.torctl.log")
+    analysis.analyze()
+    analysis.save(output_prefix=work_dir)
+    phases = {phase["name"]: phase for phase in profiler.get_report()["phases"]}
+    assert_equals(sorted(phases), ["save", "sketches", "tgen.get_data", "tgen.parse", "tor.get_data", "tor.parse"])
+    assert_equals(phases["tor.parse"]["bytes"], os.path.getsize(DATA_DIR + "logs/onionperf.torctl.log"))
+    assert_true(phases["tgen.parse"]["lines"] > 0)
+    assert_true(0 <= phases["save"]["compress_seconds"] <= phases["save"]["wall_seconds"])
+    assert_equals(profiler.get_report()["parse_errors"], {"torctl": {"count": 0, "samples": []}})
+    shutil.rmtree(work_dir)
@@ -3,9 +3,13 @@ import pkg_resources
 import datetime
 import tempfile
 import shutil
+import json
+import tarfile
 from nose.tools import *
 from onionperf import analysis
 from onionperf import reprocessing
+from onionperf import synthetic
+from onionperf import util
 
 
 def absolute_data_path(relative_path=""):
@@ -83,3 +87,128 @@ def test_end_to_end():
     json_file = os.path.join(work_dir, "2019-01-10.onionperf.analysis.json.xz")
     assert(os.path.exists(json_file))
     shutil.rmtree(work_dir)
+
+def test_manifest_skips_analyzed_pairs():
+    work_dir = tempfile.mkdtemp()
+    log_dir, output_dir = os.path.join(work_dir, "logs"), os.path.join(work_dir, "htdocs")
+    os.makedirs(log_dir)
+    (tgen_path, torctl_path, _) = synthetic.generate_logs(log_dir, days=1, transfers_per_hour=2, start_date=datetime.date(2021, 6, 1))
+    os.rename(tgen_path, os.path.join(log_dir, "onionperf_2021-06-01_23:59:59.tgen.log"))
+    os.rename(torctl_path, os.path.join(log_dir, "onionperf_2021-06-01_23:59:59.torctl.log"))
+    pairs = reprocessing.match(reprocessing.collect_logs(log_dir, '*tgen.log'), reprocessing.collect_logs(log_dir, '*torctl.log'), None)
+    manifest = reprocessing.ReprocessingManifest(output_dir)
+    assert_equals(reprocessing.plan_reprocessing(pairs, manifest), (pairs, []))
+    reprocessing.multiprocess_logs(pairs, output_dir, manifest=manifest)
+    assert(os.path.exists(os.path.join(output_dir, "2021-06-01.onionperf.analysis.json.xz")))
+    manifest = reprocessing.ReprocessingManifest(output_dir, do_hash=False)
+    assert_equals(reprocessing.plan_reprocessing(pairs, manifest), ([], pairs))
+    assert_equals(reprocessing.plan_reprocessing(pairs, manifest, force=True), (pairs, []))
+    assert_equals(reprocessing.plan_reprocessing(pairs, reprocessing.ReprocessingManifest(output_dir, nick="other")), (pairs, []))
+    # other output files or options, and code changes, need the pairs analyzed again
+    assert_equals(reprocessing.plan_reprocessing(pairs, reprocessing.ReprocessingManifest(output_dir, save_args={'codec': 'gz'})), (pairs, []))
+    assert_equals(reprocessing.plan_reprocessing(pairs, reprocessing.ReprocessingManifest(output_dir, save_args={'indent': None})), (pairs, []))
+    assert_equals(reprocessing.plan_reprocessing(pairs, reprocessing.ReprocessingManifest(output_dir, build_index=True)), (pairs, []))
+    analysis_revision = reprocessing.ANALYSIS_REVISION
+    reprocessing.ANALYSIS_REVISION += 1
+    try:
+        assert_equals(reprocessing.plan_reprocessing(pairs, reprocessing.ReprocessingManifest(output_dir)), (pairs, []))
+    finally:
+        reprocessing.ANALYSIS_REVISION = analysis_revision
+    manifest = reprocessing.ReprocessingManifest(output_dir, save_args={'codec': 'gz'})
+    reprocessing.multiprocess_logs(pairs, output_dir, manifest=manifest, save_args={'codec': 'gz'})
+    assert(os.path.exists(os.path.join(output_dir, "2021-06-01.onionperf.analysis.json.gz")))
+    assert_equals(reprocessing.plan_reprocessing(pairs, reprocessing.ReprocessingManifest(output_dir, save_args={'codec': 'gz'})), ([], pairs))
+    with open(pairs[0][0], 'at') as f:
+        f.write("\n")
+    assert_equals(reprocessing.plan_reprocessing(pairs, reprocessing.ReprocessingManifest(output_dir)), (pairs, []))
+    shutil.rmtree(work_dir)
+
+def test_log_match_by_vantage_and_date():
+    work_dir = tempfile.mkdtemp()
+    sizes = {('op-ab', '2021-06-01'): 10, ('op-ab', '2021-06-02'): 30, ('op-hk', '2021-06-01'): 20, ('op-hk', '2021-06-02'): 5}
+    for ((vantage, date), size) in sizes.items():
+        os.makedirs(os.path.join(work_dir, vantage, date), exist_ok=True)
+        for kind in ['tgen', 'torctl']:
+            with open(os.path.join(work_dir, vantage, date, "onionperf_{0}_23:59:59.{1}.log".format(date, kind)), 'wt') as f:
+                f.write("x" * size)
+    # a log that was never rotated, which covers the dates in its time index
+    os.makedirs(os.path.join(work_dir, "op-us"))
+    for kind in ['tgen', 'torctl']:
+        log_path = os.path.join(work_dir, "op-us", "onionperf.{0}.log".format(kind))
+        with open(log_path, 'wt') as f:
+            f.write("2021-06-01 23:00:00 1622588400.00 first\n2021-06-02 01:00:00 1622595600.00 second\n")
+    tgen_logs = reprocessing.collect_logs(work_dir, '*tgen.log')
+    torctl_logs = reprocessing.collect_logs(work_dir, '*torctl.log')
+    log_pairs = reprocessing.match(tgen_logs, torctl_logs, None)
+    assert_equals([(os.path.relpath(tgen_log, work_dir), os.path.relpath(tor_log, work_dir), date) for (tgen_log, tor_log, date) in log_pairs],
+                  [('op-ab/2021-06-02/onionperf_2021-06-02_23:59:59.tgen.log', 'op-ab/2021-06-02/onionperf_2021-06-02_23:59:59.torctl.log', datetime.datetime(2021, 6, 2)),
+                   ('op-hk/2021-06-01/onionperf_2021-06-01_23:59:59.tgen.log', 'op-hk/2021-06-01/onionperf_2021-06-01_23:59:59.torctl.log', datetime.datetime(2021, 6, 1)),
+                   ('op-ab/2021-06-01/onionperf_2021-06-01_23:59:59.tgen.log', 'op-ab/2021-06-01/onionperf_2021-06-01_23:59:59.torctl.log', datetime.datetime(2021, 6, 1)),
+                   ('op-hk/2021-06-02/onionperf_2021-06-02_23:59:59.tgen.log', 'op-hk/2021-06-02/onionperf_2021-06-02_23:59:59.torctl.log', datetime.datetime(2021, 6, 2))])
+    log_pairs = reprocessing.match(tgen_logs, torctl_logs, datetime.date(2021, 6, 2), build_index=True)
+    assert_equals([os.path.relpath(tgen_log, work_dir) for (tgen_log, _, _) in log_pairs],
+                  ['op-us/onionperf.tgen.log', 'op-ab/2021-06-02/onionperf_2021-06-02_23:59:59.tgen.log', 'op-hk/2021-06-02/onionperf_2021-06-02_23:59:59.tgen.log'])
+    assert_equals(len(reprocessing.match(tgen_logs, torctl_logs, None)), 6)
+    shutil.rmtree(work_dir)
+
+def test_multiprocess_logs_summary():
+    work_dir = tempfile.mkdtemp()
+    (tgen_path, torctl_path, _) = synthetic.generate_logs(work_dir, days=1, transfers_per_hour=2, start_date=datetime.date(2021, 6, 1))
+    pairs = [(tgen_path, torctl_path, datetime.datetime(2021, 6, 1)),
+             (tgen_path, os.path.join(work_dir, "missing.torctl.log"), datetime.datetime(2021, 6, 2))]
+    summary_path = os.path.join(work_dir, "summary.json")
+    summary = reprocessing.multiprocess_logs(pairs, work_dir, num_workers=2, max_tasks_per_child=1, retries=1, summary_path=summary_path)
+    assert_equals((summary['pairs'], summary['succeeded'], summary['failed']), (2, 1, 1))
+    assert_equals([(task['date'], task['status'], task['attempts']) for task in summary['tasks']], [('2021-06-01', 'ok', 1), ('2021-06-02', 'failed', 2)])
+    assert_true('FileNotFoundError' in summary['tasks'][1]['error'])
+    assert(os.path.exists(summary['tasks'][0]['output']))
+    with open(summary_path, 'rt') as f:
+        assert_equals(json.load(f)['tasks'], summary['tasks'])
+    summary = reprocessing.multiprocess_logs(pairs[:1], work_dir, task_timeout=0.001, retries=0)
+    assert_equals(summary['failed'], 1)
+    assert_true('TaskTimeout' in summary['tasks'][0]['error'])
+    shutil.rmtree(work_dir)
+
+def _exit_on_second_date(prefix, nick, pair, **kwargs):
+    if pair[2].day == 2:
+        # like a worker that the system killed for using too much memory
+        os._exit(1)
+    return os.path.join(prefix, "{0}.onionperf.analysis.json.xz".format(pair[2].day))
+
+def test_multiprocess_logs_lost_worker():
+    work_dir = tempfile.mkdtemp()
+    pairs = [("a.tgen.log", "a.torctl.log", datetime.datetime(2021, 6, day)) for day in [1, 2, 3]]
+    analyze_func = reprocessing.analyze_func
+    reprocessing.analyze_func = _exit_on_second_date
+    try:
+        summary = reprocessing.multiprocess_logs(pairs, work_dir, num_workers=2, retries=1)
+    finally:
+        reprocessing.analyze_func = analyze_func
+    assert_equals((summary['succeeded'], summary['failed']), (2, 1))
+    assert_equals([(task['status'], task['attempts']) for task in summary['tasks']], [('ok', 1), ('failed', 2), ('ok', 1)])
+    assert_true('lost' in summary['tasks'][1]['error'])
+    shutil.rmtree(work_dir)
+
+def test_analyze_archives():
+    work_dir = tempfile.mkdtemp()
+    (tgen_path, torctl_path, _) = synthetic.generate_logs(work_dir, days=1, transfers_per_hour=2, start_date=datetime.date(2021, 6, 1))
+    archive_path = os.path.join(work_dir, "logs.tar.gz")
+    with tarfile.open(archive_path, 'w:gz') as archive:
+        archive.add(tgen_path, arcname="op-ab/2021-06-01/onionperf_2021-06-01_23:59:59.tgen.log")
+        archive.add(tgen_path, arcname="op-hk/2021-06-02/onionperf_2021-06-02_23:59:59.tgen.log")
+        archive.add(torctl_path, arcname="op-ab/2021-06-01/onionperf_2021-06-01_23:59:59.torctl.log")
+        # paired by date alone, as the directory differs in more than the date
+        archive.add(torctl_path, arcname="torctl/2021-06-02/onionperf_2021-06-02_23:59:59.torctl.log")
+        archive.add(torctl_path, arcname="op-us/2021-06-03/onionperf_2021-06-03_23:59:59.torctl.log")
+    output_dir = os.path.join(work_dir, "htdocs")
+    country_lookup = util.CountryLookup(offline=True)
+    outputs = reprocessing.analyze_archives([archive_path], output_dir, country_lookup=country_lookup)
+    assert_equals([os.path.basename(output) for output in outputs],
+                  ["2021-06-01.onionperf.analysis.json.xz", "2021-06-02.onionperf.analysis.json.xz"])
+    streams = [len(list(analysis.OPAnalysis.load(output).json_db['data'].values())[0]['tgen']['streams']) for output in outputs]
+    # the logs only hold transfers of the first date
+    assert_true(streams[0] > 0)
+    assert_equals(streams[1], 0)
+    outputs = reprocessing.analyze_archives([archive_path], output_dir, date_filter=datetime.date(2021, 6, 2), country_lookup=country_lookup)
+    assert_equals([os.path.basename(output) for output in outputs], ["2021-06-02.onionperf.analysis.json.xz"])
+    shutil.rmtree(work_dir)
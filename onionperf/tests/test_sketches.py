@@ -0,0 +1,79 @@
+import os
+import random
+import pkg_resources
+from nose.tools import *
+from onionperf import sketches
+from onionperf.analysis import OPAnalysis
+
+
+def absolute_data_path(relative_path=""):
+    """
+    Returns an absolute path for test data given a relative path.
+    """
+    return pkg_resources.resource_filename("onionperf",
+                                           "tests/data/" + relative_path)
+
+
+DATA_DIR = absolute_data_path()
+
+def test_ddsketch_relative_accuracy():
+    """
+    Ensures sketch quantiles are within the relative accuracy of the exact ones.
+    """
+    rng = random.Random(1)
+    values = sorted(rng.lognormvariate(0, 2) for _ in range(10000))
+    sketch = sketches.DDSketch(0.01)
+    for value in values:
+        sketch.add(value)
+    for q in [0.0, 0.1, 0.5, 0.9, 0.99, 1.0]:
+        exact = values[int(q * (len(values) - 1))]
+        assert_true(abs(sketch.get_quantile(q) - exact) <= 0.01 * exact)
+    assert_equals(sketch.count, len(values))
+    assert_equals(sketches.DDSketch(0.01).get_quantile(0.5), None)
+
+def test_ddsketch_merge():
+    """
+    Ensures merged sketches equal the sketch of all values and reject other accuracies.
+    """
+    rng = random.Random(2)
+    merged, union = sketches.DDSketch(0.01), sketches.DDSketch(0.01)
+    for _ in range(5):
+        part = sketches.DDSketch(0.01)
+        for value in [rng.expovariate(1.0) for _ in range(200)] + [0.0]:
+            part.add(value)
+            union.add(value)
+        merged.merge(sketches.DDSketch.from_data(part.get_data(), 0.01))
+    assert_equals(merged.bins, union.bins)
+    assert_equals(merged.zero_count, 5)
+    assert_equals((merged.count, merged.min, merged.max), (union.count, union.min, union.max))
+    assert_raises(ValueError, merged.merge, sketches.DDSketch(0.02))
+
+def test_hourly_sketches_from_analysis():
+    """
+    Ensures the hourly sketches of an analysis count its successful measurements.
+    """
+    analysis = OPAnalysis.load(filename=os.path.join(DATA_DIR, "analyses/2021-06-01.op-hk6a.onionperf.analysis.json.xz"))
+    tgen_data = analysis.json_db["data"]["op-hk6a"]["tgen"]
+    hourly = sketches.build_hourly_sketches(tgen_data)
+    merged = sketches.merge_hourly_sketches(hourly)
+    ttlb = sorted(values["ttlb"] for (_, server, filesize, values) in sketches.get_measurements(tgen_data)
+                  if server == "public" and filesize == 5242880)
+    assert_equals(merged[("public", 5242880, "ttlb")].count, len(ttlb))
+    assert_equals(len(ttlb), 5)
+    median = merged[("public", 5242880, "ttlb")].get_quantile(0.5)
+    assert_true(abs(median - ttlb[2]) <= 0.01 * ttlb[2])
+    assert_equals(sketches.merge_hourly_sketches(hourly, start_ts=2000000000), {})
+
+def test_stream_and_transfer_metrics():
+    """
+    Ensures the metrics shared with the visualization are taken from the
+    stream and transfer data they are present in, and left out otherwise.
+    """
+    stream_data = {"stream_info": {"recvsize": "5242880"},
+                   "time_info": {"usecs-to-first-byte-recv": "500000", "usecs-to-last-byte-recv": "-1"},
+                   "elapsed_seconds": {"payload_progress_recv": {"0.8": 2.0, "1.0": 3.0}}}
+    assert_equals(sketches.get_stream_metrics(stream_data), {"ttfb": 0.5, "mbps": 8.388608})
+    assert_equals(sketches.get_stream_metrics({"stream_info": {"recvsize": "51200"}}), {})
+    transfer_data = {"filesize_bytes": 1048576,
+                     "elapsed_seconds": {"first_byte": 0.5, "last_byte": 2.0, "payload_progress": {"0.5": 1.0, "1.0": 2.0}}}
+    assert_equals(sketches.get_transfer_metrics(transfer_data), {"ttfb": 0.5, "ttlb": 2.0, "mbps": 4.194304})
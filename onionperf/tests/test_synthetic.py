@@ -0,0 +1,37 @@
+import os
+import shutil
+import tempfile
+from nose.tools import *
+from onionperf import synthetic, util
+from onionperf.analysis import OPAnalysis
+
+
+def test_generated_logs_analysis():
+    """
+    Ensures the generated logs are reproducible and analyze into the generated measurements.
+    """
+    work_dir = tempfile.mkdtemp()
+    (tgen_path, torctl_path, stats) = synthetic.generate_logs(work_dir, seed=7, days=0.1, transfers_per_hour=60, failure_rate=0.2)
+    other_dir = os.path.join(work_dir, "other")
+    os.makedirs(other_dir)
+    (other_tgen_path, _, other_stats) = synthetic.generate_logs(other_dir, codec='gz', seed=7, days=0.1, transfers_per_hour=60, failure_rate=0.2)
+    assert_equals(other_stats, stats)
+    with util.open_binary(tgen_path) as f, util.open_binary(other_tgen_path) as other_f:
+        assert_equals(f.read(), other_f.read())
+
+    analysis = OPAnalysis()
+    analysis.set_country_lookup(util.CountryLookup(offline=True))
+    analysis.add_tgen_file(tgen_path)
+    analysis.add_torctl_file(torctl_path)
+    analysis.analyze()
+    assert_equals(list(analysis.get_nodes()), ["op-synthetic"])
+    tgen_streams = analysis.get_tgen_streams("op-synthetic")
+    assert_equals(len(tgen_streams), stats['transfers'])
+    errors = [stream for stream in tgen_streams.values() if stream["stream_info"]["error"] != "NONE"]
+    assert_equals(len(errors), stats['failures'])
+    assert_true(0 < stats['failures'] < stats['transfers'])
+    tor_streams = analysis.get_tor_streams("op-synthetic")
+    assert_equals(len(tor_streams), stats['transfers'])
+    assert_true(all(circuit["path"] for circuit in analysis.get_tor_circuits("op-synthetic").values() if "buildtime_seconds" in circuit))
+    assert_equals(len(analysis.get_tor_guards("op-synthetic")), 3)
+    shutil.rmtree(work_dir)
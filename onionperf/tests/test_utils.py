@@ -1,12 +1,15 @@
 import datetime
 import hashlib
+import json
+import lzma
 import os
 import pkg_resources
 import shutil
 import sys
+import tarfile
 import tempfile
 
-from nose.tools import assert_equals
+from nose.tools import assert_equals, assert_raises
 
 from onionperf import util
 
@@ -305,3 +308,267 @@ def test_file_writable_rotate_file():
     assert(os.path.isdir(created_dir))
     assert(os.path.exists(rotated_file))
     shutil.rmtree(work_dir)
+
+def test_log_index_window():
+    """
+    Copies the tgen test log into a temporary working directory and builds a
+    sidecar util.LogIndex for it through a windowed util.DataSource.
+    Checks that the index was saved and can be loaded again, and that reading
+    the window of the last day yields every line of that day but skips the
+    lines of the first day apart from the head of the file.
+    Removes the working directory only if successful.
+    """
+    work_dir = tempfile.mkdtemp()
+    log_path = os.path.join(work_dir, "onionperf.tgen.log")
+    shutil.copy(absolute_data_path("logs/onionperf.tgen.log"), log_path)
+    window = util.get_date_window(datetime.date(2019, 2, 11))
+    source = util.DataSource(log_path, time_window=window, build_index=True)
+    source.open()
+    lines = list(source)
+    source.close()
+    assert(os.path.exists(log_path + util.LOG_INDEX_SUFFIX))
+    assert(util.LogIndex.load(log_path) is not None)
+    with open(log_path, 'rt') as f:
+        all_lines = f.readlines()
+    assert_equals(lines[:util.LogIndex.HEAD_LINES], all_lines[:util.LogIndex.HEAD_LINES])
+    assert_equals([l for l in lines if l.startswith("2019-02-11")],
+                  [l for l in all_lines if l.startswith("2019-02-11")])
+    assert(len(lines) < 30)
+    shutil.rmtree(work_dir)
+
+def test_log_index_xz_streams():
+    """
+    Writes the tgen test log with an XZBlockWriter in many small streams and
+    checks that the util.LogIndex built for it records where each stream
+    starts, and that reading the window of the last day through it yields
+    the same lines as reading the window of the uncompressed log.
+    Removes the working directory only if successful.
+    """
+    work_dir = tempfile.mkdtemp()
+    log_path = os.path.join(work_dir, "onionperf.tgen.log")
+    shutil.copy(absolute_data_path("logs/onionperf.tgen.log"), log_path)
+    xz_path = log_path + ".xz"
+    writer = util.XZBlockWriter(xz_path, preset=1, threads=2, block_size=1000)
+    with open(log_path, 'rt') as f:
+        for line in f:
+            writer.write(line)
+    writer.close()
+    index = util.LogIndex.build(xz_path)
+    assert(len(index.streams) > 10)
+    assert_equals(util.get_xz_streams(xz_path), index.streams)
+    index.save()
+    assert_equals(util.LogIndex.load(xz_path).streams, index.streams)
+    window = util.get_date_window(datetime.date(2019, 2, 11))
+    lines = {}
+    for path in [log_path, xz_path]:
+        source = util.DataSource(path, time_window=window, build_index=True)
+        source.open()
+        lines[path] = list(source)
+        source.close()
+    assert_equals(lines[xz_path], lines[log_path])
+    assert(len(lines[xz_path]) < 30)
+    shutil.rmtree(work_dir)
+
+def test_log_index_stale():
+    """
+    Builds a util.LogIndex for a file in a temporary working directory, then
+    appends to the file and checks that the index is no longer loaded.
+    Removes the working directory only if successful.
+    """
+    work_dir = tempfile.mkdtemp()
+    log_path = os.path.join(work_dir, "onionperf.torctl.log")
+    shutil.copy(absolute_data_path("logs/onionperf.torctl.log"), log_path)
+    util.LogIndex.build(log_path).save()
+    assert(util.LogIndex.load(log_path) is not None)
+    with open(log_path, 'at') as f:
+        f.write("2019-02-12 00:00:00 1549929600.00 650 BW 0 0\r\n")
+    assert_equals(util.LogIndex.load(log_path), None)
+    shutil.rmtree(work_dir)
+
+def test_iter_lines_by_date():
+    """
+    Ensures that iter_lines_by_date keeps every line with a timestamp, in
+    order, in batches of consecutive lines of one date.
+    """
+    with open(DATA_DIR + "logs/onionperf.torctl.log", 'rt', newline='\r\n') as f:
+        lines = f.readlines()
+    batches = list(util.iter_lines_by_date(lines, batch_lines=100))
+    assert_equals(sorted(set(date for (date, _) in batches)), [datetime.date(2019, 1, 31), datetime.date(2019, 2, 11)])
+    assert_equals(max(len(batch) for (_, batch) in batches), 100)
+    for (date, batch) in batches:
+        assert_equals(set(util.get_line_date(line) for line in batch) - set([None, date]), set())
+    first_dated = next(i for (i, line) in enumerate(lines) if util.get_line_date(line) is not None)
+    assert_equals([line for (_, batch) in batches for line in batch], lines[first_dated:])
+    assert_equals(sum(len(batch) for (date, batch) in batches if date == datetime.date(2019, 2, 11)), 14)
+
+def test_data_source_chunks():
+    """
+    Ensures that the chunks of a log file cover it completely, end at line
+    boundaries and together yield the same lines as reading it in text mode.
+    """
+    filename = DATA_DIR + "logs/onionperf.torctl.log"
+    chunks = util.DataSource(filename).get_chunks(8, newline='\r\n')
+    assert_equals(len(chunks), 8)
+    assert_equals(chunks[0][0], 0)
+    assert_equals(chunks[-1][1], os.path.getsize(filename))
+    lines = []
+    for chunk in chunks:
+        lines.extend(util.read_line_range(filename, chunk, newline='\r\n'))
+    with open(filename, 'rt', newline='\r\n') as f:
+        assert_equals(lines, f.readlines())
+
+def test_data_source_chunks_compressed():
+    """
+    Ensures that compressed sources cannot be split into chunks.
+    """
+    assert_equals(util.DataSource(DATA_DIR + "analyses/2021-01-01.op-hk5.onionperf.analysis.json.xz").get_chunks(4), None)
+
+def test_tail_source():
+    """
+    Ensures that a TailSource only returns complete lines and continues
+    where the previous one stopped.
+    """
+    work_dir = tempfile.mkdtemp()
+    log_path = os.path.join(work_dir, "growing.log")
+    with open(log_path, 'wb') as f:
+        f.write(b"first\r\nsecond\r\nthi")
+    source = util.TailSource(log_path)
+    source.open(newline='\r\n')
+    assert_equals(list(source), ["first\r\n", "second\r\n"])
+    assert_equals(source.offset, 15)
+    with open(log_path, 'ab') as f:
+        f.write(b"rd\r\n")
+    source = util.TailSource(log_path, source.offset)
+    source.open(newline='\r\n')
+    assert_equals(list(source), ["third\r\n"])
+    shutil.rmtree(work_dir)
+
+def test_country_lookup_offline():
+    """
+    Ensures that CountryLookup finds countries in a local details snapshot,
+    resolves addresses with a geoip file and caches what it found.
+    """
+    work_dir = tempfile.mkdtemp()
+    details_path = os.path.join(work_dir, "details.json")
+    with open(details_path, 'wt') as f:
+        f.write('{"relays": [{"fingerprint": "' + 'A' * 40 + '", "country": "de"},'
+                ' {"fingerprint": "' + 'B' * 40 + '", "or_addresses": ["1.2.3.4:9001"]}]}')
+    geoip_path = os.path.join(work_dir, "geoip")
+    with open(geoip_path, 'wt') as f:
+        f.write("# comment\n16777216,16843007,AU\n16909056,16909311,US\n")
+    lookup = util.CountryLookup(details_path=details_path, geoip_path=geoip_path, offline=True)
+    countries = lookup.get_countries(['A' * 40, 'b' * 40, 'C' * 40])
+    assert_equals(countries, {'A' * 40: 'de', 'B' * 40: 'us', 'C' * 40: None})
+    shutil.rmtree(work_dir)
+
+def test_country_lookup_cache_ttl():
+    """
+    Ensures that cached countries are used until they expire.
+    """
+    work_dir = tempfile.mkdtemp()
+    cache_path = os.path.join(work_dir, "countries.json")
+    with open(cache_path, 'wt') as f:
+        f.write('{"version": 1, "relays": {"' + 'A' * 40 + '": ["nl", 1000.0]}}')
+    lookup = util.CountryLookup(cache_path=cache_path, ttl_seconds=100, offline=True)
+    assert_equals(lookup.get_countries(['A' * 40], now=1050.0), {'A' * 40: 'nl'})
+    assert_equals(lookup.get_countries(['A' * 40], now=2000.0), {'A' * 40: None})
+    shutil.rmtree(work_dir)
+
+def test_xz_block_writer():
+    """
+    Ensures that the blocks an XZBlockWriter compresses on several threads
+    decompress to what was written, in order, as one .xz file.
+    """
+    work_dir = tempfile.mkdtemp()
+    xz_path = os.path.join(work_dir, "blocks.xz")
+    writer = util.XZBlockWriter(xz_path, preset=1, threads=3, block_size=100)
+    lines = ["line {0}\n".format(i) for i in range(1000)]
+    for line in lines:
+        writer.write(line)
+    writer.close()
+    with lzma.open(xz_path, 'rt') as f:
+        assert_equals(f.read(), "".join(lines))
+    shutil.rmtree(work_dir)
+
+def test_iter_json_sections():
+    """
+    Ensures that JSON written section by section is the same as the json
+    module's compact JSON, including integer keys.
+    """
+    obj = {'data': {'node': {'tor': {'circuits': {2: {'a': [1, 2.5]}, 10: {'b': None}}}}}, 'version': '3.1'}
+    expected = json.dumps(obj, sort_keys=True, separators=(',', ':'))
+    encoder = json.JSONEncoder(sort_keys=True, separators=(',', ':')).encode
+    assert_equals("".join(util.iter_json_sections(obj, encoder)), expected)
+    assert_equals("".join(util.iter_json_sections(obj, encoder, depth=1)), expected)
+    assert_equals(json.loads("".join(util.iter_json_sections(obj, util.get_json_encoder()))), json.loads(expected))
+
+def test_codec_detection():
+    """
+    Ensures that files written with each available codec are read back by
+    DataSource going by their magic bytes, whatever their file extension.
+    """
+    work_dir = tempfile.mkdtemp()
+    lines = ["line {0}\r\n".format(i) for i in range(100)]
+    for codec in util.COMPRESSION_CODECS.values():
+        if not codec.is_available():
+            continue
+        log_path = os.path.join(work_dir, "{0}.log".format(codec.name))
+        with codec.open(log_path, 'wt', newline='') as f:
+            f.write("".join(lines))
+        assert_equals(util.detect_codec(log_path), codec)
+        source = util.DataSource(log_path)
+        source.open(newline='\r\n')
+        assert_equals(list(source), lines)
+        source.close()
+        assert_equals(source.compress, codec.name != 'plain')
+    shutil.rmtree(work_dir)
+
+def test_archive_members():
+    """
+    Ensures that DataSource reads the members of tar archives, compressed or
+    not, both while iterating over an archive and by their member paths.
+    """
+    work_dir = tempfile.mkdtemp()
+    lines = ["line {0}\r\n".format(i) for i in range(100)]
+    log_path = os.path.join(work_dir, "onionperf.torctl.log")
+    with open(log_path, 'wt', newline='') as f:
+        f.write("".join(lines))
+    with util.COMPRESSION_CODECS['gz'].open(log_path + ".gz", 'wt', newline='') as f:
+        f.write("".join(lines))
+    archive_path = os.path.join(work_dir, "logs.tar.xz")
+    with tarfile.open(archive_path, 'w:xz') as archive:
+        archive.add(log_path, arcname="op-ab/onionperf.torctl.log")
+        archive.add(log_path + ".gz", arcname="op-ab/onionperf.torctl.log.gz")
+    member_names = []
+    for source in util.iter_archive_members(archive_path):
+        source.open(newline='\r\n')
+        assert_equals(list(source), lines)
+        source.close()
+        member_names.append(source.member_name)
+    assert_equals(member_names, ["op-ab/onionperf.torctl.log", "op-ab/onionperf.torctl.log.gz"])
+    assert_equals(util.split_archive_path(archive_path + "!/op-ab/onionperf.torctl.log.gz"), (archive_path, "op-ab/onionperf.torctl.log.gz"))
+    assert_equals(util.split_archive_path(log_path), (log_path, None))
+    source = util.DataSource(archive_path + "!/op-ab/onionperf.torctl.log.gz")
+    source.open(newline='\r\n')
+    assert_equals(list(source), lines)
+    source.close()
+    assert_equals((source.compress, source.get_size(), source.get_chunks(4)), (True, os.path.getsize(log_path + ".gz"), None))
+    assert_raises(FileNotFoundError, util.DataSource(archive_path + "!/missing.log").open)
+    shutil.rmtree(work_dir)
+
+def test_file_writable_codec():
+    """
+    Ensures that a FileWritable compresses with the requested codec and
+    level, adding the codec's extension, and that levels are checked.
+    """
+    work_dir = tempfile.mkdtemp()
+    writable = util.FileWritable(os.path.join(work_dir, "out.json"), codec="gz", level=1)
+    assert_equals(writable.filename, os.path.join(work_dir, "out.json.gz"))
+    writable.write("{}")
+    writable.close()
+    assert_equals(util.detect_codec(writable.filename).name, "gz")
+    with util.open_binary(writable.filename) as f:
+        assert_equals(f.read(), b"{}")
+    assert_raises(ValueError, util.get_codec("xz").get_level, 10)
+    assert_raises(ValueError, util.get_codec, "bz2")
+    shutil.rmtree(work_dir)
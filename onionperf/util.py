@@ -5,11 +5,28 @@
   See LICENSE for licensing information
 '''
 
-import sys, os, socket, logging, random, re, shutil, datetime, gzip, lzma, requests
+import sys, os, io, socket, logging, random, re, shutil, datetime, gzip, lzma, json, bisect, math, struct, tarfile, requests
 import urllib.request, urllib.parse, urllib.error
 from threading import Lock
 from io import StringIO
 from abc import ABCMeta, abstractmethod
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import lz4.frame as lz4_frame
+except ImportError:
+    lz4_frame = None
 
 LINEFORMATS = "k-,r-,b-,g-,c-,m-,y-,k--,r--,b--,g--,c--,m--,y--,k:,r:,b:,g:,c:,m:,y:,k-.,r-.,b-.,g-.,c-.,m-.,y-."
 
@@ -19,6 +36,158 @@ def get_country_by_fingerprint(fingerprint):
     return r.json()["relays"][0]["country"]
 
 
+def get_countries_by_fingerprints(fingerprints, batch_size=100, timeout=30):
+    """
+    Looks up the countries of many relays at once using onionoo, sending one
+    request per batch_size fingerprints.
+
+    :param fingerprints: list of strings
+    :returns: dict of fingerprint -> lowercase country code, without the
+              relays that onionoo does not know or has no country for
+    """
+    countries = {}
+    for i in range(0, len(fingerprints), batch_size):
+        batch = fingerprints[i:i + batch_size]
+        r = requests.get("https://onionoo.torproject.org/details",
+                         params={'lookup': ",".join(batch), 'fields': "fingerprint,country"}, timeout=timeout)
+        r.raise_for_status()
+        for relay in r.json().get("relays", []):
+            if "fingerprint" in relay and "country" in relay:
+                countries[relay["fingerprint"].upper()] = relay["country"]
+    return countries
+
+
+class CountryLookup(object):
+    """
+    Looks up the countries of relays by fingerprint, trying in this order:
+    a persistent on-disk cache whose entries expire after ttl_seconds, a
+    local onionoo details snapshot (countries, or addresses resolved with
+    geoip_path), and finally batched onionoo requests unless offline is set.
+    Sources are loaded lazily on the first lookup.
+
+    The geoip file is in Tor's format, i.e. lines of "INTIPLOW,INTIPHIGH,CC".
+    """
+
+    CACHE_VERSION = 1
+
+    def __init__(self, cache_path=None, ttl_seconds=7 * 86400, details_path=None, geoip_path=None, offline=False):
+        self.cache_path = cache_path
+        self.ttl_seconds = ttl_seconds
+        self.details_path = details_path
+        self.geoip_path = geoip_path
+        self.offline = offline
+        self.cache = None
+        self.details = None
+        self.geoip = None
+
+    def get_countries(self, fingerprints, now=None):
+        """
+        :param fingerprints: list of strings
+        :returns: dict of fingerprint -> lowercase country code, or None if
+                  no source knows the relay's country
+        """
+        now = now if now is not None else datetime.datetime.utcnow().timestamp()
+        self.__load()
+        countries = {}
+        missing = []
+        for fingerprint in fingerprints:
+            fingerprint = fingerprint.upper()
+            entry = self.cache.get(fingerprint)
+            if entry is not None and now - entry[1] < self.ttl_seconds:
+                countries[fingerprint] = entry[0]
+            elif fingerprint in self.details:
+                countries[fingerprint] = self.details[fingerprint]
+            else:
+                missing.append(fingerprint)
+
+        found = {}
+        if len(missing) > 0 and not self.offline:
+            try:
+                found = get_countries_by_fingerprints(missing)
+            except Exception as e:
+                logging.warning("unable to look up the countries of {0} relays with onionoo: {1}".format(len(missing), repr(e)))
+                # only remember what we could not find if onionoo was reachable
+                missing = []
+        for fingerprint in missing:
+            countries[fingerprint] = found.get(fingerprint)
+            self.cache[fingerprint] = [countries[fingerprint], now]
+        for fingerprint in fingerprints:
+            countries.setdefault(fingerprint.upper(), None)
+        if len(missing) > 0:
+            self.save()
+        return countries
+
+    def __load(self):
+        if self.cache is None:
+            self.cache = self.__read_cache()
+        if self.details is None:
+            self.details = {}
+            if self.details_path is not None:
+                self.__load_details()
+
+    def __read_cache(self):
+        if self.cache_path is None or not os.path.exists(self.cache_path):
+            return {}
+        try:
+            with open(self.cache_path, 'rt') as f:
+                cache = json.load(f)
+            if cache.get('version') == CountryLookup.CACHE_VERSION:
+                return cache['relays']
+        except (OSError, ValueError, KeyError) as e:
+            logging.warning("ignoring unreadable country cache at {0}: {1}".format(self.cache_path, repr(e)))
+        return {}
+
+    def __load_details(self):
+        with open_binary(self.details_path) as f:
+            relays = json.load(f).get("relays", [])
+        for relay in relays:
+            if "fingerprint" not in relay:
+                continue
+            country = relay.get("country")
+            if country is None and self.geoip_path is not None:
+                addresses = relay.get("or_addresses", [])
+                country = self.__lookup_geoip(addresses[0].rsplit(':', 1)[0]) if len(addresses) > 0 else None
+            if country is not None:
+                self.details[relay["fingerprint"].upper()] = country.lower()
+        logging.info("loaded the countries of {0} relays from {1}".format(len(self.details), self.details_path))
+
+    def __lookup_geoip(self, address):
+        if self.geoip is None:
+            self.geoip = ([], [], [])
+            with open(self.geoip_path, 'rt') as f:
+                for line in f:
+                    if line.startswith('#') or line.count(',') != 2:
+                        continue
+                    low, high, country = line.strip().split(',')
+                    self.geoip[0].append(int(low))
+                    self.geoip[1].append(int(high))
+                    self.geoip[2].append(country.lower())
+        try:
+            ip = int.from_bytes(socket.inet_aton(address), 'big')
+        except OSError:
+            # only IPv4 addresses are in the geoip file
+            return None
+        i = bisect.bisect_right(self.geoip[0], ip) - 1
+        if i >= 0 and ip <= self.geoip[1][i] and self.geoip[2][i] != '??':
+            return self.geoip[2][i]
+        return None
+
+    def save(self):
+        if self.cache_path is None:
+            return
+        # merge with entries that other processes saved since we loaded the cache
+        relays = self.__read_cache()
+        for fingerprint, entry in self.cache.items():
+            if fingerprint not in relays or relays[fingerprint][1] < entry[1]:
+                relays[fingerprint] = entry
+        self.cache = relays
+        make_dir_path(os.path.dirname(os.path.abspath(self.cache_path)))
+        tmp_path = "{0}.{1}.tmp".format(self.cache_path, os.getpid())
+        with open(tmp_path, 'wt') as f:
+            json.dump({'version': CountryLookup.CACHE_VERSION, 'relays': relays}, f)
+        os.replace(tmp_path, self.cache_path)
+
+
 def make_dir_path(path):
     p = os.path.abspath(os.path.expanduser(path))
     if not os.path.exists(p):
@@ -212,17 +381,593 @@ def get_random_free_port():
             return port
 
 
+def get_date_window(date_object):
+    """
+    Returns the [start, end) unix timestamps covering the given date in UTC.
+
+    :param date_object: date or datetime
+    :returns: tuple of floats
+    """
+    start = datetime.datetime(date_object.year, date_object.month, date_object.day, tzinfo=datetime.timezone.utc).timestamp()
+    return (start, start + 86400.0)
+
+
+def _open_xz(filename, mode, level, newline, threads):
+    if 'r' in mode:
+        return lzma.open(filename, mode, newline=newline)
+    return lzma.open(filename, mode, preset=level, newline=newline)
+
+def _open_gz(filename, mode, level, newline, threads):
+    if 'r' in mode:
+        return gzip.open(filename, mode, newline=newline)
+    return gzip.open(filename, mode, compresslevel=level, newline=newline)
+
+def _open_zstd(filename, mode, level, newline, threads):
+    if 'r' in mode:
+        return zstandard.open(filename, mode, newline=newline)
+    return zstandard.open(filename, mode, cctx=zstandard.ZstdCompressor(level=level, threads=threads), newline=newline)
+
+def _open_lz4(filename, mode, level, newline, threads):
+    if 'r' in mode:
+        return lz4_frame.open(filename, mode, newline=newline)
+    return lz4_frame.open(filename, mode, compression_level=level, newline=newline)
+
+def _open_plain(filename, mode, level, newline, threads):
+    return open(filename, mode, newline=None if 'b' in mode else newline)
+
+
+class Codec(object):
+    """
+    A compression format that logs and analysis results can be written in,
+    recognized when reading by the magic bytes at the start of a file. The
+    codecs whose library is not installed are known but not available.
+    """
+
+    def __init__(self, name, extension, magic, opener, default_level=None, min_level=None, max_level=None, module=None):
+        self.name = name
+        self.extension = extension
+        self.magic = magic
+        self.opener = opener
+        self.default_level = default_level
+        self.min_level = min_level
+        self.max_level = max_level
+        self.module = module
+
+    def is_available(self):
+        return self.magic is None or self.module is not None
+
+    def get_level(self, level=None):
+        """
+        Returns level, or the default level if it is None, raising a
+        ValueError if level is outside of the range this codec supports.
+        """
+        if level is None or self.default_level is None:
+            return self.default_level
+        if level < self.min_level or level > self.max_level:
+            raise ValueError("{0} is an invalid {1} compression level, expected {2}-{3}".format(level, self.name, self.min_level, self.max_level))
+        return level
+
+    def open(self, filename, mode='rb', level=None, newline=None, threads=1):
+        if not self.is_available():
+            raise ValueError("reading or writing {0} files at {1} requires a library that is not installed".format(self.name, filename))
+        return self.opener(filename, mode, self.get_level(level), newline, threads)
+
+
+COMPRESSION_CODECS = {
+    'xz': Codec('xz', ".xz", b'\xfd7zXZ\x00', _open_xz, 6, 0, 9, lzma),
+    'gz': Codec('gz', ".gz", b'\x1f\x8b', _open_gz, 9, 1, 9, gzip),
+    'zstd': Codec('zstd', ".zst", b'\x28\xb5\x2f\xfd', _open_zstd, 3, 1, 22, zstandard),
+    'lz4': Codec('lz4', ".lz4", b'\x04\x22\x4d\x18', _open_lz4, 0, 0, 16, lz4_frame),
+    'plain': Codec('plain', "", None, _open_plain),
+}
+
+
+def get_codec(name):
+    if name not in COMPRESSION_CODECS:
+        raise ValueError("unknown compression codec '{0}', expected one of {1}".format(name, ', '.join(sorted(COMPRESSION_CODECS))))
+    return COMPRESSION_CODECS[name]
+
+
+def get_codec_by_extension(filename):
+    """ returns the compressing codec that filename's extension belongs to, or None """
+    for codec in COMPRESSION_CODECS.values():
+        if codec.magic is not None and filename.endswith(codec.extension):
+            return codec
+    return None
+
+
+def detect_codec(filename):
+    """
+    Returns the codec that the file at filename was written with, going by
+    the magic bytes at its start rather than by its extension.
+    """
+    with open(filename, 'rb') as f:
+        head = f.read(8)
+    return _get_codec_by_magic(head)
+
+
+def _get_codec_by_magic(head):
+    for codec in COMPRESSION_CODECS.values():
+        if codec.magic is not None and head.startswith(codec.magic):
+            return codec
+    return COMPRESSION_CODECS['plain']
+
+
+def open_binary(filename):
+    return detect_codec(filename).open(filename, 'rb')
+
+
+# the tar archives that logs can be read from without extracting them, and
+# the separator between the path of an archive and the name of a member in
+# paths like logs.tar.xz!/onionperf/2021-06-01.onionperf.tgen.log
+ARCHIVE_EXTENSIONS = (".tar", ".tar.xz", ".tar.gz", ".tgz", ".txz")
+ARCHIVE_MEMBER_SEPARATOR = "!/"
+
+
+def is_archive(filename):
+    return filename.endswith(ARCHIVE_EXTENSIONS)
+
+
+def split_archive_path(filename):
+    """
+    Splits a path that points into a tar archive into the path of the archive
+    and the name of the member, or returns (filename, None) for other paths.
+    """
+    if ARCHIVE_MEMBER_SEPARATOR in filename:
+        (archive_path, member_name) = filename.split(ARCHIVE_MEMBER_SEPARATOR, 1)
+        if is_archive(archive_path):
+            return (archive_path, member_name)
+    return (filename, None)
+
+
+def iter_archive_members(archive_path):
+    """
+    Yields a DataSource for each regular file in the tar archive at
+    archive_path, reading the archive front to back only once, so that a
+    compressed archive is decompressed once no matter how many logs it holds.
+    Each member has to be read before the next one is yielded, as its data is
+    gone once the archive moves on.
+    """
+    with tarfile.open(archive_path, mode='r|*') as archive:
+        for member in archive:
+            if member.isfile():
+                yield DataSource(archive_path + ARCHIVE_MEMBER_SEPARATOR + member.name,
+                                 fileobj=archive.extractfile(member), size=member.size)
+
+
+class _ArchiveMemberReader(io.RawIOBase):
+    """
+    Reads a member of a tar archive that is opened in stream mode, which
+    fails rather than answers when io wrappers ask whether it is seekable.
+    """
+
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        data = self.fileobj.read(len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
+
+
+LOG_INDEX_SUFFIX = ".opindex"
+
+
+def _read_xz_varint(data, pos):
+    value, shift = 0, 0
+    while True:
+        byte = data[pos]
+        value |= (byte & 0x7f) << shift
+        pos += 1
+        if byte & 0x80 == 0:
+            return (value, pos)
+        shift += 7
+
+
+def get_xz_streams(filename):
+    """
+    Returns the [compressed offset, decompressed offset] at which each of the
+    concatenated streams of an .xz file starts, as found in the index at the
+    end of each stream, without decompressing anything. Returns None if the
+    file is not made of well-formed xz streams.
+    """
+    streams = []
+    with open(filename, 'rb') as f:
+        end = f.seek(0, io.SEEK_END)
+        while end > 0:
+            # streams may be followed by null bytes in multiples of four
+            while end >= 4:
+                f.seek(end - 4)
+                if f.read(4) != b'\0\0\0\0':
+                    break
+                end -= 4
+            if end < 24:
+                return None
+            f.seek(end - 12)
+            footer = f.read(12)
+            if footer[10:12] != b'YZ':
+                return None
+            index_size = (struct.unpack('<I', footer[4:8])[0] + 1) * 4
+            index_start = end - 12 - index_size
+            if index_start < 12:
+                return None
+            f.seek(index_start)
+            index = f.read(index_size)
+            if index[0] != 0:
+                return None
+            try:
+                (num_blocks, pos) = _read_xz_varint(index, 1)
+                blocks_size, decompressed_size = 0, 0
+                for _ in range(num_blocks):
+                    (unpadded_size, pos) = _read_xz_varint(index, pos)
+                    (block_decompressed_size, pos) = _read_xz_varint(index, pos)
+                    blocks_size += (unpadded_size + 3) // 4 * 4
+                    decompressed_size += block_decompressed_size
+            except IndexError:
+                return None
+            start = index_start - blocks_size - 12
+            if start < 0:
+                return None
+            f.seek(start)
+            if f.read(6) != COMPRESSION_CODECS['xz'].magic:
+                return None
+            streams.append((start, decompressed_size))
+            end = start
+    offsets = []
+    decompressed_offset = 0
+    for (start, decompressed_size) in reversed(streams):
+        offsets.append([start, decompressed_offset])
+        decompressed_offset += decompressed_size
+    return offsets
+
+
+class XZStreamReader(object):
+    """
+    A binary reader of an .xz file made of several concatenated streams, like
+    those XZBlockWriter writes, that seeks to a decompressed offset by
+    decompressing from the start of the last stream before it, given the
+    [compressed offset, decompressed offset] of each stream.
+    """
+
+    def __init__(self, filename, streams):
+        self.filename = filename
+        self.streams = streams
+        self.raw = None
+        self.file = None
+        self.seek(0)
+
+    def seek(self, offset):
+        i = bisect.bisect_right([decompressed_offset for (_, decompressed_offset) in self.streams], offset) - 1
+        (compressed_offset, decompressed_offset) = self.streams[i]
+        self.close()
+        self.raw = open(self.filename, 'rb')
+        self.raw.seek(compressed_offset)
+        self.file = lzma.LZMAFile(self.raw)
+        self.file.seek(offset - decompressed_offset)
+        return offset
+
+    def __iter__(self):
+        return iter(self.file)
+
+    def read(self, size=-1):
+        return self.file.read(size)
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.raw.close()
+            self.file, self.raw = None, None
+
+
+class LogIndex(object):
+    """
+    A sidecar index holding the byte offset at which each hour starts in a
+    log file whose lines begin with "<date> <time> <unix_ts>", as written by
+    TGen and the torctl monitor. For compressed logs the offsets refer to the
+    decompressed stream. Compressed logs are thus decompressed from their
+    start up to the requested window, except for .xz logs made of several
+    streams, like those XZBlockWriter writes, for which the index also holds
+    where each stream starts, so that reading begins at the last stream
+    before the window. Either way none of the skipped lines are parsed and
+    reading stops at the end of the window.
+    """
+
+    VERSION = 1
+    HEAD_LINES = 10
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.size = None
+        self.mtime = None
+        self.head_end = 0
+        self.hours = []
+        # the [compressed offset, decompressed offset] of each stream of an
+        # .xz log made of more than one
+        self.streams = []
+
+    @staticmethod
+    def get_index_path(filename):
+        return filename + LOG_INDEX_SUFFIX
+
+    @classmethod
+    def build(cls, filename):
+        index = cls(filename)
+        stat_result = os.stat(filename)
+        index.size, index.mtime = stat_result.st_size, stat_result.st_mtime
+        last_hour = None
+        offset = 0
+        with open_binary(filename) as f:
+            for num_lines, line in enumerate(f):
+                if num_lines == cls.HEAD_LINES:
+                    index.head_end = offset
+                parts = line.split(None, 3)
+                try:
+                    hour = int(float(parts[2]) // 3600)
+                except (IndexError, ValueError):
+                    hour = None
+                if hour is not None and (last_hour is None or hour > last_hour):
+                    index.hours.append([hour, offset])
+                    last_hour = hour
+                offset += len(line)
+        if index.head_end == 0:
+            index.head_end = offset
+        if detect_codec(filename).name == 'xz':
+            streams = get_xz_streams(filename)
+            if streams is not None and len(streams) > 1:
+                index.streams = streams
+        return index
+
+    @classmethod
+    def load(cls, filename):
+        """
+        Loads the index of the given log file, returning None if there is no
+        index or if the log file changed since the index was built.
+        """
+        index_path = cls.get_index_path(filename)
+        if not os.path.exists(index_path):
+            return None
+        try:
+            with open(index_path, 'rt') as f:
+                d = json.load(f)
+            stat_result = os.stat(filename)
+            if d['version'] != cls.VERSION or d['size'] != stat_result.st_size or d['mtime'] != stat_result.st_mtime:
+                return None
+        except (OSError, ValueError, KeyError):
+            return None
+        index = cls(filename)
+        index.size, index.mtime, index.head_end, index.hours = d['size'], d['mtime'], d['head_end'], d['hours']
+        # indexes built before streams were recorded still work, just without skipping streams
+        index.streams = d.get('streams', [])
+        return index
+
+    def save(self):
+        index_path = LogIndex.get_index_path(self.filename)
+        tmp_path = "{0}.{1}.tmp".format(index_path, os.getpid())
+        with open(tmp_path, 'wt') as f:
+            json.dump({'version': self.VERSION, 'size': self.size, 'mtime': self.mtime,
+                       'head_end': self.head_end, 'hours': self.hours, 'streams': self.streams}, f)
+        # replace atomically, in case several processes index the same file
+        os.replace(tmp_path, index_path)
+
+    def get_dates(self):
+        """
+        Returns the sorted list of UTC dates that the lines of the log file fall on.
+        """
+        return sorted(set(datetime.datetime.utcfromtimestamp(hour * 3600).date() for (hour, _) in self.hours))
+
+    def get_ranges(self, start_ts, end_ts):
+        """
+        Returns the (start, end) byte ranges that need to be read to see all
+        lines logged in the [start_ts, end_ts) window, always including the
+        first lines of the file which carry the process startup messages. An
+        end of None means reading until the end of the file. Each index entry
+        marks the first line at which a new, later hour appears, so no line
+        before the entry for the window's first hour can fall into the window;
+        the end is padded by one hour to tolerate slightly out-of-order
+        timestamps.
+        """
+        hours = [hour for (hour, _) in self.hours]
+        i = bisect.bisect_left(hours, int(start_ts // 3600))
+        if i == len(self.hours):
+            return [(0, self.head_end)]
+        start = self.hours[i][1]
+        j = bisect.bisect_left(hours, int(math.ceil(end_ts / 3600.0)) + 1)
+        end = self.hours[j][1] if j < len(self.hours) else None
+        if end is not None and end <= start:
+            return [(0, self.head_end)]
+        if start <= self.head_end:
+            return [(0, end)]
+        return [(0, self.head_end), (start, end)]
+
+
+def get_line_date(line):
+    """
+    Returns the UTC date of a log line beginning with "<date> <time> <unix_ts>",
+    or None if the line does not carry such a timestamp.
+
+    :param line: bytes or string
+    :returns: date
+    """
+    parts = line.split(None, 3)
+    try:
+        return datetime.datetime.utcfromtimestamp(float(parts[2])).date()
+    except (IndexError, ValueError, OverflowError, OSError):
+        return None
+
+
+def iter_lines_by_date(lines, batch_lines=10000):
+    """
+    Groups the lines of a log whose lines begin with "<date> <time> <unix_ts>"
+    into lists of consecutive lines of the same UTC date, of at most
+    batch_lines lines each, and yields them as (date, lines). Lines without a
+    timestamp follow the preceding line, and those before the first line with
+    a timestamp are dropped.
+    """
+    current_date, batch = None, []
+    for line in lines:
+        line_date = get_line_date(line)
+        if (line_date is not None and line_date != current_date) or len(batch) >= batch_lines:
+            if len(batch) > 0:
+                yield (current_date, batch)
+            batch = []
+            if line_date is not None:
+                current_date = line_date
+        if current_date is not None:
+            batch.append(line)
+    if len(batch) > 0:
+        yield (current_date, batch)
+
+
+class LineRangeReader(object):
+    """
+    Iterates over the text lines found in the given byte ranges of a binary
+    stream, mimicking the line splitting and newline translation that text
+    mode would apply for the given newline argument.
+    """
+
+    def __init__(self, fileobj, ranges, newline=None):
+        self.fileobj = fileobj
+        self.ranges = ranges
+        self.newline = newline
+        self.lines = self.__read_lines()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return next(self.lines)
+
+    def __read_lines(self):
+        for (start, end) in self.ranges:
+            self.fileobj.seek(start)
+            offset = start
+            pending = b''
+            for line in self.fileobj:
+                if end is not None and offset >= end and len(pending) == 0:
+                    break
+                offset += len(line)
+                if self.newline == '\r\n':
+                    pending += line
+                    if not pending.endswith(b'\r\n'):
+                        continue
+                    line, pending = pending, b''
+                text = line.decode('utf-8')
+                if self.newline is None:
+                    text = text.replace('\r\n', '\n')
+                yield text
+            if len(pending) > 0:
+                yield pending.decode('utf-8')
+
+    def close(self):
+        self.fileobj.close()
+
+
+def read_line_range(filename, byte_range, newline=None):
+    """
+    Reads the byte range of an uncompressed file at once and returns its text
+    lines as text mode would for the given newline argument, which must be
+    None or '\r\n'. This is much faster than a LineRangeReader for ranges
+    that fit into memory, such as the chunks returned by DataSource.get_chunks.
+    """
+    with open(filename, 'rb') as f:
+        f.seek(byte_range[0])
+        text = f.read(byte_range[1] - byte_range[0]).decode('utf-8')
+    return split_lines(text, newline)
+
+
+def split_lines(text, newline=None):
+    """
+    Splits text into lines like text mode would for the given newline
+    argument, which must be None or '\r\n'.
+    """
+    if newline is None:
+        lines = text.replace('\r\n', '\n').replace('\r', '\n').split('\n')
+        line_end = '\n'
+    else:
+        lines = text.split(newline)
+        line_end = newline
+    last = lines.pop()
+    lines = [line + line_end for line in lines]
+    if len(last) > 0:
+        lines.append(last)
+    return lines
+
+
+class TailSource(object):
+    """
+    A source over the complete lines that were appended to an uncompressed
+    log file after the given byte offset, for following a log that is still
+    being written. At most max_bytes are read; after the source was read,
+    offset is the position right after the last complete line, so that the
+    next TailSource can continue from there.
+    """
+
+    def __init__(self, filename, offset=0, max_bytes=1 << 26):
+        self.filename = filename
+        self.offset = offset
+        self.max_bytes = max_bytes
+        self.source = None
+
+    def __iter__(self):
+        if self.source is None:
+            self.open()
+        return self.source
+
+    def open(self, newline=None):
+        if self.source is None:
+            line_end = b'\r\n' if newline == '\r\n' else b'\n'
+            with open(self.filename, 'rb') as f:
+                f.seek(self.offset)
+                data = f.read(self.max_bytes)
+            # a partial last line is left for the next source, once it is complete
+            data = data[:data.rfind(line_end) + len(line_end)] if data.rfind(line_end) >= 0 else b''
+            self.offset += len(data)
+            self.source = iter(split_lines(data.decode('utf-8'), newline))
+
+    def close(self):
+        pass
+
+
 class DataSource(object):
-    def __init__(self, filename, compress=False):
+    def __init__(self, filename, compress=False, time_window=None, build_index=False, count_lines=False, fileobj=None, size=None):
         self.filename = filename
         self.compress = compress
+        # a filename like logs.tar.xz!/tgen.log is a member of a tar archive,
+        # which is read from fileobj if iter_archive_members already found it,
+        # or else by reading the archive up to the member; members have no
+        # sidecar LogIndex, so time_window does not apply to them
+        (self.archive_path, self.member_name) = split_archive_path(filename)
+        self.fileobj = fileobj
+        self.size = size
+        self.archive = None
+        # an optional [start, end) window of unix timestamps; if the log has
+        # a valid sidecar LogIndex (or build_index is set), only the parts of
+        # the file around this window are read
+        self.time_window = time_window
+        self.build_index = build_index
         self.source = None
+        # with count_lines, the number of lines and (decompressed) characters
+        # read so far, which parsers that read chunks themselves add to
+        self.count_lines = count_lines
+        self.lines_read = 0
+        self.bytes_read = 0
 
     def __iter__(self):
         if self.source is None:
             self.open()
+        if self.count_lines:
+            return self.__iter_counting()
         return self.source
 
+    def __iter_counting(self):
+        for line in self.source:
+            self.lines_read += 1
+            self.bytes_read += len(line)
+            yield line
+
     def __next__(self):
         return next(self.source) if self.source is not None else None
 
@@ -230,14 +975,84 @@ class DataSource(object):
         if self.source is None:
             if self.filename == '-':
                 self.source = sys.stdin
-            elif self.compress or self.filename.endswith(".xz"):
-                self.compress = True
-                self.source = lzma.open(self.filename, mode='rt', newline=newline)
-            elif self.filename.endswith(".gz"):
-                self.compress = True
-                self.source = gzip.open(self.filename, 'rt', newline=newline)
+            elif self.fileobj is not None or self.member_name is not None:
+                self.__open_member(newline)
+            elif self.time_window is not None and self.__open_window(newline):
+                pass
+            else:
+                codec = detect_codec(self.filename)
+                self.compress = codec.magic is not None
+                self.source = codec.open(self.filename, 'rt', newline=newline)
+
+    def __open_member(self, newline):
+        if self.fileobj is None:
+            self.archive = tarfile.open(self.archive_path, mode='r|*')
+            for member in self.archive:
+                if member.isfile() and member.name == self.member_name:
+                    self.fileobj = self.archive.extractfile(member)
+                    self.size = member.size
+                    break
             else:
-                self.source = open(self.filename, 'rt', newline=newline)
+                self.archive.close()
+                self.archive = None
+                raise FileNotFoundError("no file {0} in archive {1}".format(self.member_name, self.archive_path))
+        # members may themselves be compressed, e.g. rotated logs in a plain tar
+        fileobj = io.BufferedReader(_ArchiveMemberReader(self.fileobj))
+        codec = _get_codec_by_magic(fileobj.peek(8)[:8])
+        self.compress = codec.magic is not None
+        if self.compress:
+            self.source = codec.open(fileobj, 'rt', newline=newline)
+        else:
+            self.source = io.TextIOWrapper(fileobj, newline=newline)
+
+    def __open_window(self, newline):
+        index = LogIndex.load(self.filename)
+        if index is None and self.build_index:
+            logging.info("building time index for log file at {0}".format(self.filename))
+            index = LogIndex.build(self.filename)
+            index.save()
+        if index is None:
+            return False
+        ranges = index.get_ranges(self.time_window[0], self.time_window[1])
+        fileobj = XZStreamReader(self.filename, index.streams) if len(index.streams) > 0 else open_binary(self.filename)
+        self.source = LineRangeReader(fileobj, ranges, newline=newline)
+        return True
+
+    def get_chunks(self, num_chunks, newline=None):
+        """
+        Splits an uncompressed log file into at most num_chunks byte ranges
+        that begin and end at line boundaries for the given newline argument,
+        so that each range can be read on its own with a LineRangeReader.
+        Returns None if this source cannot be read at arbitrary offsets.
+        """
+        if self.filename == '-' or self.member_name is not None or self.compress or self.time_window is not None or \
+                detect_codec(self.filename).magic is not None:
+            return None
+        line_end = b'\r\n' if newline == '\r\n' else b'\n'
+        size = os.path.getsize(self.filename)
+        boundaries = [0]
+        with open(self.filename, 'rb') as f:
+            for i in range(1, num_chunks):
+                # a line ending that straddles the offset is still found
+                # because we start reading one byte early
+                f.seek(max(size * i // num_chunks - 1, boundaries[-1]))
+                line = f.readline()
+                while len(line) > 0 and not line.endswith(line_end):
+                    line = f.readline()
+                if len(line) == 0 or f.tell() >= size:
+                    break
+                if f.tell() > boundaries[-1]:
+                    boundaries.append(f.tell())
+        boundaries.append(size)
+        return list(zip(boundaries[:-1], boundaries[1:]))
+
+    def get_size(self):
+        """ returns the size in bytes of the file or archive member, or None for stdin """
+        if self.filename == '-':
+            return None
+        if self.member_name is not None:
+            return self.size
+        return os.path.getsize(self.filename)
 
     def get_file_handle(self):
         if self.source is None:
@@ -246,6 +1061,7 @@ class DataSource(object):
 
     def close(self):
         if self.source is not None: self.source.close()
+        if self.archive is not None: self.archive.close()
 
 
 class Writable(object, metaclass=ABCMeta):
@@ -260,19 +1076,32 @@ class Writable(object, metaclass=ABCMeta):
 
 class FileWritable(Writable):
 
-    def __init__(self, filename, do_compress=False, do_truncate=False):
+    def __init__(self, filename, do_compress=False, do_truncate=False, codec=None, level=None, threads=1,
+                 rotate_codec='gz', rotate_level=None):
         self.filename = filename
         self.do_compress = do_compress
         self.do_truncate = do_truncate
+        # the codec and level to write with, if compressing, which defaults to
+        # the codec of the filename's extension or else xz
+        self.codec = get_codec(codec) if codec is not None else get_codec_by_extension(filename)
+        self.level = level
+        self.threads = threads
+        # the codec and level of the archived copies made by rotate_file
+        self.rotate_codec = get_codec(rotate_codec)
+        self.rotate_level = rotate_level
         self.file = None
         self.lock = Lock()
 
         if self.filename == '-':
             self.file = sys.stdout
-        elif self.do_compress or self.filename.endswith(".xz"):
+        elif self.codec is not None and self.codec.magic is None:
+            self.do_compress = False
+        elif self.do_compress or self.codec is not None:
             self.do_compress = True
-            if not self.filename.endswith(".xz"):
-                self.filename += ".xz"
+            if self.codec is None:
+                self.codec = get_codec('xz')
+            if not self.filename.endswith(self.codec.extension):
+                self.filename += self.codec.extension
 
     def write(self, msg):
         self.lock.acquire()
@@ -286,8 +1115,10 @@ class FileWritable(Writable):
         self.lock.release()
 
     def __open_nolock(self):
-        if self.do_compress:
-            self.file = lzma.open(self.filename, mode='wt')
+        if self.do_compress and self.codec.name == 'xz' and self.threads > 1:
+            self.file = XZBlockWriter(self.filename, preset=self.codec.get_level(self.level), threads=self.threads)
+        elif self.do_compress:
+            self.file = self.codec.open(self.filename, 'wt', level=self.level, threads=self.threads)
         else:
             self.file = open(self.filename, 'wt' if self.do_truncate else 'at', 1)
 
@@ -304,18 +1135,18 @@ class FileWritable(Writable):
     def rotate_file(self, filename_datetime=datetime.datetime.now()):
         self.lock.acquire()
 
-        # build up the new filename with an embedded timestamp and ending in .gz
+        # build up the new filename with an embedded timestamp and ending in the rotate codec's extension
         base = os.path.basename(self.filename)
         base_noext = os.path.splitext(os.path.splitext(base)[0])[0]
         ts = filename_datetime.strftime("%Y-%m-%d_%H:%M:%S")
         new_base = base.replace(base_noext, "{0}_{1}".format(base_noext, ts))
-        new_filename = self.filename.replace(base, "log_archive/{0}.gz".format(new_base))
+        new_filename = self.filename.replace(base, "log_archive/{0}{1}".format(new_base, self.rotate_codec.extension))
 
         make_dir_path(os.path.dirname(new_filename))
 
         # close and copy the old file, then truncate and reopen the old file
         self.__close_nolock()
-        with open(self.filename, 'rb') as f_in, gzip.open(new_filename, 'wb') as f_out:
+        with open(self.filename, 'rb') as f_in, self.rotate_codec.open(new_filename, 'wb', level=self.rotate_level) as f_out:
             shutil.copyfileobj(f_in, f_out)
         with open(self.filename, 'ab') as f_in:
             f_in.truncate(0)
@@ -326,6 +1157,48 @@ class FileWritable(Writable):
         return new_filename
 
 
+class XZBlockWriter(object):
+    """
+    A text file object that compresses what is written to it in blocks of
+    block_size bytes, on several threads. Each block becomes its own xz
+    stream, and xz, lzma.open, and DataSource all read the concatenation of
+    these streams as a single .xz file.
+    """
+
+    def __init__(self, filename, preset=None, threads=2, block_size=1 << 23):
+        self.file = open(filename, 'wb')
+        self.preset = preset
+        self.block_size = block_size
+        self.executor = ThreadPoolExecutor(max_workers=threads)
+        self.max_pending = 2 * threads
+        self.pending = deque()
+        self.buffer = []
+        self.buffered = 0
+
+    def write(self, msg):
+        data = msg.encode('utf-8')
+        self.buffer.append(data)
+        self.buffered += len(data)
+        if self.buffered >= self.block_size:
+            self.__submit()
+
+    def __submit(self):
+        block = b''.join(self.buffer)
+        self.buffer, self.buffered = [], 0
+        # lzma releases the GIL while compressing, so blocks compress in parallel
+        self.pending.append(self.executor.submit(lzma.compress, block, preset=self.preset))
+        while len(self.pending) > self.max_pending:
+            self.file.write(self.pending.popleft().result())
+
+    def close(self):
+        if self.buffered > 0 or (len(self.pending) == 0 and self.file.tell() == 0):
+            self.__submit()
+        while len(self.pending) > 0:
+            self.file.write(self.pending.popleft().result())
+        self.executor.shutdown()
+        self.file.close()
+
+
 class MemoryWritable(Writable):
 
     def __init__(self):
@@ -341,6 +1214,36 @@ class MemoryWritable(Writable):
         self.str_buffer.close()
 
 
+def get_json_encoder(sort_keys=True):
+    """
+    Returns a function that encodes an object to compact JSON, using orjson
+    if it is installed and the json module's C encoder otherwise.
+    """
+    if orjson is not None:
+        option = orjson.OPT_NON_STR_KEYS | (orjson.OPT_SORT_KEYS if sort_keys else 0)
+        return lambda obj: orjson.dumps(obj, option=option).decode('utf-8')
+    return json.JSONEncoder(sort_keys=sort_keys, separators=(',', ':')).encode
+
+
+def iter_json_sections(obj, encode, sort_keys=True, depth=5):
+    """
+    Yields compact JSON for obj piece by piece. The dicts in the top depth
+    levels are written key by key, everything below them is encoded by
+    encode one value at a time, so no single string holds the whole obj.
+    """
+    if not isinstance(obj, dict) or depth == 0:
+        yield encode(obj)
+        return
+    keys = sorted(obj.keys()) if sort_keys else list(obj.keys())
+    yield '{'
+    for (i, key) in enumerate(keys):
+        # same key conversion as the json module, e.g. circuit ids are ints
+        name = key if isinstance(key, str) else json.dumps(key)
+        yield "{0}{1}:".format(',' if i > 0 else '', json.dumps(name))
+        yield from iter_json_sections(obj[key], encode, sort_keys, depth - 1)
+    yield '}'
+
+
 def match_log(regex, writable):
     if writable is not None and os.path.exists(writable):
         with open(writable, 'r') as fin:
@@ -19,6 +19,7 @@ import seaborn as sns
 import datetime
 import numpy as np
 import logging
+from onionperf import profiling, sketches
 
 def split_data_frame_list(df, target_column, position_column):
     """ df :: dataframe to split,
@@ -67,8 +68,12 @@ class Visualization(object, metaclass=ABCMeta):
 
     def __init__(self):
         self.datasets = []
+        self.profiler = None
         register_matplotlib_converters()
 
+    def set_profiler(self, profiler):
+        self.profiler = profiler
+
     def add_dataset(self, analyses, label):
         self.datasets.append((analyses, label))
 
@@ -82,40 +87,49 @@ class TGenVisualization(Visualization):
         if len(self.datasets) > 0:
             prefix = output_prefix + '.' if output_prefix is not None else ''
             ts = time.strftime("%Y-%m-%d_%H:%M:%S")
-            self.__extract_data_frame(onion=onion, public=public)
-            self.data.to_csv("{0}onionperf.viz.{1}.csv".format(prefix, ts))
+            with profiling.phase(self.profiler, "extract") as record:
+                self.__extract_data_frame(onion=onion, public=public)
+                self.data.to_csv("{0}onionperf.viz.{1}.csv".format(prefix, ts))
+                record.update(rows=len(self.data))
             if "base" in categories:
-                sns.set_context("paper")
-                self.page = PdfPages("{0}onionperf.viz.{1}.pdf".format(prefix, ts))
-                self.__plot_firstbyte_ecdf()
-                self.__plot_firstbyte_time()
-                self.__plot_lastbyte_ecdf()
-                self.__plot_lastbyte_box()
-                self.__plot_lastbyte_bar()
-                self.__plot_lastbyte_time()
-                self.__plot_throughput_ecdf()
-                self.__plot_downloads_count()
-                self.__plot_errors_count()
-                self.__plot_errors_time()
-                self.page.close()
+                with profiling.phase(self.profiler, "plot.base"):
+                    sns.set_context("paper")
+                    self.page = PdfPages("{0}onionperf.viz.{1}.pdf".format(prefix, ts))
+                    self.__plot_firstbyte_ecdf()
+                    self.__plot_firstbyte_time()
+                    self.__plot_lastbyte_ecdf()
+                    self.__plot_lastbyte_box()
+                    self.__plot_lastbyte_bar()
+                    self.__plot_lastbyte_time()
+                    self.__plot_throughput_ecdf()
+                    self.__plot_downloads_count()
+                    self.__plot_errors_count()
+                    self.__plot_errors_time()
+                    self.page.close()
             if "outliers" in categories:
-                # plot outliers in a separate pdf
-                self.page = PdfPages("{0}onionperf.outliers.{1}.pdf".format(prefix, ts))
-                if threshold >= 10:
-                    sns.set(rc={"figure.figsize":(threshold, threshold/1.5)})
-                else:
-                    sns.set(rc={"figure.figsize":(15, 10)})
-
-                firstbyte_csv = self.__plot_firstbyte_outliers(percentile/100.0, threshold)
-                lastbyte_csv = self.__plot_lastbyte_outliers(percentile/100.0, threshold)
-                errors_csv = self.__plot_top_errors(threshold)
-                self.page.close()
-                if not firstbyte_csv.empty:
-                    firstbyte_csv.to_csv("{0}onionperf.firstbyte_outliers.{1}.csv".format(prefix, ts), index=False)
-                if not lastbyte_csv.empty:
-                    lastbyte_csv.to_csv("{0}onionperf.lastbyte_outliers.{1}.csv".format(prefix, ts), index=False)
-                if not errors_csv.empty:
-                    errors_csv.to_csv("{0}onionperf.error_outliers.{1}.csv".format(prefix, ts), index=False)
+                with profiling.phase(self.profiler, "plot.outliers"):
+                    # plot outliers in a separate pdf
+                    self.page = PdfPages("{0}onionperf.outliers.{1}.pdf".format(prefix, ts))
+                    if threshold >= 10:
+                        sns.set(rc={"figure.figsize":(threshold, threshold/1.5)})
+                    else:
+                        sns.set(rc={"figure.figsize":(15, 10)})
+
+                    firstbyte_csv = self.__plot_firstbyte_outliers(percentile/100.0, threshold)
+                    lastbyte_csv = self.__plot_lastbyte_outliers(percentile/100.0, threshold)
+                    errors_csv = self.__plot_top_errors(threshold)
+                    self.page.close()
+                    if not firstbyte_csv.empty:
+                        firstbyte_csv.to_csv("{0}onionperf.firstbyte_outliers.{1}.csv".format(prefix, ts), index=False)
+                    if not lastbyte_csv.empty:
+                        lastbyte_csv.to_csv("{0}onionperf.lastbyte_outliers.{1}.csv".format(prefix, ts), index=False)
+                    if not errors_csv.empty:
+                        errors_csv.to_csv("{0}onionperf.error_outliers.{1}.csv".format(prefix, ts), index=False)
+
+    def get_data_frame(self, onion=False, public=False):
+        ''' returns the data frame with one row per measurement that the graphs are drawn from '''
+        self.__extract_data_frame(onion=onion, public=public)
+        return self.data
 
     def __extract_data_frame(self, onion, public):
         streams = []
@@ -156,34 +170,14 @@ class TGenVisualization(Visualization):
                         error_code = None
                         source_port = None
                         unix_ts_end = None
-                        # Explanation of the math below for computing Mbps: For 1 MiB
-                        # downloads we can extract the number of seconds that have elapsed between
-                        # receiving bytes 524,288 and 1,048,576, which is a total amount of 524,288
-                        # bytes or 4,194,304 bits or 4.194304 megabits.
-
-                        # For 5 MiB downloads we extract the number of seconds that have elapsed between
-                        # receiving bytes 4,194,304 and 5,242,880, which is a total amount of 1,048,576
-                        # bytes or 8,388,608 bits or 8.388608 megabits. We want the reciprocal of
-                        # that value with unit megabits per second.
+                        metrics = {}
                         if tgen_streams:
                             stream_id, stream_data = tgen_streams.popitem()
                             stream["id"] = stream_id
                             stream["label"] = label
                             stream["filesize_bytes"] = int(stream_data["stream_info"]["recvsize"])
                             stream["server"] = "onion" if ".onion:" in stream_data["transport_info"]["remote"] else "public"
-                            if "time_info" in stream_data:
-                                s = stream_data["time_info"]
-                                if "usecs-to-first-byte-recv" in s and float(s["usecs-to-first-byte-recv"]) >= 0:
-                                    stream["time_to_first_byte"] = float(s["usecs-to-first-byte-recv"])/1000000
-                                if "usecs-to-last-byte-recv" in s and float(s["usecs-to-last-byte-recv"]) >= 0:
-                                    stream["time_to_last_byte"] = float(s["usecs-to-last-byte-recv"])/1000000
-                            if "elapsed_seconds" in stream_data:
-                                s = stream_data["elapsed_seconds"]
-                                if stream_data["stream_info"]["recvsize"] == "5242880" and "1.0" in s["payload_progress_recv"]:
-                                     try:
-                                         stream["mbps"] = 8.388608 / (s["payload_progress_recv"]["1.0"] - s["payload_progress_recv"]["0.8"])
-                                     except ZeroDivisionError:
-                                         stream["mbps"] = 8.388608
+                            metrics = sketches.get_stream_metrics(stream_data)
                             if "error" in stream_data["stream_info"] and stream_data["stream_info"]["error"] != "NONE":
                                 error_code = stream_data["stream_info"]["error"]
                             if "local" in stream_data["transport_info"] and len(stream_data["transport_info"]["local"].split(":")) > 2:
@@ -198,17 +192,7 @@ class TGenVisualization(Visualization):
                             stream["label"] = label
                             stream["filesize_bytes"] = transfer_data["filesize_bytes"]
                             stream["server"] = "onion" if ".onion:" in transfer_data["endpoint_remote"] else "public"
-                            if "elapsed_seconds" in transfer_data:
-                               s = transfer_data["elapsed_seconds"]
-                               if "payload_progress" in s:
-                                   if transfer_data["filesize_bytes"] == 1048576 and "1.0" in s["payload_progress"]:
-                                       stream["mbps"] = 4.194304 / (s["payload_progress"]["1.0"] - s["payload_progress"]["0.5"])
-                                   if transfer_data["filesize_bytes"] == 5242880 and "1.0" in s["payload_progress"]:
-                                       stream["mbps"] = 8.388608 / (s["payload_progress"]["1.0"] - s["payload_progress"]["0.8"])
-                               if "first_byte" in s:
-                                   stream["time_to_first_byte"] = s["first_byte"]
-                               if "last_byte" in s:
-                                   stream["time_to_last_byte"] = s["last_byte"]
+                            metrics = sketches.get_transfer_metrics(transfer_data)
                             if "error_code" in transfer_data and transfer_data["error_code"] != "NONE":
                                 error_code = transfer_data["error_code"]
                             if "endpoint_local" in transfer_data and len(transfer_data["endpoint_local"].split(":")) > 2:
@@ -217,6 +201,9 @@ class TGenVisualization(Visualization):
                                 unix_ts_end = transfer_data["unix_ts_end"]
                             if "unix_ts_start" in transfer_data:
                                 stream["start"] = datetime.datetime.utcfromtimestamp(transfer_data["unix_ts_start"])
+                        stream["time_to_first_byte"] = metrics.get("ttfb")
+                        stream["time_to_last_byte"] = metrics.get("ttlb")
+                        stream["mbps"] = metrics.get("mbps")
                         tor_circuit = None
                         circuit_id = None
                         if source_port and source_port in tor_streams_by_source_port and unix_ts_end: